@@ -0,0 +1,328 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from .cluster import shared_redis
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'chat:cache-invalidation'
+
+
+class LRUCache:
+    """
+    A thread safe, process-wide least recently used cache.
+
+    Attributes:
+        maxsize (int): The maximum number of entries kept in the cache.
+
+    Methods:
+        get(key): Returns a cached value and marks it as recently used.
+        set(key, value): Stores a value, evicting the least recently used entry if the cache is full.
+        invalidate(key): Removes an entry.
+        clear(): Removes every entry.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        """
+        Returns a cached value and marks it as recently used.
+
+        Args:
+            key: The key of the entry.
+            default: The value returned when the key is not cached.
+
+        Returns:
+            The cached value, or `default`.
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        """
+        Stores a value, evicting the least recently used entry if the cache is full.
+
+        Args:
+            key: The key of the entry.
+            value: The value to cache.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+
+    def invalidate(self, key):
+        """
+        Removes an entry if it is cached.
+
+        Args:
+            key: The key of the entry.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CacheInvalidationBus:
+    """
+    Propagates the invalidations of the process-wide caches to the other worker processes.
+
+    In multi-worker mode every invalidation is published on a Redis Pub/Sub channel once the
+    transaction that caused it commits, and every process that has cached anything listens on
+    that channel from a daemon thread and applies the invalidations of the other processes. A
+    process subscribes before it caches its first entry, so it never keeps an entry that was
+    invalidated before it listened. If the subscription is lost, both caches are cleared, since
+    invalidations may have been missed meanwhile. In single process mode nothing is published.
+
+    Attributes:
+        redis (SharedRedis): The connections to the shared Redis server.
+
+    Methods:
+        publish(friend_ids, session_ids, clear_sessions): Publishes invalidations to the other processes.
+        ensure_subscribed(): Starts listening to the invalidations of the other processes.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._origin = uuid.uuid4().hex
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, friend_ids = (), session_ids = (), clear_sessions = False):
+        """
+        Publishes invalidations to the other processes once the current transaction commits.
+
+        Args:
+            friend_ids (iterable): The IDs of the users whose cached chat partners changed.
+            session_ids (iterable): The IDs of the chat sessions whose cached participants changed.
+            clear_sessions (bool): Whether every cached chat session participants must be dropped.
+        """
+        if not self.redis.enabled:
+            return
+        payload = json.dumps({'origin': self._origin, 'friend_ids': list(friend_ids), 'session_ids': list(session_ids), 'clear_sessions': clear_sessions})
+
+        def send():
+            try:
+                self.redis.sync_client().publish(INVALIDATION_CHANNEL, payload)
+            except Exception:
+                logger.exception('Publishing a cache invalidation failed')
+        transaction.on_commit(send)
+
+    def ensure_subscribed(self):
+        """
+        Starts listening to the invalidations of the other processes, once per process.
+
+        Returns after Redis confirmed the subscription, so invalidations published from then on are applied.
+        """
+        if self._thread is not None or not self.redis.enabled:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            pubsub = self.redis.sync_client().pubsub()
+            pubsub.subscribe(**{INVALIDATION_CHANNEL: self._apply})
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout = 0.5)
+                if message is not None and message['type'] == 'subscribe':
+                    break
+            pubsub.ignore_subscribe_messages = True
+            self._thread = pubsub.run_in_thread(sleep_time = 1, daemon = True, exception_handler = self._lost)
+
+    def _apply(self, message):
+        """
+        Applies the invalidations published by another process.
+        """
+        data = json.loads(message['data'])
+        if data['origin'] == self._origin:
+            return
+        for user_id in data['friend_ids']:
+            friend_index.invalidate(user_id)
+        if data['clear_sessions']:
+            session_participants.clear()
+        for session_id in data['session_ids']:
+            session_participants.invalidate(session_id)
+
+    def _lost(self, error, pubsub, thread):
+        """
+        Clears the caches after the subscription failed; the listener reconnects on its next read.
+        """
+        logger.warning('Cache invalidation subscription failed, clearing the caches: %s', error)
+        friend_index.clear()
+        session_participants.clear()
+        time.sleep(1)
+
+
+class SessionParticipants(namedtuple('SessionParticipants', ['session_id', 'user1_id', 'user1_name', 'user2_id', 'user2_name'])):
+    """
+    The participants of a chat session as cached by `session_participants`.
+
+    Methods:
+        includes(user_id): Checks if a user is a participant of the chat session.
+        other_id(user_id): Returns the ID of the other participant.
+    """
+    __slots__ = ()
+
+    def includes(self, user_id):
+        """
+        Checks if a user is a participant of the chat session.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            bool: True if the user is one of the two participants.
+        """
+        return user_id in (self.user1_id, self.user2_id)
+
+    def other_id(self, user_id):
+        """
+        Returns the ID of the participant who is not the given user.
+
+        Args:
+            user_id (int): The ID of one of the participants.
+
+        Returns:
+            int: The ID of the other participant.
+        """
+        return self.user2_id if user_id == self.user1_id else self.user1_id
+
+
+session_participants = LRUCache(getattr(settings, 'CHAT_PARTICIPANT_CACHE_SIZE', 10000))
+
+
+def cached_session_participants(session_id):
+    """
+    Returns the participants of a chat session if they are cached, without touching the database.
+
+    Args:
+        session_id (int): The ID of the chat session.
+
+    Returns:
+        SessionParticipants or None: The cached participants.
+    """
+    return session_participants.get(int(session_id))
+
+
+def get_session_participants(session_id):
+    """
+    Returns the participants of a chat session, loading and caching them on a cache miss.
+
+    Entries are invalidated by the `ChatSession` and `User` signal receivers when a chat session
+    is saved or deleted or a username may have changed.
+
+    Args:
+        session_id (int): The ID of the chat session.
+
+    Returns:
+        SessionParticipants or None: The participants, or None if the chat session does not exist.
+    """
+    from .models import ChatSession
+    session_id = int(session_id)
+    participants = session_participants.get(session_id)
+    if participants is None:
+        invalidation_bus.ensure_subscribed()
+        row = ChatSession.objects.filter(id = session_id).values_list('user1_id', 'user1__username', 'user2_id', 'user2__username').first()
+        if row is None:
+            return None
+        participants = SessionParticipants(session_id, *row)
+        session_participants.set(session_id, participants)
+    return participants
+
+
+friend_index = LRUCache(getattr(settings, 'CHAT_FRIEND_INDEX_CACHE_SIZE', 10000))
+
+
+def cached_friend_ids(user_id):
+    """
+    Returns the IDs of the chat partners of a user if they are cached, without touching the database.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        frozenset or None: The cached IDs of the users sharing a chat session with the user.
+    """
+    return friend_index.get(user_id)
+
+
+def get_friend_ids(user_id):
+    """
+    Returns the IDs of the chat partners of a user, loading and caching them on a cache miss.
+
+    The adjacency is loaded with a single query on the user columns of `ChatSession`. Entries
+    are invalidated by the signals of `ChatSession` when a chat session is created or deleted.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        frozenset: The IDs of the users sharing a chat session with the user.
+    """
+    from .models import ChatSession
+    friend_ids = friend_index.get(user_id)
+    if friend_ids is None:
+        invalidation_bus.ensure_subscribed()
+        rows = ChatSession.objects.filter(Q(user1_id = user_id) | Q(user2_id = user_id)).values_list('user1_id', 'user2_id')
+        friend_ids = frozenset(user2_id if user1_id == user_id else user1_id for user1_id, user2_id in rows)
+        friend_index.set(user_id, friend_ids)
+    return friend_ids
+
+
+def invalidate_friend_ids(*user_ids):
+    """
+    Removes the cached chat partners of users whose chat sessions changed, in every worker process.
+
+    Args:
+        *user_ids (int): The IDs of the users.
+    """
+    for user_id in user_ids:
+        friend_index.invalidate(user_id)
+    invalidation_bus.publish(friend_ids = user_ids)
+
+
+def invalidate_participants(*session_ids):
+    """
+    Removes the cached participants of chat sessions that were saved or deleted, in every worker process.
+
+    Args:
+        *session_ids (int): The IDs of the chat sessions.
+    """
+    for session_id in session_ids:
+        session_participants.invalidate(session_id)
+    invalidation_bus.publish(session_ids = session_ids)
+
+
+def clear_participants():
+    """
+    Removes every cached chat session participants, in every worker process.
+    """
+    session_participants.clear()
+    invalidation_bus.publish(clear_sessions = True)
+
+
+invalidation_bus = CacheInvalidationBus(shared_redis)
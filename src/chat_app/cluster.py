@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+
+
+class SharedRedis:
+    """
+    The Redis connections holding the chat state shared by the worker processes in multi-worker mode.
+
+    Multi-worker mode is enabled by setting `CHAT_CLUSTER['REDIS_URL']`; without it every piece of
+    state is kept in the memory of the single process. Async clients are bound to the event loop
+    they were created on, so one is kept per event loop together with the Lua scripts registered
+    on it. Sync code (views, signal receivers, shutdown hooks) shares one thread safe sync client.
+
+    Attributes:
+        url (str): The Redis URL, or an empty string in single process mode.
+
+    Methods:
+        from_settings(): Creates the connections from the `CHAT_CLUSTER` setting.
+        client(): Returns the async client of the running event loop.
+        script(source): Returns a Lua script registered on the async client of the running event loop.
+        sync_client(): Returns the sync client.
+    """
+
+    def __init__(self, url = ''):
+        self.url = url
+        self._clients = weakref.WeakKeyDictionary()
+        self._sync_client = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the connections from the `CHAT_CLUSTER` setting.
+
+        Returns:
+            SharedRedis: The configured connections.
+        """
+        return cls(url = getattr(settings, 'CHAT_CLUSTER', {}).get('REDIS_URL', ''))
+
+    @property
+    def enabled(self):
+        """
+        bool: Whether the chat runs in multi-worker mode.
+        """
+        return bool(self.url)
+
+    def client(self):
+        """
+        Returns the async client of the running event loop, creating it on first use.
+
+        Returns:
+            redis.asyncio.Redis: The client, decoding responses to str.
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._clients.get(loop)
+        if entry is None:
+            entry = self._clients[loop] = (redis.asyncio.Redis.from_url(self.url, decode_responses = True), {})
+        return entry[0]
+
+    def script(self, source):
+        """
+        Returns a Lua script registered on the async client of the running event loop.
+
+        Args:
+            source (str): The Lua source of the script.
+
+        Returns:
+            redis.commands.core.AsyncScript: The script, called with `keys` and `args` and run with EVALSHA.
+        """
+        client = self.client()
+        scripts = self._clients[asyncio.get_running_loop()][1]
+        script = scripts.get(source)
+        if script is None:
+            script = scripts[source] = client.register_script(source)
+        return script
+
+    def sync_client(self):
+        """
+        Returns the sync client, creating it on first use.
+
+        Returns:
+            redis.Redis: The client, decoding responses to str.
+        """
+        if self._sync_client is None:
+            with self._lock:
+                if self._sync_client is None:
+                    self._sync_client = redis.Redis.from_url(self.url, decode_responses = True)
+        return self._sync_client
+
+
+shared_redis = SharedRedis.from_settings()
@@ -1,36 +1,161 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-import json
 from datetime import datetime
-from chat_app.models import ChatSession, ChatMessage
+from chat_app.models import ChatMessage
 from channels.db import database_sync_to_async
 import uuid
-from .models import Profile
-from django.db.models import Q
+from urllib.parse import parse_qs
+from django.conf import settings
+from django.utils import timezone
+from .models import Profile, UnreadCounter
+from .write_behind import message_writer
+from .cache import cached_session_participants, get_session_participants
+from .presence import presence
+from .replay import room_sequencer, replay_buffer, stored_events_since
+from .typing_indicator import typing_tracker
+from .unread_push import unread_pusher
+from .wire import encode_frame, encode_binary_frame, decode_frame, frame_event, MSGPACK_SUBPROTOCOL, MSGPACK_QUERY_VALUE
 
 
 MESSAGE_MAX_LENGTH = 10
 
+READ_RECEIPT_MAX_BATCH = 1000
+
+CLOSE_CODE_OVERFLOW = 1013
+
 MESSAGE_ERROR_TYPE = {
     "MESSAGE_OUT_OF_LENGTH": 'MESSAGE_OUT_OF_LENGTH',
     "UN_AUTHENTICATED": 'UN_AUTHENTICATED',
+    "UN_AUTHORIZED": 'UN_AUTHORIZED',
     "INVALID_MESSAGE": 'INVALID_MESSAGE',
 }
 
 MESSAGE_TYPE = {
     "WENT_ONLINE": 'WENT_ONLINE',
     "WENT_OFFLINE": 'WENT_OFFLINE',
+    "HEARTBEAT": 'HEARTBEAT',
     "IS_TYPING": 'IS_TYPING',
     "NOT_TYPING": 'NOT_TYPING',
     "MESSAGE_COUNTER": 'MESSAGE_COUNTER',
     "OVERALL_MESSAGE_COUNTER": 'OVERALL_MESSAGE_COUNTER',
     "TEXT_MESSAGE": 'TEXT_MESSAGE',
     "MESSAGE_READ": 'MESSAGE_READ',
+    "MESSAGES_READ": 'MESSAGES_READ',
     "ALL_MESSAGE_READ": 'ALL_MESSAGE_READ',
-    "ERROR_OCCURED": 'ERROR_OCCURED'
+    "READ_UNTIL": 'READ_UNTIL',
+    "RESUME": 'RESUME',
+    "RESYNC_REQUIRED": 'RESYNC_REQUIRED',
+    "ERROR_OCCURED": 'ERROR_OCCURED',
+    "SUBSCRIBE": 'SUBSCRIBE',
+    "UNSUBSCRIBE": 'UNSUBSCRIBE',
+    "SUBSCRIBED": 'SUBSCRIBED',
+    "UNSUBSCRIBED": 'UNSUBSCRIBED',
 }
 
 
-class PersonalConsumer(AsyncWebsocketConsumer):
+async def room_participants(room_name, user_id):
+    """
+    Resolves the participants of a chat room a user wants to join.
+
+    The participants are taken from the process-wide participant cache when possible.
+
+    Args:
+        room_name (str): The room name, `chat_<session id>`.
+        user_id (int): The ID of the user.
+
+    Returns:
+        SessionParticipants: The participants of the chat session, or None if the room does not
+        exist or the user is not one of its participants.
+    """
+    session_id = room_name[5:]
+    if not room_name.startswith('chat_') or not session_id.isdigit():
+        return None
+    participants = cached_session_participants(session_id) or await database_sync_to_async(get_session_participants)(session_id)
+    if participants is None or not participants.includes(user_id):
+        return None
+    return participants
+
+
+class WireProtocolMixin:
+    """
+    Negotiates and speaks the WebSocket protocol of a connection.
+
+    JSON text frames are the default. A client asking for the `chat.msgpack` subprotocol, or
+    passing `protocol=msgpack` in the query string, gets binary msgpack frames whose message
+    types are integer codes, and may send its own frames that way.
+
+    Attributes:
+        binary (bool): Whether the connection uses the binary protocol.
+
+    Methods:
+        select_protocol(): Chooses the protocol of the connection from the handshake.
+        send_frame(frame): Encodes a frame for this connection and sends it.
+        forward_frame(event): Sends the pre-encoded frame of a channel layer event.
+        send_encoded(frames): Sends the encoding of a (JSON, binary) frame pair matching this connection.
+        channel_overflow(event): Closes a connection that fell too far behind its channel.
+    """
+    binary = False
+
+    def select_protocol(self):
+        """
+        Chooses the protocol of the connection from the handshake.
+
+        Returns:
+            str or None: The subprotocol to accept the connection with, if the client asked for one.
+        """
+        if MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', []):
+            self.binary = True
+            return MSGPACK_SUBPROTOCOL
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.binary = query.get('protocol', [''])[0] == MSGPACK_QUERY_VALUE
+        return None
+
+    async def send_frame(self, frame):
+        """
+        Encodes a frame sent to this connection only and sends it.
+
+        Args:
+            frame (dict): The frame.
+        """
+        if self.binary:
+            await self.send(bytes_data=encode_binary_frame(frame))
+        else:
+            await self.send(text_data=encode_frame(frame))
+
+    async def forward_frame(self, event):
+        """
+        Sends the frame of a channel layer event built with `frame_event`, as encoded by the sender.
+
+        Args:
+            event (dict): The channel layer event.
+        """
+        await self.send_encoded((event['frame'], event['binary_frame']))
+
+    async def send_encoded(self, frames):
+        """
+        Sends the encoding of a frame matching the protocol of this connection.
+
+        Args:
+            frames (tuple): The JSON text and the binary encoding of the frame.
+        """
+        if self.binary:
+            await self.send(bytes_data=frames[1])
+        else:
+            await self.send(text_data=frames[0])
+
+    async def channel_overflow(self, event):
+        """
+        Closes the connection after the local channel layer dropped its channel under the close overflow policy.
+
+        The channel left its groups and receives nothing anymore, so the client has to reconnect;
+        a chat room client resumes from its last sequence number.
+
+        Args:
+            event (dict): The channel layer event.
+        """
+        await self.close(code=CLOSE_CODE_OVERFLOW)
+
+
+class PersonalConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
     Handles WebSocket connections and messages for personal chat sessions.
 
@@ -38,48 +163,58 @@ class PersonalConsumer(AsyncWebsocketConsumer):
         connect(): Handles the WebSocket connection initiation.
         disconnect(code): Handles the WebSocket connection termination.
         receive(text_data): Handles incoming WebSocket messages.
+        handle_frame(data): Handles a decoded presence frame of the client.
         user_online(event): Sends a message indicating a user has gone online.
         message_counter(event): Sends a message containing the count of unread messages.
         user_offline(event): Sends a message indicating a user has gone offline.
-        set_online(user_id): Sets a user as online and retrieves IDs of their friends for notifications.
-        set_offline(user_id): Sets a user as offline and retrieves IDs of their friends for notifications.
-        count_unread_overall_msg(user_id): Counts the overall number of unread messages for a user.
+        set_online(): Marks this connection of the user as present in the presence registry.
+        set_offline(): Marks this connection of the user as gone in the presence registry.
+
+    The events of the channel layer carry the frame already encoded by the sender, which the
+    handlers forward to the socket untouched in the protocol negotiated by `WireProtocolMixin`.
     """
     async def connect(self):
         """
         Handles the WebSocket connection initiation.
 
         This method is called when a client attempts to establish a WebSocket connection.
-        It extracts the room name from the URL route kwargs, constructs the room group name,
-        and adds the channel to the corresponding group. If the user is authenticated, the
-        connection is accepted, allowing communication via WebSocket. If the user is not
-        authenticated, the connection is closed with a custom code indicating authentication failure.
+        It extracts the room name from the URL route kwargs and constructs the room group name.
+        If the user is not authenticated, or the room is not the personal room of the user, the
+        connection is closed with a custom code before the channel joins any group. Otherwise
+        the channel is added to the corresponding group and the connection is accepted, allowing
+        communication via WebSocket, and the connection is registered as present.
 
         Raises:
             WebSocketError: If an error occurs during WebSocket connection initiation.
 
         """
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'personal__{self.room_name}'
+        self.room_group_name = None
         self.user = self.scope['user']
 
+        if not self.user.is_authenticated:
+            await self.close(code=4001)
+            return
+        if self.room_name != str(self.user.id):
+            await self.close(code=4003)
+            return
+
+        self.room_group_name = f'personal__{self.room_name}'
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-
-        if self.scope["user"].is_authenticated:
-            await self.accept()
-        else:
-            await self.close(code=4001)
+        await self.accept(self.select_protocol())
+        await self.set_online()
             
     async def disconnect(self, code):
         """
         Handles the WebSocket connection termination.
 
-        This method is called when a WebSocket connection is closed. It sets the user offline
-        by calling the `set_offline` method, and removes the channel from the corresponding room
-        group using `group_discard` method.
+        This method is called when a WebSocket connection is closed. It removes the connection
+        from the presence registry by calling the `set_offline` method, which only takes the user
+        offline if no other connection of the user is present, and removes the channel from the
+        corresponding room group using `group_discard` method.
 
         Args:
             code (int): The status code indicating the reason for disconnection.
@@ -88,211 +223,154 @@ class PersonalConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs during WebSocket disconnection handling.
 
         """
-        self.set_offline()
+        if self.room_group_name is None:
+            return
+        await self.set_offline()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
         
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Handles incoming WebSocket messages.
 
         This method is called when a message is received over the WebSocket connection.
-        It parses the received JSON data to extract the message type and user ID. Depending
-        on the message type, it either sets the user online or offline using `set_online`
-        or `set_offline` methods, respectively. It then sends appropriate notifications to
-        the relevant room groups indicating the user's online or offline status.
+        It decodes the received JSON or msgpack data and hands it to `handle_frame`.
 
         Args:
             text_data (str): The received JSON data as a string.
+            bytes_data (bytes): The received msgpack data of a binary connection.
 
         Raises:
             WebSocketError: If an error occurs during WebSocket message handling.
 
         """
-        data = json.loads(text_data)
+        await self.handle_frame(decode_frame(text_data, bytes_data))
+
+    async def handle_frame(self, data):
+        """
+        Handles a decoded presence frame of the client.
+
+        Depending on the message type, it marks this connection as present or gone using
+        `set_online` or `set_offline` methods, respectively, or refreshes its heartbeat. The
+        presence registry notifies the relevant room groups when the user's online status changes.
+
+        Args:
+            data (dict): The decoded frame.
+
+        """
         msg_type = data.get('msg_type')
-        user_id = data.get('user_id')
         
         if msg_type == MESSAGE_TYPE['WENT_ONLINE']:
-            users_room_id = await self.set_online(user_id)
-            for room_id in users_room_id:
-                await self.channel_layer.group_send(
-                    f'personal__{room_id}',
-                    {
-                    'type': 'user_online',
-                    'user_name' : self.user.username
-                    }
-                )
+            await self.set_online()
         elif msg_type == MESSAGE_TYPE['WENT_OFFLINE']:
-            users_room_id = await self.set_offline(user_id)
-            for room_id in users_room_id:
-                await self.channel_layer.group_send(
-                    f'personal__{room_id}',
-                    {
-                    'type': 'user_offline',
-                    'user_name' : self.user.username
-                    }
-                )
+            await self.set_offline()
+        elif msg_type == MESSAGE_TYPE['HEARTBEAT']:
+            await presence.heartbeat(self.user.id, self.channel_name)
             
     async def user_online(self,event):
         """
         Sends a message indicating a user has gone online.
 
         This method is invoked when a user goes online, triggering a notification event.
-        It sends a WebSocket message to the client containing information about the user
-        who has gone online, including their username.
+        It forwards the WebSocket message built by `broadcast_presence`, containing information
+        about the user who has gone online, including their username, to the client.
 
         Args:
-            event (dict): A dictionary containing information about the online user event.
+            event (dict): A dictionary containing the encoded frame of the online user event.
 
         Raises:
             WebSocketError: If an error occurs during WebSocket message handling.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['WENT_ONLINE'],
-            'user_name' : event['user_name']
-        }))
+        await self.forward_frame(event)
         
     async def message_counter(self, event):
         """
         Sends a message containing the count of unread messages.
 
         This method is invoked when a message counter event is triggered, typically after a user
-        receives a new message. It calculates the overall number of unread messages for the current
-        user by calling the `count_unread_overall_msg` method. Then, it sends a WebSocket message
-        to the client containing the count of unread messages.
+        receives new messages. The unread pusher builds the message once, however many connections
+        the recipient has, from the counts stored with the messages: the new unread count of every
+        chat session that changed, with the other participant, and the new overall unread count.
+        Bursts of messages are coalesced into one message. This method forwards it to the client.
 
         Args:
-            event (dict): A dictionary containing information about the message counter event.
+            event (dict): A dictionary containing the encoded frame of the message counter event.
 
         Raises:
             WebSocketError: If an error occurs during WebSocket message handling.
 
         """
-        overall_unread_msg = await self.count_unread_overall_msg(event['current_user_id'])
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['MESSAGE_COUNTER'],
-            'user_id': event['user_id'],
-            'overall_unread_msg' : overall_unread_msg
-        }))
+        await self.forward_frame(event)
 
     async def user_offline(self,event):
         """
         Sends a message indicating a user has gone offline.
 
         This method is invoked when a user goes offline, triggering a notification event.
-        It sends a WebSocket message to the client containing information about the user
-        who has gone offline, including their username.
+        It forwards the WebSocket message built by `broadcast_presence`, containing information
+        about the user who has gone offline, including their username, to the client.
 
         Args:
-            event (dict): A dictionary containing information about the offline user event.
+            event (dict): A dictionary containing the encoded frame of the offline user event.
 
         Raises:
             WebSocketError: If an error occurs during WebSocket message handling.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['WENT_OFFLINE'],
-            'user_name' : event['user_name']
-        }))
+        await self.forward_frame(event)
     
-    @database_sync_to_async
-    def set_online(self,user_id):
+    async def set_online(self):
         """
-        Sets a user as online and retrieves IDs of their friends for notifications.
-
-        This method is responsible for updating the online status of a user in the database
-        and retrieving the IDs of their friends for sending online notifications. It marks the
-        user as online by updating the `is_online` field in the `Profile` model. Then, it retrieves
-        the chat sessions involving the current user and extracts the IDs of their friends based
-        on the session participants.
-
-        Args:
-            user_id (int): The ID of the user to set as online.
+        Marks this connection of the user as present.
 
-        Returns:
-            list: A list of user IDs representing friends of the current user.
-
-        Raises:
-            DatabaseError: If an error occurs while accessing or updating the database.
+        The presence registry reference counts the connections of the user, so friends are only
+        notified and `Profile.is_online` only updated when this is the first present connection.
 
         """
-        Profile.objects.filter(user__id = user_id).update(is_online = True)
-        user_all_friends = ChatSession.objects.filter(Q(user1 = self.user) | Q(user2 = self.user))
-        user_id = []
-        for ch_session in user_all_friends:
-            user_id.append(ch_session.user2.id) if self.user.username == ch_session.user1.username else user_id.append(ch_session.user1.id)
-        return user_id
+        await presence.connect(self.user.id, self.user.username, self.channel_name)
 
-    @database_sync_to_async
-    def set_offline(self,user_id):
+    async def set_offline(self):
         """
-        Sets a user as offline and retrieves IDs of their friends for notifications.
+        Marks this connection of the user as gone.
 
-        This method is responsible for updating the online status of a user in the database
-        and retrieving the IDs of their friends for sending offline notifications. It marks the
-        user as offline by updating the `is_online` field in the `Profile` model. Then, it retrieves
-        the chat sessions involving the current user and extracts the IDs of their friends based
-        on the session participants.
-
-        Args:
-            user_id (int): The ID of the user to set as offline.
-
-        Returns:
-            list: A list of user IDs representing friends of the current user.
+        Friends are only notified and `Profile.is_online` only updated when no other connection
+        of the user is present.
 
-        Raises:
-            DatabaseError: If an error occurs while accessing or updating the database.
-
-        """
-        Profile.objects.filter(user__id = user_id).update(is_online = False)
-        user_all_friends = ChatSession.objects.filter(Q(user1 = self.user) | Q(user2 = self.user))
-        user_id = []
-        for ch_session in user_all_friends:
-            user_id.append(ch_session.user2.id) if self.user.username == ch_session.user1.username else user_id.append(ch_session.user1.id)
-        return user_id
-
-    @database_sync_to_async
-    def count_unread_overall_msg(self,user_id):
         """
-        Counts the overall number of unread messages for a user.
-
-        This method asynchronously calculates the total number of unread messages for a given user.
-        It queries the `ChatMessage` model to count the unread messages associated with the provided
-        user ID.
+        await presence.disconnect(self.user.id, self.channel_name)
 
-        Args:
-            user_id (int): The ID of the user for whom the unread messages are counted.
 
-        Returns:
-            int: The total number of unread messages for the specified user.
-
-        Raises:
-            DatabaseError: If an error occurs while accessing the database.
-
-        """
-        return ChatMessage.count_overall_unread_msg(user_id)
-    
-
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
     Handles WebSocket connections and messages for group chat sessions.
 
     Methods:
         connect(): Handles the WebSocket connection initiation.
+        reject(error_message, code): Sends an error to the client and closes the connection.
         disconnect(code): Handles the WebSocket connection termination.
         receive(text_data): Handles incoming WebSocket messages.
+        handle_frame(data): Handles a decoded room frame of the client.
+        read_messages(msg_ids, legacy): Applies a batch of read receipts and notifies the room once.
+        publish_read(store, handler, frame): Sequences, stores and broadcasts a read event of the user.
+        replay(last_seq): Sends the room events the client missed after a sequence number.
+        send_room_event(event): Sends a sequenced room event and keeps it for replays.
         chat_message(event): Sends a message to the WebSocket group chat.
         msg_as_read(event): Sends a message indicating a specific message has been read.
+        read_until(event): Sends the read watermark a participant has moved to.
         all_msg_read(event): Sends a message indicating all messages have been read.
         user_is_typing(event): Sends a message indicating a user is typing.
         user_not_typing(event): Sends a message indicating a user has stopped typing.
-        save_text_message(msg_id, message): Asynchronously saves a text message to the database.
-        msg_read(msg_id): Asynchronously marks a message as read in the database.
-        read_all_msg(room_id, user): Asynchronously marks all messages in a room as read.
+        save_text_message(msg_id, message, created_at, seq): Asynchronously saves a text message to the database.
+        newest_read(msg_ids): Asynchronously resolves the newest message of a batch of read receipts.
+        advance_read(read_until, seq): Asynchronously moves the read watermark of the user.
+        read_all_msg(seq): Asynchronously marks all messages of the room as read by the user.
+
+    Every frame broadcast to the room is encoded once by the sender, with the `CHAT_WIRE_ENCODER`
+    encoder and with msgpack, and travels pre-encoded in the channel layer event; the handlers
+    forward the encoding matching the protocol negotiated by `WireProtocolMixin` untouched.
     """
 
     async def connect(self):
@@ -300,35 +378,62 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Handles the initiation of a WebSocket connection.
 
         This method is invoked when a client attempts to establish a WebSocket connection.
-        It extracts the room name from the URL route parameters and sets up the room group
-        name accordingly. The user associated with the connection is also determined from
-        the scope. The method then adds the channel to the corresponding room group. If the
-        user is authenticated, the connection is accepted; otherwise, an error message is sent
-        to the client, and the connection is closed with a specified error code.
+        It extracts the room name from the URL route parameters and determines the user
+        associated with the connection from the scope. The participants of the chat session
+        are resolved once, from the process-wide participant cache when possible, and kept
+        for the lifetime of the connection. If the user is not authenticated or is not a
+        participant of the chat session, an error message is sent to the client and the
+        connection is closed with a specified error code before the channel joins the room
+        group. Otherwise the channel is added to the room group and the connection is accepted.
+        A reconnecting client passes the sequence number of the last room event it has seen as
+        the `last_seq` query parameter and gets the events it missed replayed.
 
         Raises:
             WebSocketError: If an error occurs during WebSocket connection handling.
 
         """
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = self.room_name
+        self.room_group_name = None
         self.user = self.scope['user']
 
+        if not self.user.is_authenticated:
+            await self.reject(MESSAGE_ERROR_TYPE["UN_AUTHENTICATED"], 4001)
+            return
+
+        self.participants = await room_participants(self.room_name, self.user.id)
+        if self.participants is None:
+            await self.reject(MESSAGE_ERROR_TYPE["UN_AUTHORIZED"], 4003)
+            return
+
+        self.room_group_name = self.room_name
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        await self.accept(self.select_protocol())
 
-        if self.scope["user"].is_authenticated:
-            await self.accept()
-        else:
-            await self.accept()
-            await self.send(text_data=json.dumps({
-                "msg_type": MESSAGE_TYPE['ERROR_OCCURED'],
-                "error_message": MESSAGE_ERROR_TYPE["UN_AUTHENTICATED"],
-                "user": self.user.username,
-            }))
-            await self.close(code=4001)
+        last_seq = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seq', [''])[0]
+        if last_seq.isdigit():
+            await self.replay(int(last_seq))
+
+    async def reject(self, error_message, code):
+        """
+        Rejects a connection that must not join the room.
+
+        The connection is accepted only to deliver the error message to the client, then closed.
+
+        Args:
+            error_message (str): The error type sent to the client.
+            code (int): The WebSocket close code.
+
+        """
+        await self.accept(self.select_protocol())
+        await self.send_frame({
+            "msg_type": MESSAGE_TYPE['ERROR_OCCURED'],
+            "error_message": error_message,
+            "user": self.user.username,
+        })
+        await self.close(code=code)
 
     async def disconnect(self, code):
         """
@@ -336,7 +441,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         This method is invoked when a WebSocket connection is closed, either by the client
         or due to an error. It removes the channel from the associated room group, effectively
-        unsubscribing the client from further messages in the group.
+        unsubscribing the client from further messages in the group, and ends the typing state
+        of the user in the room.
 
         Args:
             code (int): The close code associated with the disconnection.
@@ -345,35 +451,61 @@ class ChatConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs during WebSocket disconnection handling.
 
         """
+        if self.room_group_name is None:
+            return
+        await typing_tracker.disconnect(self.room_group_name, self.user.username)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Handles incoming WebSocket messages.
 
-        This method is invoked when the WebSocket consumer receives a message from the client.
-        It processes the received message, extracts the message type, message content, and user
-        information. Depending on the message type, it performs different actions:
+        This method is invoked when the WebSocket consumer receives a message from the client,
+        as JSON text or, on binary connections, as msgpack. The decoded message is handed to
+        `handle_frame`.
+
+        Args:
+            text_data (str): The JSON-encoded text data received from the client.
+            bytes_data (bytes): The msgpack-encoded data received from a binary client.
+
+        Raises:
+            WebSocketError: If an error occurs during message processing or handling.
 
-        - For text messages, it verifies the message length, generates a unique message ID, sends
-          the message to the chat group, and updates message counters.
+        """
+        await self.handle_frame(decode_frame(text_data, bytes_data))
+
+    async def handle_frame(self, data):
+        """
+        Handles a decoded room frame of the client.
+
+        It extracts the message type, message content, and user information. Depending on the
+        message type, it performs different actions:
+
+        - For text messages, it verifies the message length, generates a unique message ID and
+          timestamp, sends the message to the chat group, and updates message counters.
         - For message read events, it marks the specified message as read and notifies the chat group.
+        - For batched read receipts, it marks the messages up to the newest of the given IDs as read
+          and notifies the chat group with a single READ_UNTIL event.
         - For all message read events, it marks all messages in the group as read and notifies the group.
         - For typing events, it notifies the group that a user is typing.
         - For not typing events, it notifies the group that a user has stopped typing.
+          Typing events go through the typing tracker, which drops repeated states and
+          broadcasts at most one transition per `CHAT_TYPING['WINDOW']`.
+        - For resume requests, it replays the room events after the given `last_seq`.
 
-        Args:
-            text_data (str): The JSON-encoded text data received from the client.
+        Messages and read events are stamped with the next sequence number of the room, so
+        clients can detect gaps and resume from the last event they have seen. Every frame sent
+        to the room names it in `room`, so a client multiplexing several rooms over one
+        connection can tell them apart.
 
-        Raises:
-            WebSocketError: If an error occurs during message processing or handling.
+        Args:
+            data (dict): The decoded frame.
 
         """
-        data = json.loads(text_data)
         message = data.get('message')
         msg_type = data.get('msg_type')
         user = data.get('user')
@@ -381,68 +513,173 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if msg_type == MESSAGE_TYPE['TEXT_MESSAGE']:
             if len(message) <= MESSAGE_MAX_LENGTH:
                 msg_id = uuid.uuid4()
+                created_at = timezone.now()
+                seq = await room_sequencer.next(self.participants.session_id)
                 await self.channel_layer.group_send(
                     self.room_group_name,
-                    {
-                        'type': 'chat_message',
+                    frame_event('chat_message', {
+                        'msg_type': MESSAGE_TYPE['TEXT_MESSAGE'],
                         'message': message,
                         'user': user,
-                        'msg_id' : str(msg_id)
-                    }
-                )
-                current_user_id = await self.save_text_message(msg_id,message)
-                await self.channel_layer.group_send(
-                    f'personal__{current_user_id}',
-                    {
-                        'type': 'message_counter',
-                        'user_id' : self.user.id,
-                        'current_user_id' : current_user_id
-                    }
+                        'timestampe': created_at.isoformat(),
+                        'msg_id' : str(msg_id),
+                        'seq': seq,
+                        'room': self.room_group_name,
+                    }, seq = seq, room = self.room_group_name)
                 )
+                await self.save_text_message(msg_id,message,created_at,seq)
             else:
-                await self.send(text_data=json.dumps({
+                await self.send_frame({
                     'msg_type': MESSAGE_TYPE['ERROR_OCCURED'],
                     'error_message': MESSAGE_ERROR_TYPE["MESSAGE_OUT_OF_LENGTH"],
                     'message': message,
                     'user': user,
                     'timestampe': str(datetime.now()),
-                }))
+                    'room': self.room_group_name,
+                })
         elif msg_type == MESSAGE_TYPE['MESSAGE_READ']:
-            msg_id = data['msg_id']
-            await self.msg_read(msg_id)
-            await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                    'type': 'msg_as_read',
-                    'msg_id': msg_id,
-                    'user' : user
-                    }
-                )  
+            # A single receipt of older clients, applied as a batch of one
+            if await self.read_messages([data.get('msg_id')], legacy = True) is None:
+                await self.send_frame({
+                    'msg_type': MESSAGE_TYPE['ERROR_OCCURED'],
+                    'error_message': MESSAGE_ERROR_TYPE['INVALID_MESSAGE'],
+                    'msg_id': data.get('msg_id') if isinstance(data.get('msg_id'), str) else None,
+                    'user': self.user.username,
+                    'room': self.room_group_name,
+                })
+        elif msg_type == MESSAGE_TYPE['MESSAGES_READ']:
+            await self.read_messages(data.get('msg_ids'))
         elif msg_type == MESSAGE_TYPE['ALL_MESSAGE_READ']:
-            await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                    'type': 'all_msg_read',
-                    'user' : user,
-                    }
-                )
-            await self.read_all_msg(self.room_name[5:],user)
+            await self.publish_read(self.read_all_msg, 'all_msg_read', {'msg_type': MESSAGE_TYPE['ALL_MESSAGE_READ']})
         elif msg_type == MESSAGE_TYPE['IS_TYPING']:
-            await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                    'type': 'user_is_typing',
-                    'user' : user,
-                    }
-                )
+            await typing_tracker.update(self.room_group_name, self.user.username, True)
         elif msg_type == MESSAGE_TYPE["NOT_TYPING"]:
-            await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                    'type': 'user_not_typing',
-                    'user' : user,
-                    }
-                )
+            await typing_tracker.update(self.room_group_name, self.user.username, False)
+        elif msg_type == MESSAGE_TYPE["RESUME"]:
+            last_seq = data.get('last_seq')
+            if isinstance(last_seq, int) and last_seq >= 0:
+                await self.replay(last_seq)
+
+    async def read_messages(self, msg_ids, legacy = False):
+        """
+        Applies a batch of read receipts sent by the client and notifies the room once.
+
+        Read state is a watermark, so the batch marks every message of the other participant up
+        to the newest of the given messages as read: one lookup of the newest message and one
+        update of the unread counter, however many IDs the batch holds. A client may also send
+        just the newest read message. The room receives a single READ_UNTIL event carrying the
+        new watermark. Invalid IDs are ignored; a batch without any valid message is dropped.
+
+        Args:
+            msg_ids (list): The IDs of the read messages, at most `READ_RECEIPT_MAX_BATCH` of them are used.
+            legacy (bool): Whether the batch is a single MESSAGE_READ receipt, which is announced
+                to the room as a MESSAGE_READ event for clients that do not handle READ_UNTIL.
+
+        Returns:
+            datetime: The new watermark, or None if no message of the batch qualifies.
+
+        """
+        if not isinstance(msg_ids, list):
+            return None
+        valid_ids = []
+        for msg_id in msg_ids[:READ_RECEIPT_MAX_BATCH]:
+            try:
+                valid_ids.append(uuid.UUID(str(msg_id)))
+            except ValueError:
+                continue
+        read_until = await self.newest_read(valid_ids)
+        if read_until is None:
+            return None
+
+        async def advance(seq):
+            await self.advance_read(read_until, seq)
+
+        if legacy:
+            await self.publish_read(advance, 'msg_as_read', {'msg_type': MESSAGE_TYPE['MESSAGE_READ'], 'msg_id': str(valid_ids[0])})
+        else:
+            await self.publish_read(advance, 'read_until', {'msg_type': MESSAGE_TYPE['READ_UNTIL'], 'read_until': read_until.isoformat()})
+        return read_until
+
+    async def publish_read(self, store, handler, frame):
+        """
+        Sequences a read event of the user of this connection, stores it and notifies the room.
+
+        Every read frame ends here, so the read state that changes is always the one of the
+        authenticated user in this chat session, never a user named by the client. The event is
+        broadcast only after it has been stored.
+
+        Args:
+            store (coroutine function): Stores the read event, called with its sequence number.
+            handler (str): The name of the consumer method that delivers the event.
+            frame (dict): The event without the user, sequence number and room.
+
+        """
+        seq = await room_sequencer.next(self.participants.session_id)
+        await store(seq)
+        frame.update({'user': self.user.username, 'seq': seq, 'room': self.room_group_name})
+        await self.channel_layer.group_send(self.room_group_name, frame_event(handler, frame, seq = seq, room = self.room_group_name))
+
+    async def replay(self, last_seq):
+        """
+        Sends the room events the client missed after a sequence number.
+
+        The events are taken from the replay buffer of this process when it holds every event
+        after `last_seq`. Otherwise they are loaded from the database: the messages by their
+        sequence number and the read events as the current read watermark of each participant.
+        If more messages are missing than `CHAT_REPLAY['DATABASE_LIMIT']`, the client is told to
+        resynchronize through the delta sync endpoint instead.
+
+        Args:
+            last_seq (int): The sequence number of the last room event the client has seen.
+
+        """
+        frames = replay_buffer.since(self.participants.session_id, last_seq)
+        if frames is None:
+            limit = getattr(settings, 'CHAT_REPLAY', {}).get('DATABASE_LIMIT', 500)
+            messages, counters, truncated = await database_sync_to_async(stored_events_since)(self.participants.session_id, last_seq, limit)
+            if truncated:
+                await self.send_frame({
+                    'msg_type': MESSAGE_TYPE['RESYNC_REQUIRED'],
+                    'last_seq': last_seq,
+                    'room': self.room_group_name,
+                })
+                return
+            frames = [(msg.seq, {
+                'msg_type': MESSAGE_TYPE['TEXT_MESSAGE'],
+                'message': msg.message_detail.get('msg'),
+                'user': msg.user.username,
+                'timestampe': msg.created_at.isoformat(),
+                'msg_id': str(msg.id),
+                'seq': msg.seq,
+                'room': self.room_group_name,
+            }) for msg in messages]
+            frames += [(counter.last_read_seq, {
+                'msg_type': MESSAGE_TYPE['READ_UNTIL'],
+                'user': counter.user.username,
+                'read_until': counter.last_read_at.isoformat(),
+                'seq': counter.last_read_seq,
+                'room': self.room_group_name,
+            }) for counter in counters if counter.last_read_at is not None]
+            frames.sort(key = lambda frame: frame[0])
+            for seq, frame in frames:
+                await self.send_frame(frame)
+            return
+        for seq, encoded in frames:
+            await self.send_encoded(encoded)
+
+    async def send_room_event(self, event):
+        """
+        Sends a sequenced room event to the WebSocket client and keeps it for replays.
+
+        Both encodings of the event are kept, so the replay serves clients of either protocol.
+
+        Args:
+            event (dict): The channel layer event, carrying the `seq` and the encoded frames of the event.
+
+        """
+        encoded = (event['frame'], event['binary_frame'])
+        replay_buffer.record(self.participants.session_id, event['seq'], encoded)
+        await self.send_encoded(encoded)
 
     # Receive message from room group
     async def chat_message(self, event):
@@ -450,9 +687,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Sends a chat message to the WebSocket client.
 
         This method is invoked when a chat message event is received from the channel layer.
-        It formats the received event data into a JSON message containing the message type,
-        message content, user information, timestamp, and message ID. The formatted message
-        is then sent to the WebSocket client.
+        The event carries the JSON message built by the sender, containing the message type,
+        message content, user information, timestamp, message ID and sequence number. The
+        timestamp is the one stored with the message, not the time of delivery. The message
+        is sent to the WebSocket client as is and kept in the replay buffer.
 
         Args:
             event (dict): The event data received from the channel layer containing information
@@ -462,22 +700,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs while sending the chat message to the client.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['TEXT_MESSAGE'],
-            'message': event['message'],
-            'user': event['user'],
-            'timestampe': str(datetime.now()),
-            'msg_id' : event["msg_id"]
-        }))
+        await self.send_room_event(event)
 
     async def msg_as_read(self,event):
         """
         Sends a message indicating that a specific message has been read to the WebSocket client.
 
         This method is invoked when a message read event is received from the channel layer.
-        It formats the received event data into a JSON message containing the message type,
+        The event carries the JSON message built by the sender, containing the message type,
         message ID, and user information indicating that the specified message has been read.
-        The formatted message is then sent to the WebSocket client.
+        The message is sent to the WebSocket client as is and kept in the replay buffer.
 
         Args:
             event (dict): The event data received from the channel layer containing information
@@ -487,20 +719,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs while sending the message read notification to the client.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['MESSAGE_READ'],
-            'msg_id': event['msg_id'],
-            'user' : event['user']
-        }))
+        await self.send_room_event(event)
+
+    async def read_until(self, event):
+        """
+        Sends the read watermark a participant has moved to, after a batch of read receipts.
+
+        The event carries the JSON message built by the sender, containing the message type, the
+        reader and the timestamp up to which the reader has read the chat session. The message
+        is sent to the WebSocket client as is and kept in the replay buffer.
+
+        Args:
+            event (dict): The event data received from the channel layer.
+
+        """
+        await self.send_room_event(event)
 
     async def all_msg_read(self,event):
         """
         Sends a message indicating that all messages in a chat room have been read to the WebSocket client.
 
         This method is invoked when an all message read event is received from the channel layer.
-        It formats the received event data into a JSON message containing the message type and
+        The event carries the JSON message built by the sender, containing the message type and
         user information indicating that all messages in the chat room have been read.
-        The formatted message is then sent to the WebSocket client.
+        The message is sent to the WebSocket client as is and kept in the replay buffer.
 
         Args:
             event (dict): The event data received from the channel layer containing information
@@ -510,19 +752,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs while sending the all message read notification to the client.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['ALL_MESSAGE_READ'],
-            'user' : event['user']
-        }))
+        await self.send_room_event(event)
 
     async def user_is_typing(self,event):
         """
         Sends a message indicating that a user is typing to the WebSocket client.
 
         This method is invoked when a user typing event is received from the channel layer.
-        It formats the received event data into a JSON message containing the message type
+        The event carries the JSON message built by the sender, containing the message type
         and user information indicating that the specified user is currently typing.
-        The formatted message is then sent to the WebSocket client.
+        The message is sent to the WebSocket client as is.
 
         Args:
             event (dict): The event data received from the channel layer containing information
@@ -532,19 +771,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs while sending the user typing notification to the client.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['IS_TYPING'],
-            'user' : event['user']
-        }))
+        await self.forward_frame(event)
 
     async def user_not_typing(self,event):
         """
         Sends a message indicating that a user has stopped typing to the WebSocket client.
 
         This method is invoked when a user not typing event is received from the channel layer.
-        It formats the received event data into a JSON message containing the message type
+        The event carries the JSON message built by the sender, containing the message type
         and user information indicating that the specified user has stopped typing.
-        The formatted message is then sent to the WebSocket client.
+        The message is sent to the WebSocket client as is.
 
         Args:
             event (dict): The event data received from the channel layer containing information
@@ -554,86 +790,312 @@ class ChatConsumer(AsyncWebsocketConsumer):
             WebSocketError: If an error occurs while sending the user not typing notification to the client.
 
         """
-        await self.send(text_data=json.dumps({
-            'msg_type': MESSAGE_TYPE['NOT_TYPING'],
-            'user' : event['user']
-        }))
+        await self.forward_frame(event)
 
-    @database_sync_to_async
-    def save_text_message(self,msg_id,message):
+    async def save_text_message(self,msg_id,message,created_at,seq):
         """
         Saves a text message to the database and updates message details.
 
-        This method creates a new chat message instance with the provided message ID
-        and saves it to the database. The message details include the message content,
-        read status, timestamp, and user-specific read status. The method determines
-        the appropriate user IDs based on the chat session associated with the WebSocket
-        connection.
+        This method creates a new chat message instance with the provided message ID.
+        The message details include the message content and user-specific read status;
+        the timestamp is stored in its own column. The participants of the chat session
+        were resolved when the connection was admitted, so no chat session lookup is
+        needed. When the write-behind queue is enabled the message is handed to it and
+        inserted with the next batch, otherwise it is inserted right away. In both cases
+        the unread counter of the recipient is incremented together with the insert, and
+        the new counts are handed to the unread pusher, which updates the personal room of
+        the recipient.
 
         Args:
             msg_id (str): The unique ID of the message to be saved.
             message (str): The content of the message to be saved.
+            created_at (datetime): The timestamp the message was sent to the room with.
+            seq (int): The sequence number of the message in the room.
 
         Returns:
             int: The user ID of the recipient of the message.
 
         Raises:
-            ChatSession.DoesNotExist: If the associated chat session does not exist.
-            ChatMessage.DoesNotExist: If the associated chat message does not exist.
             IntegrityError: If there is an integrity constraint violation when creating
                             the chat message instance.
 
         """
-        session_id = self.room_name[5:]
-        session_inst = ChatSession.objects.select_related('user1', 'user2').get(id=session_id)
         message_json = {
             "msg": message,
-            "read": False,
-            "timestamp": str(datetime.now()),
-            session_inst.user1.username: False,
-            session_inst.user2.username: False
+            self.participants.user1_name: False,
+            self.participants.user2_name: False
         }
-        ChatMessage.objects.create(id = msg_id,chat_session=session_inst, user=self.user, message_detail=message_json)
-        return session_inst.user2.id if self.user == session_inst.user1 else session_inst.user1.id
-    
+        chat_message = ChatMessage(id = msg_id,chat_session_id=self.participants.session_id, user=self.user, message_detail=message_json, created_at=created_at, seq=seq)
+        recipient_id = self.participants.other_id(self.user.id)
+        if message_writer.enabled:
+            await message_writer.submit(chat_message, recipient_id)
+        else:
+            unread_pusher.publish(await database_sync_to_async(ChatMessage.persist_messages)([(chat_message, recipient_id)]))
+        return recipient_id
+
     @database_sync_to_async
-    def msg_read(self,msg_id):
+    def newest_read(self, msg_ids):
         """
-        Marks a message as read in the database.
-
-        This method updates the read status of the specified message in the database
-        to indicate that it has been read by the recipient user.
+        Resolves the newest message of a batch of read receipts.
 
         Args:
-            msg_id (str): The unique ID of the message to be marked as read.
+            msg_ids (list): The IDs of the read messages.
 
         Returns:
-            None
+            datetime: The timestamp of the newest message of the other participant in the batch, or None.
 
-        Raises:
-            ChatMessage.DoesNotExist: If the specified message does not exist.
+        """
+        return ChatMessage.newest_read(self.participants.session_id, self.user.id, msg_ids)
 
+    @database_sync_to_async
+    def advance_read(self, read_until, seq):
         """
-        return ChatMessage.meassage_read_true(msg_id)
+        Moves the read watermark of the user in this chat session forward.
+
+        Args:
+            read_until (datetime): The timestamp up to which the user has read the chat session.
+            seq (int): The sequence number of the read event.
+
+        Returns:
+            bool: True if the watermark moved.
+
+        """
+        return UnreadCounter.advance_watermark(self.participants.session_id, self.user.id, read_until, seq = seq)
 
     @database_sync_to_async
-    def read_all_msg(self,room_id,user):
+    def read_all_msg(self,seq):
         """
-        Marks all messages in a chat room as read in the database.
+        Marks all messages of this chat session as read by the user of this connection in the database.
 
-        This method updates the read status of all messages in the specified chat room
-        to indicate that they have been read by the recipient user.
+        The reader is always the authenticated user, never a name sent by the client.
 
         Args:
-            room_id (str): The ID of the chat room whose messages are to be marked as read.
-            user (str): The username of the recipient user.
+            seq (int): The sequence number of the read event.
 
         Returns:
             None
 
-        Raises:
-            ChatSession.DoesNotExist: If the specified chat session does not exist.
-            ChatMessage.DoesNotExist: If any of the associated chat messages do not exist.
+        """
+        return ChatMessage.all_msg_read(self.participants.session_id, self.user.id, seq)
+
+class RoomSubscription(ChatConsumer):
+    """
+    A chat room subscribed over the connection of a `ClientConsumer`.
+
+    It handles the room frames of the client and the room events of the channel layer exactly
+    like a `ChatConsumer`, but has no socket of its own: it shares the user, the channel and the
+    negotiated protocol of the client connection and sends through it.
+
+    Attributes:
+        client (ClientConsumer): The connection the room is subscribed over.
+
+    Methods:
+        send(text_data, bytes_data, close): Sends a frame over the client connection.
+    """
+
+    def __init__(self, client, room_name, participants):
+        super().__init__()
+        self.client = client
+        self.user = client.user
+        self.channel_layer = client.channel_layer
+        self.channel_name = client.channel_name
+        self.room_name = self.room_group_name = room_name
+        self.participants = participants
+
+    @property
+    def binary(self):
+        """
+        bool: Whether the client connection uses the binary protocol.
+        """
+        return self.client.binary
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """
+        Sends a frame over the client connection.
+
+        Args:
+            text_data (str): The JSON frame.
+            bytes_data (bytes): The msgpack frame.
+            close (bool): Whether to close the client connection afterwards.
+
+        """
+        await self.client.send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+
+class ClientConsumer(PersonalConsumer):
+    """
+    Handles the single multiplexed WebSocket connection of a client.
+
+    The connection carries what the personal connection carries, the presence of the user and
+    the unread counters, plus any number of chat rooms. The client subscribes to a room with a
+    SUBSCRIBE frame naming it in `room`, optionally with the `last_seq` it has seen to get the
+    events it missed replayed, and leaves it with an UNSUBSCRIBE frame; both are confirmed with
+    a SUBSCRIBED or UNSUBSCRIBED frame. Switching conversations therefore costs two frames
+    instead of a new connection and its authentication.
+
+    Frames of the client naming a subscribed room in `room` are handled by the
+    `RoomSubscription` of the room, frames without a room are presence frames. Every frame sent
+    for a room names it in `room` as well. Frames for rooms that are not subscribed, e.g. sent
+    while an UNSUBSCRIBE was in flight, are dropped.
+
+    Attributes:
+        rooms (dict): The `RoomSubscription` of every subscribed room, by room name.
+
+    Methods:
+        connect(): Admits an authenticated user and marks the connection as present.
+        disconnect(code): Leaves every subscribed room and marks the connection as gone.
+        handle_frame(data): Handles a decoded frame of the client.
+        subscribe(room_name, last_seq): Subscribes the connection to a chat room.
+        unsubscribe(room_name): Unsubscribes the connection from a chat room.
+        leave(room): Removes the channel from a room group and ends the typing state of the user there.
+        room_event(event): Hands a room event of the channel layer to the subscription of its room.
+    """
+
+    async def connect(self):
+        """
+        Admits an authenticated user and marks the connection as present.
+
+        The channel joins the personal room of the user, which carries the presence of the
+        friends and the unread counters. Unauthenticated connections are closed with 4001.
+
+        """
+        self.rooms = {}
+        self.room_group_name = None
+        self.user = self.scope['user']
+
+        if not self.user.is_authenticated:
+            await self.close(code=4001)
+            return
+
+        self.room_name = str(self.user.id)
+        self.room_group_name = f'personal__{self.room_name}'
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        await self.accept(self.select_protocol())
+        await self.set_online()
+
+    async def disconnect(self, code):
+        """
+        Leaves every subscribed room and marks the connection as gone.
+
+        Args:
+            code (int): The status code indicating the reason for disconnection.
+
+        """
+        for room in list(self.rooms.values()):
+            await self.leave(room)
+        self.rooms.clear()
+        await super().disconnect(code)
+
+    async def handle_frame(self, data):
+        """
+        Handles a decoded frame of the client.
+
+        Frames naming their room with anything but a string are answered with an INVALID_MESSAGE
+        error instead of being looked up.
+
+        Args:
+            data (dict): The decoded frame.
+
+        """
+        msg_type = data.get('msg_type')
+        room_name = data.get('room')
+        if room_name is not None and not isinstance(room_name, str):
+            await self.send_frame({
+                'msg_type': MESSAGE_TYPE['ERROR_OCCURED'],
+                'error_message': MESSAGE_ERROR_TYPE['INVALID_MESSAGE'],
+                'user': self.user.username,
+            })
+        elif msg_type == MESSAGE_TYPE['SUBSCRIBE']:
+            await self.subscribe(room_name, data.get('last_seq'))
+        elif msg_type == MESSAGE_TYPE['UNSUBSCRIBE']:
+            await self.unsubscribe(room_name)
+        elif room_name is None:
+            await super().handle_frame(data)
+        elif room_name in self.rooms:
+            await self.rooms[room_name].handle_frame(data)
+
+    async def subscribe(self, room_name, last_seq = None):
+        """
+        Subscribes the connection to a chat room.
+
+        The user must be a participant of the chat session, otherwise an UN_AUTHORIZED error
+        naming the room is sent and the connection stays open. Subscribing to a room that is
+        already subscribed only replays the missed events.
+
+        Args:
+            room_name (str): The room name, `chat_<session id>`.
+            last_seq (int): The sequence number of the last room event the client has seen, if any.
+
+        """
+        room = self.rooms.get(room_name) if isinstance(room_name, str) else None
+        if room is None:
+            participants = await room_participants(room_name, self.user.id) if isinstance(room_name, str) else None
+            if participants is None:
+                await self.send_frame({
+                    'msg_type': MESSAGE_TYPE['ERROR_OCCURED'],
+                    'error_message': MESSAGE_ERROR_TYPE['UN_AUTHORIZED'],
+                    'user': self.user.username,
+                    'room': room_name,
+                })
+                return
+            room = self.rooms[room_name] = RoomSubscription(self, room_name, participants)
+            await self.channel_layer.group_add(
+                room_name,
+                self.channel_name
+            )
+        await self.send_frame({
+            'msg_type': MESSAGE_TYPE['SUBSCRIBED'],
+            'room': room_name,
+        })
+        if isinstance(last_seq, int) and last_seq >= 0:
+            await room.replay(last_seq)
+
+    async def unsubscribe(self, room_name):
+        """
+        Unsubscribes the connection from a chat room.
+
+        Args:
+            room_name (str): The room name.
 
         """
-        return ChatMessage.all_msg_read(room_id,user)
\ No newline at end of file
+        room = self.rooms.pop(room_name, None) if isinstance(room_name, str) else None
+        if room is None:
+            return
+        await self.leave(room)
+        await self.send_frame({
+            'msg_type': MESSAGE_TYPE['UNSUBSCRIBED'],
+            'room': room_name,
+        })
+
+    async def leave(self, room):
+        """
+        Removes the channel from a room group and ends the typing state of the user there.
+
+        Args:
+            room (RoomSubscription): The subscription of the room.
+
+        """
+        await typing_tracker.disconnect(room.room_group_name, self.user.username)
+        await self.channel_layer.group_discard(
+            room.room_group_name,
+            self.channel_name
+        )
+
+    async def room_event(self, event):
+        """
+        Hands a room event of the channel layer to the subscription of its room.
+
+        Events of rooms unsubscribed while they were queued are dropped.
+
+        Args:
+            event (dict): The channel layer event, naming its room in `room`.
+
+        """
+        room = self.rooms.get(event.get('room'))
+        if room is not None:
+            await getattr(room, event['type'])(event)
+
+    chat_message = msg_as_read = read_until = all_msg_read = user_is_typing = user_not_typing = room_event
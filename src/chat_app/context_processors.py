@@ -0,0 +1,19 @@
+from django.conf import settings
+from .wire import MSGPACK_QUERY_VALUE
+
+
+def wire_protocol(request):
+    """
+    Tells the templates which WebSocket protocol the page asks for.
+
+    JSON is the default. The binary msgpack protocol is asked for when `CHAT_WIRE_BINARY` is
+    enabled or the page was opened with the `protocol=msgpack` query parameter, which the
+    WebSocket endpoints accept as well.
+
+    Args:
+        request (HttpRequest): The request rendering the template.
+
+    Returns:
+        dict: `wire_binary`, True if the page uses the binary protocol.
+    """
+    return {'wire_binary': getattr(settings, 'CHAT_WIRE_BINARY', False) or request.GET.get('protocol') == MSGPACK_QUERY_VALUE}
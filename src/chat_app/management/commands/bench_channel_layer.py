@@ -0,0 +1,150 @@
+import asyncio
+import shutil
+import socket
+import statistics
+import subprocess
+import time
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from django_channel.channel_layers import CHANNEL_LAYER_BACKENDS, channel_layer_config
+from chat_app.wire import frame_event
+
+
+class RedisServer:
+    """
+    A throwaway redis-server process listening on a free local port, without persistence.
+
+    Attributes:
+        url (str): The URL of the server once started.
+    """
+
+    def __init__(self, executable):
+        self.executable = executable
+        self.url = None
+        self._process = None
+
+    def __enter__(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        self._process = subprocess.Popen(
+            [self.executable, '--port', str(port), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no'],
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout = 0.1).close()
+                break
+            except OSError:
+                if self._process.poll() is not None:
+                    raise CommandError(f'{self.executable} exited with code {self._process.returncode}')
+                time.sleep(0.05)
+        else:
+            self.__exit__()
+            raise CommandError(f'{self.executable} did not start listening on port {port}')
+        self.url = f'redis://127.0.0.1:{port}/0'
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait(10)
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks `group_send` fan-out throughput and latency of the channel layers.
+
+    Unless `--redis-url` points to a running server, a redis-server (or a compatible server given
+    with `--redis-server`) is spawned on a free local port for the duration of the benchmark.
+    For every layer, group kind and receiver count, a `chat_<id>` or `personal__<id>` group with
+    that many channels is created and `--messages` chat message events are sent to it one after
+    the other while every channel receives concurrently. The command reports the sends and the
+    deliveries per second and the send-to-receive latency percentiles of the deliveries.
+    """
+    help = 'Benchmarks group_send fan-out throughput and latency of the in-process and Redis channel layers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layers', nargs='+', default=list(CHANNEL_LAYER_BACKENDS), choices=list(CHANNEL_LAYER_BACKENDS), help='Channel layers to benchmark.')
+        parser.add_argument('--receivers', type=int, nargs='+', default=[2, 10, 50], help='Channels per group to benchmark.')
+        parser.add_argument('--messages', type=int, default=500, help='Events sent per layer, group and receiver count.')
+        parser.add_argument('--redis-url', help='URL of a running Redis server to use instead of spawning one.')
+        parser.add_argument('--redis-server', default='redis-server', help='Executable of the Redis compatible server to spawn.')
+
+    def handle(self, *args, **options):
+        """
+        Runs the benchmark for every layer, group kind and receiver count and prints one result row each.
+        """
+        redis_layers = [layer for layer in options['layers'] if layer.startswith('redis')]
+        if redis_layers and not options['redis_url'] and not shutil.which(options['redis_server']):
+            raise CommandError(f"{options['redis_server']} was not found; install Redis, pass --redis-server or --redis-url, or benchmark --layers local memory only.")
+        self.stdout.write(f"{'layer':>13} {'group':>16} {'receivers':>9} {'sends/s':>9} {'deliveries/s':>13} {'p50 ms':>8} {'p99 ms':>8}")
+        if options['redis_url'] or not redis_layers:
+            self.run_layers(options, options['redis_url'])
+        else:
+            with RedisServer(options['redis_server']) as server:
+                self.run_layers(options, server.url)
+
+    def run_layers(self, options, redis_url):
+        """
+        Runs the benchmark of every requested layer.
+
+        Args:
+            options (dict): The command options.
+            redis_url (str): The URL of the Redis server, or None if only in-process layers are benchmarked.
+        """
+        for layer_name in options['layers']:
+            config = channel_layer_config(layer_name, [redis_url], max(options['messages'], settings.CHANNEL_CAPACITY))
+            for group in ('chat_1', 'personal__1'):
+                for receivers in options['receivers']:
+                    layer = import_string(config['BACKEND'])(**config['CONFIG'])
+                    sends, deliveries, latencies = async_to_sync(self.fan_out)(layer, group, receivers, options['messages'])
+                    latencies.sort()
+                    p50 = statistics.median(latencies) * 1000
+                    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+                    self.stdout.write(f'{layer_name:>13} {group:>16} {receivers:>9} {sends:>9.0f} {deliveries:>13.0f} {p50:>8.2f} {p99:>8.2f}')
+
+    async def fan_out(self, layer, group, receivers, messages):
+        """
+        Sends the events to a group of the given size and waits until every channel received them.
+
+        Args:
+            layer (BaseChannelLayer): The channel layer.
+            group (str): The group name.
+            receivers (int): The number of channels in the group.
+            messages (int): The number of events to send.
+
+        Returns:
+            tuple: The sends per second, the deliveries per second and the latency of every delivery in seconds.
+        """
+        channels = [await layer.new_channel() for _ in range(receivers)]
+        for channel_name in channels:
+            await layer.group_add(group, channel_name)
+        latencies = []
+
+        async def receive(channel_name):
+            for _ in range(messages):
+                event = await layer.receive(channel_name)
+                latencies.append(time.perf_counter() - event['sent_at'])
+
+        receiving = [asyncio.ensure_future(receive(channel_name)) for channel_name in channels]
+        frame = {'msg_type': 'TEXT_MESSAGE', 'message': 'x' * 100, 'user': 'bench', 'timestampe': '2024-01-01T00:00:00+00:00', 'msg_id': '00000000-0000-0000-0000-000000000000'}
+        start = time.perf_counter()
+        for seq in range(1, messages + 1):
+            await layer.group_send(group, frame_event('chat_message', dict(frame, seq = seq), seq = seq, sent_at = time.perf_counter()))
+        sent = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.gather(*receiving), timeout = 60)
+        finally:
+            for task in receiving:
+                task.cancel()
+            for channel_name in channels:
+                await layer.group_discard(group, channel_name)
+            if hasattr(layer, 'flush'):
+                await layer.flush()
+        done = time.perf_counter()
+        return messages / (sent - start), messages * receivers / (done - start), latencies
@@ -0,0 +1,174 @@
+import json
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat_app.cache import SessionParticipants
+from chat_app.consumers import ChatConsumer, MESSAGE_TYPE
+from chat_app.replay import ReplayBuffer
+from chat_app.wire import frame_event, load_encoder
+from chat_app import consumers, wire
+
+
+class BenchConsumer(ChatConsumer):
+    """
+    A chat consumer whose socket only counts the bytes it is given.
+    """
+
+    def __init__(self, session_id):
+        super().__init__()
+        self.participants = SessionParticipants(session_id, 1, 'bench_1', 2, 'bench_2')
+        self.sent_bytes = 0
+
+    async def send(self, text_data = None, bytes_data = None, close = False):
+        self.sent_bytes += len(text_data or bytes_data)
+
+    async def legacy_chat_message(self, event):
+        """
+        Handles a chat message event the way `ChatConsumer.chat_message` did before frames were
+        encoded by the sender: the frame is built and JSON encoded for every recipient.
+        """
+        frame = json.dumps({
+            'msg_type': MESSAGE_TYPE['TEXT_MESSAGE'],
+            'message': event['message'],
+            'user': event['user'],
+            'timestampe': event['timestamp'],
+            'msg_id' : event["msg_id"],
+            'seq': event['seq'],
+        })
+        consumers.replay_buffer.record(self.participants.session_id, event['seq'], frame)
+        await self.send(text_data=frame)
+
+
+def legacy_event(message, seq):
+    """
+    Builds the chat message event sent before frames were encoded by the sender.
+
+    Args:
+        message (str): The text of the message.
+        seq (int): The sequence number of the message.
+
+    Returns:
+        dict: The channel layer event.
+    """
+    return {
+        'type': 'legacy_chat_message',
+        'message': message,
+        'user': 'bench_1',
+        'msg_id': str(uuid.uuid4()),
+        'timestamp': timezone.now().isoformat(),
+        'seq': seq,
+    }
+
+
+def encoded_event(message, seq):
+    """
+    Builds the chat message event with the frame encoded once by the sender.
+
+    Args:
+        message (str): The text of the message.
+        seq (int): The sequence number of the message.
+
+    Returns:
+        dict: The channel layer event.
+    """
+    return frame_event('chat_message', {
+        'msg_type': MESSAGE_TYPE['TEXT_MESSAGE'],
+        'message': message,
+        'user': 'bench_1',
+        'timestampe': timezone.now().isoformat(),
+        'msg_id': str(uuid.uuid4()),
+        'seq': seq,
+    }, seq = seq)
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks the CPU cost of broadcasting a chat message to the sockets of a room.
+
+    For every requested receiver count a room group with that many channels is created on an
+    in-memory channel layer. Every message is sent to the group once and then received and
+    handled by a chat consumer per channel, whose socket only counts bytes. The CPU time is
+    measured with `time.process_time` for the previous per-recipient encoding and for frames
+    encoded once by the sender with each requested encoder, split into the channel layer part
+    (building the event, `group_send` and receiving it on every channel) and the handler part.
+    """
+    help = 'Benchmarks the fan-out CPU per message to 2, 50 and 500 receivers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--receivers', type=int, nargs='+', default=[2, 50, 500], help='Receiver counts to benchmark.')
+        parser.add_argument('--messages', type=int, default=200, help='Messages broadcast per receiver count and strategy.')
+        parser.add_argument('--encoders', nargs='+', default=['json', 'orjson', 'ujson'], help='CHAT_WIRE_ENCODER values to benchmark.')
+        parser.add_argument('--text', default='x' * 200, help='Text of the broadcast messages.')
+
+    def handle(self, *args, **options):
+        """
+        Runs the benchmark for every receiver count and prints one result row per strategy.
+        """
+        self.stdout.write(f"{'receivers':>9} {'strategy':>9} {'layer us/msg':>13} {'handler us/msg':>15} {'us/recipient':>13} {'bytes sent':>11}")
+        original_encoder = wire.encode_frame
+        original_buffer = consumers.replay_buffer
+        try:
+            for receivers in options['receivers']:
+                consumers.replay_buffer = ReplayBuffer()
+                self.report(receivers, 'legacy', legacy_event, options)
+                for encoder in options['encoders']:
+                    try:
+                        wire.encode_frame = load_encoder(encoder)
+                    except Exception as error:
+                        self.stderr.write(str(error))
+                        continue
+                    consumers.replay_buffer = ReplayBuffer()
+                    self.report(receivers, encoder, encoded_event, options)
+        finally:
+            wire.encode_frame = original_encoder
+            consumers.replay_buffer = original_buffer
+
+    def report(self, receivers, strategy, build_event, options):
+        """
+        Broadcasts the messages with one strategy and writes its result row.
+
+        Args:
+            receivers (int): The number of sockets in the room.
+            strategy (str): The name of the strategy.
+            build_event (callable): Builds the channel layer event of a message and its sequence number.
+            options (dict): The command options.
+        """
+        layer_seconds, handler_seconds, sent_bytes = async_to_sync(self.fan_out)(receivers, build_event, options['messages'], options['text'])
+        layer_us, handler_us = (seconds / options['messages'] * 1e6 for seconds in (layer_seconds, handler_seconds))
+        self.stdout.write(f'{receivers:>9} {strategy:>9} {layer_us:>13.1f} {handler_us:>15.1f} {(layer_us + handler_us) / receivers:>13.2f} {sent_bytes:>11}')
+
+    async def fan_out(self, receivers, build_event, messages, text):
+        """
+        Broadcasts the messages to a room of the given size.
+
+        Args:
+            receivers (int): The number of sockets in the room.
+            build_event (callable): Builds the channel layer event of a message and its sequence number.
+            messages (int): The number of messages to broadcast.
+            text (str): The text of the messages.
+
+        Returns:
+            tuple: The CPU seconds spent in the channel layer and in the handlers, and the number
+            of bytes sent to the sockets.
+        """
+        channel_layer = InMemoryChannelLayer(capacity = messages + 1)
+        group = 'chat_bench'
+        members = []
+        for _ in range(receivers):
+            channel_name = await channel_layer.new_channel()
+            await channel_layer.group_add(group, channel_name)
+            members.append((channel_name, BenchConsumer(0)))
+        layer_seconds = handler_seconds = 0
+        for seq in range(1, messages + 1):
+            start = time.process_time()
+            await channel_layer.group_send(group, build_event(text, seq))
+            events = [await channel_layer.receive(channel_name) for channel_name, consumer in members]
+            handling = time.process_time()
+            for (channel_name, consumer), event in zip(members, events):
+                await getattr(consumer, event['type'])(event)
+            layer_seconds += handling - start
+            handler_seconds += time.process_time() - handling
+        return layer_seconds, handler_seconds, sum(consumer.sent_bytes for channel_name, consumer in members)
@@ -0,0 +1,109 @@
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from chat_app.cache import get_friend_ids, invalidate_friend_ids
+from chat_app.models import ChatSession
+from chat_app.wire import frame_event
+
+
+def legacy_friend_ids(user):
+    """
+    Resolves the chat partners of a user the way `PersonalConsumer` did before the friend index.
+
+    Args:
+        user (User): The user going online or offline.
+
+    Returns:
+        list: The IDs of the chat partners.
+    """
+    user_all_friends = ChatSession.objects.filter(Q(user1 = user) | Q(user2 = user))
+    user_id = []
+    for ch_session in user_all_friends:
+        user_id.append(ch_session.user2.id) if user.username == ch_session.user1.username else user_id.append(ch_session.user1.id)
+    return user_id
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks the cost of an online/offline transition for users with many chat sessions.
+
+    For every requested session count a user with that many chat partners is created inside a
+    transaction that is rolled back afterwards. The command then measures, for the previous N+1
+    lookup, a cold friend index and a warm friend index, the number of queries and the time
+    needed to resolve the chat partners, plus the time of the `group_send` fan-out to their
+    personal rooms on the configured channel layer.
+    """
+    help = 'Benchmarks presence transitions for users with 10, 1,000 and 10,000 chat sessions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, nargs='+', default=[10, 1000, 10000], help='Chat session counts to benchmark.')
+        parser.add_argument('--repeat', type=int, default=5, help='Warm index transitions measured per session count.')
+
+    def handle(self, *args, **options):
+        """
+        Runs the benchmark for every session count and prints one result row per strategy.
+        """
+        self.stdout.write(f"{'sessions':>9} {'strategy':>10} {'queries':>8} {'lookup ms':>10} {'fan-out ms':>11}")
+        for sessions in options['sessions']:
+            with transaction.atomic():
+                user = self.create_user_with_sessions(sessions)
+                self.report(sessions, 'legacy', lambda: legacy_friend_ids(user))
+                invalidate_friend_ids(user.id)
+                self.report(sessions, 'cold', lambda: get_friend_ids(user.id))
+                for _ in range(options['repeat']):
+                    self.report(sessions, 'warm', lambda: get_friend_ids(user.id))
+                invalidate_friend_ids(user.id)
+                transaction.set_rollback(True)
+
+    def create_user_with_sessions(self, sessions):
+        """
+        Creates a user with the given number of chat sessions.
+
+        Args:
+            sessions (int): The number of chat partners to create.
+
+        Returns:
+            User: The user owning the chat sessions.
+        """
+        prefix = f'bench_presence_{sessions}_'
+        user = User.objects.create(username = f'{prefix}owner')
+        User.objects.bulk_create([User(username = f'{prefix}{i}') for i in range(sessions)], batch_size = 1000)
+        friends = User.objects.filter(username__startswith = prefix).exclude(id = user.id)
+        ChatSession.objects.bulk_create([ChatSession(user1 = user, user2 = friend, pair_key = ChatSession.make_pair_key(user.id, friend.id)) for friend in friends], batch_size = 1000)
+        return user
+
+    def report(self, sessions, strategy, resolve):
+        """
+        Measures one transition and writes its result row.
+
+        Args:
+            sessions (int): The number of chat sessions of the user.
+            strategy (str): The name of the lookup strategy.
+            resolve (callable): Returns the IDs of the chat partners.
+        """
+        channel_layer = get_channel_layer()
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            start = time.perf_counter()
+            friend_ids = resolve()
+            lookup_ms = (time.perf_counter() - start) * 1000
+
+        event = frame_event('user_online', {'msg_type': 'WENT_ONLINE', 'user_name': 'bench'})
+
+        async def fan_out():
+            for friend_id in friend_ids:
+                await channel_layer.group_send(f'personal__{friend_id}', event)
+
+        start = time.perf_counter()
+        async_to_sync(fan_out)()
+        fan_out_ms = (time.perf_counter() - start) * 1000
+        self.stdout.write(f'{sessions:>9} {strategy:>10} {len(queries):>8} {lookup_ms:>10.2f} {fan_out_ms:>11.2f}')
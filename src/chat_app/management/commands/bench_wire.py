@@ -0,0 +1,90 @@
+import json
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat_app.wire import encode_binary_frame, decode_frame
+
+
+def legacy_encode(frame):
+    """
+    Encodes a frame the way the consumers did before the wire module: `json.dumps` with its default separators.
+
+    Args:
+        frame (dict): The frame.
+
+    Returns:
+        str: The encoded frame.
+    """
+    return json.dumps(frame)
+
+
+def sample_frames():
+    """
+    Returns a frame of every kind of room chatter, keyed by a label.
+
+    Returns:
+        dict: The frames.
+    """
+    return {
+        'typing': {'msg_type': 'IS_TYPING', 'user': 'alice'},
+        'not typing': {'msg_type': 'NOT_TYPING', 'user': 'alice'},
+        'read receipt': {'msg_type': 'MESSAGE_READ', 'msg_id': str(uuid.uuid4()), 'user': 'alice', 'seq': 1024},
+        'read all': {'msg_type': 'ALL_MESSAGE_READ', 'user': 'alice', 'seq': 1025},
+        'counter': {'msg_type': 'OVERALL_MESSAGE_COUNTER', 'user_id': 42, 'overall_unread_msg': 7},
+        'text message': {
+            'msg_type': 'TEXT_MESSAGE',
+            'message': 'hello',
+            'user': 'alice',
+            'timestampe': timezone.now().isoformat(),
+            'msg_id': str(uuid.uuid4()),
+            'seq': 1026,
+        },
+    }
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks the size and the encode/decode CPU of WebSocket frames per protocol.
+
+    For every kind of frame the command measures the JSON text protocol and the binary msgpack
+    protocol with integer message type codes: the frame size in bytes and the CPU time of
+    encoding and decoding it, measured with `time.process_time` over `--repeat` iterations.
+    """
+    help = 'Benchmarks the bandwidth and encode/decode cost of the JSON and msgpack WebSocket protocols.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=100000, help='Encodes and decodes measured per frame and protocol.')
+
+    def handle(self, *args, **options):
+        """
+        Runs the benchmark for every frame and prints one result row per protocol.
+        """
+        protocols = {
+            'json': (legacy_encode, lambda data: decode_frame(text_data = data)),
+            'msgpack': (encode_binary_frame, lambda data: decode_frame(bytes_data = data)),
+        }
+        self.stdout.write(f"{'frame':>13} {'protocol':>9} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+        for label, frame in sample_frames().items():
+            for protocol, (encode, decode) in protocols.items():
+                data = encode(frame)
+                size = len(data.encode() if isinstance(data, str) else data)
+                encode_us = self.measure(lambda: encode(frame), options['repeat'])
+                decode_us = self.measure(lambda: decode(data), options['repeat'])
+                self.stdout.write(f'{label:>13} {protocol:>9} {size:>6} {encode_us:>10.2f} {decode_us:>10.2f}')
+
+    def measure(self, call, repeat):
+        """
+        Measures the CPU time of a call.
+
+        Args:
+            call (callable): The call to measure.
+            repeat (int): The number of calls.
+
+        Returns:
+            float: The CPU microseconds per call.
+        """
+        start = time.process_time()
+        for _ in range(repeat):
+            call()
+        return (time.process_time() - start) / repeat * 1e6
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from chat_app.models import UnreadCounter
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the unread message counters from the stored chat messages.
+
+    The counters are maintained incrementally while messages are sent and read. This command
+    recomputes every `UnreadCounter` row and every `Profile.unread_msg_count` from `ChatMessage`,
+    which is needed after the counters are introduced on an existing database or whenever they
+    are suspected to have drifted.
+    """
+    help = 'Rebuilds the per-session and overall unread message counters from ChatMessage.'
+
+    def handle(self, *args, **options):
+        """
+        Runs the reconciliation and reports the number of counters written.
+        """
+        written = UnreadCounter.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {written} unread counters.'))
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.2 on 2026-10-17 01:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0006_unread_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='read',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,83 @@
+import logging
+from datetime import datetime
+
+from django.db import migrations, models, transaction
+from django.utils import timezone
+
+BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def parse_timestamp(value):
+    """
+    Converts a timestamp stored by `str(datetime.now())` into an aware datetime.
+
+    Args:
+        value (str): The timestamp stored in `message_detail`.
+
+    Returns:
+        datetime: The aware datetime, or None if the value cannot be parsed.
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return timezone.make_aware(datetime.strptime(value, fmt))
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def backfill_message_columns(apps, schema_editor):
+    """
+    Copies the timestamp and read flag of every message from `message_detail` into the native columns.
+
+    Messages are processed in primary key order in batches of `BATCH_SIZE`, each batch in its own
+    transaction. Only rows whose `created_at` is still empty are selected, so an interrupted run
+    resumes where it stopped when the migration is applied again.
+
+    A timestamp that cannot be parsed must not become the current time, which would make the
+    message the newest one of its chat session in the history and in watermark comparisons.
+    Such messages are dated with the oldest parsed timestamp of their chat session instead, or
+    the `updated_on` time of the chat session if none could be parsed, and reported.
+    """
+    ChatMessage = apps.get_model('chat_app', 'ChatMessage')
+    ChatSession = apps.get_model('chat_app', 'ChatSession')
+    last_pk = None
+    while True:
+        with transaction.atomic():
+            batch = ChatMessage.objects.filter(created_at__isnull=True).order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            for msg in batch:
+                msg.created_at = parse_timestamp(msg.message_detail.get('timestamp'))
+                msg.read = bool(msg.message_detail.get('read', False))
+            ChatMessage.objects.bulk_update(batch, ['created_at', 'read'])
+
+    unparsed = ChatMessage.objects.filter(created_at__isnull=True)
+    session_ids = set(unparsed.values_list('chat_session_id', flat=True))
+    if not session_ids:
+        return
+    oldest = dict(ChatMessage.objects.filter(chat_session_id__in=session_ids, created_at__isnull=False).order_by()
+                  .values_list('chat_session_id').annotate(oldest=models.Min('created_at')))
+    updated_on = dict(ChatSession.objects.filter(id__in=session_ids).values_list('id', 'updated_on'))
+    count = 0
+    for session_id in session_ids:
+        count += unparsed.filter(chat_session_id=session_id).update(created_at=oldest.get(session_id) or updated_on[session_id])
+    logger.warning('%d chat messages in %d chat sessions had an unparseable timestamp and were dated with the oldest message of their chat session or its updated_on time.', count, len(session_ids))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chat_app', '0007_message_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_message_columns, migrations.RunPython.noop),
+    ]
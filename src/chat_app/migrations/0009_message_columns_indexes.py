@@ -0,0 +1,31 @@
+# Generated by Django 3.2.2 on 2026-10-17 01:43
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0008_backfill_message_columns'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chatmessage',
+            options={'ordering': ['-created_at']},
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['chat_session', 'created_at'], name='chat_msg_session_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['chat_session', 'read', 'user'], name='chat_msg_session_read_idx'),
+        ),
+    ]
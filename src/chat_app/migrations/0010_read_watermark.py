@@ -0,0 +1,89 @@
+# Generated by Django 3.2.2 on 2026-10-17 01:46
+
+from django.db import migrations, models
+
+
+def read_flags_to_watermarks(apps, schema_editor):
+    """
+    Derives the read watermark of every participant from the per-message read flags.
+
+    The watermark of a participant becomes the timestamp of the newest message of the other
+    participant that was marked as read. The unread counts are then recomputed from the watermarks.
+    """
+    ChatMessage = apps.get_model('chat_app', 'ChatMessage')
+    ChatSession = apps.get_model('chat_app', 'ChatSession')
+    UnreadCounter = apps.get_model('chat_app', 'UnreadCounter')
+    participants = {
+        ch_session['id']: (ch_session['user1_id'], ch_session['user2_id'])
+        for ch_session in ChatSession.objects.values('id', 'user1_id', 'user2_id')
+    }
+    last_read = (ChatMessage.objects.filter(read=True).order_by()
+                 .values('chat_session_id', 'user_id').annotate(last_read_at=models.Max('created_at')))
+    for row in last_read:
+        user1_id, user2_id = participants[row['chat_session_id']]
+        reader_id = user2_id if row['user_id'] == user1_id else user1_id
+        UnreadCounter.objects.update_or_create(
+            chat_session_id=row['chat_session_id'], user_id=reader_id,
+            defaults={'last_read_at': row['last_read_at']},
+        )
+    recount_unread(ChatMessage, UnreadCounter, apps.get_model('chat_app', 'Profile'), participants)
+
+
+def recount_unread(ChatMessage, UnreadCounter, Profile, participants):
+    """
+    Recomputes every unread counter and overall unread count under the watermark meaning.
+
+    A message is unread when it is newer than the watermark of its recipient, which is not
+    always the same as the read flag it had, so the counts maintained from the flags are
+    replaced by a count per (chat session, recipient) of the messages after the watermark.
+    """
+    watermark = UnreadCounter.objects.filter(
+        chat_session_id=models.OuterRef('chat_session_id'),
+    ).exclude(user_id=models.OuterRef('user_id')).values('last_read_at')[:1]
+    unread = (ChatMessage.objects.order_by().annotate(watermark=models.Subquery(watermark))
+              .filter(models.Q(watermark__isnull=True) | models.Q(created_at__gt=models.F('watermark')))
+              .values('chat_session_id', 'user_id').annotate(unread=models.Count('id')))
+    counts = {}
+    for row in unread:
+        user1_id, user2_id = participants[row['chat_session_id']]
+        reader_id = user2_id if row['user_id'] == user1_id else user1_id
+        counts[(row['chat_session_id'], reader_id)] = row['unread']
+    counters = {(counter.chat_session_id, counter.user_id): counter for counter in UnreadCounter.objects.all()}
+    for session_id, (user1_id, user2_id) in participants.items():
+        for reader_id in (user1_id, user2_id):
+            counter = counters.get((session_id, reader_id))
+            if counter is None:
+                counter = counters[(session_id, reader_id)] = UnreadCounter(chat_session_id=session_id, user_id=reader_id)
+            counter.count = counts.get((session_id, reader_id), 0)
+    UnreadCounter.objects.bulk_create([counter for counter in counters.values() if counter.pk is None], batch_size=1000)
+    UnreadCounter.objects.bulk_update([counter for counter in counters.values() if counter.pk is not None], ['count'], batch_size=1000)
+    totals = {}
+    for (session_id, reader_id), count in counts.items():
+        totals[reader_id] = totals.get(reader_id, 0) + count
+    Profile.objects.exclude(user_id__in=totals.keys()).update(unread_msg_count=0)
+    for user_id, total in totals.items():
+        Profile.objects.filter(user_id=user_id).update(unread_msg_count=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0009_message_columns_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unreadcounter',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(read_flags_to_watermarks, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chat_msg_session_read_idx',
+        ),
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='read',
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.2.2 on 2026-10-17 01:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+SNIPPET_LENGTH = 100
+
+
+def build_inbox_entries(apps, schema_editor):
+    """
+    Creates the inbox rows of both participants of every existing chat session.
+
+    Each row shows the newest message of its chat session, or the last update of the chat
+    session if no message has been sent yet.
+    """
+    ChatMessage = apps.get_model('chat_app', 'ChatMessage')
+    ChatSession = apps.get_model('chat_app', 'ChatSession')
+    InboxEntry = apps.get_model('chat_app', 'InboxEntry')
+    entries = []
+    for ch_session in ChatSession.objects.iterator():
+        msg = ChatMessage.objects.filter(chat_session_id=ch_session.id).order_by('-created_at').first()
+        preview = {'last_message_at': ch_session.updated_on}
+        if msg is not None:
+            preview = {
+                'last_message_id': msg.id,
+                'last_message_snippet': str(msg.message_detail.get('msg', ''))[:SNIPPET_LENGTH],
+                'last_message_at': msg.created_at,
+                'last_sender_id': msg.user_id,
+            }
+        for user_id, other_user_id in ((ch_session.user1_id, ch_session.user2_id), (ch_session.user2_id, ch_session.user1_id)):
+            entries.append(InboxEntry(user_id=user_id, chat_session_id=ch_session.id, other_user_id=other_user_id, **preview))
+    InboxEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat_app', '0010_read_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_id', models.UUIDField(blank=True, null=True)),
+                ('last_message_snippet', models.CharField(blank=True, default='', max_length=100)),
+                ('last_message_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chat_app.chatsession')),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('other_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['user', '-last_message_at', '-id'], name='chat_inbox_user_last_msg_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='inboxentry',
+            unique_together={('user', 'chat_session')},
+        ),
+        migrations.RunPython(build_inbox_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 3.2.2 on 2026-10-17 02:05
+
+from django.db import migrations, models
+
+
+def pair_key(user1_id, user2_id):
+    low, high = sorted((user1_id, user2_id))
+    return f'{low}_{high}'
+
+
+def merge_reversed_duplicates(apps, schema_editor):
+    """
+    Merges chat sessions of the same two users into the oldest one and sets every pair key.
+
+    Messages of the duplicates are moved to the kept chat session. Unread counters are merged
+    per participant: the watermark becomes the newest one and the count is recomputed from the
+    moved messages. The overall unread counts of the participants are recomputed from their
+    counters. The kept inbox rows take the newest preview, then the duplicates are deleted.
+    """
+    ChatMessage = apps.get_model('chat_app', 'ChatMessage')
+    ChatSession = apps.get_model('chat_app', 'ChatSession')
+    InboxEntry = apps.get_model('chat_app', 'InboxEntry')
+    Profile = apps.get_model('chat_app', 'Profile')
+    UnreadCounter = apps.get_model('chat_app', 'UnreadCounter')
+    groups = {}
+    merged_users = set()
+    for ch_session in ChatSession.objects.order_by('id'):
+        groups.setdefault(pair_key(ch_session.user1_id, ch_session.user2_id), []).append(ch_session)
+    for key, (keep, *duplicates) in groups.items():
+        for duplicate in duplicates:
+            ChatMessage.objects.filter(chat_session_id=duplicate.id).update(chat_session_id=keep.id)
+            for counter in UnreadCounter.objects.filter(chat_session_id=duplicate.id):
+                kept, created = UnreadCounter.objects.get_or_create(chat_session_id=keep.id, user_id=counter.user_id)
+                if counter.last_read_at and (kept.last_read_at is None or counter.last_read_at > kept.last_read_at):
+                    kept.last_read_at = counter.last_read_at
+                kept.save()
+                counter.delete()
+            for entry in InboxEntry.objects.filter(chat_session_id=duplicate.id):
+                InboxEntry.objects.filter(chat_session_id=keep.id, user_id=entry.user_id, last_message_at__lt=entry.last_message_at).update(
+                    last_message_id=entry.last_message_id,
+                    last_message_snippet=entry.last_message_snippet,
+                    last_message_at=entry.last_message_at,
+                    last_sender_id=entry.last_sender_id,
+                )
+            if duplicate.updated_on > keep.updated_on:
+                ChatSession.objects.filter(id=keep.id).update(updated_on=duplicate.updated_on)
+            duplicate.delete()
+        if duplicates:
+            merged_users.update((keep.user1_id, keep.user2_id))
+            for counter in UnreadCounter.objects.filter(chat_session_id=keep.id):
+                unread = ChatMessage.objects.filter(chat_session_id=keep.id).exclude(user_id=counter.user_id)
+                if counter.last_read_at is not None:
+                    unread = unread.filter(created_at__gt=counter.last_read_at)
+                UnreadCounter.objects.filter(id=counter.id).update(count=unread.count())
+        ChatSession.objects.filter(id=keep.id).update(pair_key=key)
+    for user_id in merged_users:
+        total = UnreadCounter.objects.filter(user_id=user_id).aggregate(total=models.Sum('count'))['total']
+        Profile.objects.filter(user_id=user_id).update(unread_msg_count=total or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0011_inbox_entries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='pair_key',
+            field=models.CharField(editable=False, max_length=41, null=True),
+        ),
+        migrations.RunPython(merge_reversed_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.2 on 2026-10-17 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0012_chat_session_pair_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatsession',
+            name='pair_key',
+            field=models.CharField(editable=False, max_length=41, unique=True),
+        ),
+    ]
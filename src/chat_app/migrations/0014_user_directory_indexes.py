@@ -0,0 +1,42 @@
+# Generated by Django 3.2.2 on 2026-10-17 02:20
+
+from django.db import migrations
+
+INDEXES = (
+    ('chat_user_username_upper_idx', 'UPPER("username"::text)'),
+    ('chat_user_username_upper_like_idx', 'UPPER("username"::text) text_pattern_ops'),
+)
+
+
+def create_directory_indexes(apps, schema_editor):
+    """
+    Creates the expression indexes of the user directory on PostgreSQL.
+
+    `username__istartswith` is compiled to `UPPER("username"::text) LIKE UPPER(...)`, which only
+    uses an index built with `text_pattern_ops` unless the database collation is "C". The plain
+    expression index serves the ordering by the upper-cased username and the cursor range.
+    Other databases are left unchanged.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, expression in INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "auth_user" ({expression})')
+
+
+def drop_directory_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, expression in INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat_app', '0013_chat_session_pair_key_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_directory_indexes, drop_directory_indexes),
+    ]
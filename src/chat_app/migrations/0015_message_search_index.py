@@ -0,0 +1,35 @@
+# Generated by Django 3.2.2 on 2026-10-17 02:40
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Creates the full-text index of the message text on PostgreSQL.
+
+    The expression must stay identical to `chat_app.search.SEARCH_VECTOR_SQL`, otherwise the
+    search queries cannot use the index. Other databases use the in-process index instead.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS "chat_msg_fts_idx" ON "chat_app_chatmessage" '
+        "USING GIN (to_tsvector('simple', COALESCE(\"message_detail\" ->> 'msg', '')))"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS "chat_msg_fts_idx"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0014_user_directory_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
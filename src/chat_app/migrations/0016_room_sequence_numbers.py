@@ -0,0 +1,51 @@
+# Generated by Django 3.2.2 on 2026-10-17 02:06
+
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+
+
+def number_existing_messages(apps, schema_editor):
+    """
+    Gives the existing messages of every chat session sequence numbers in chronological order.
+
+    Each chat session is numbered in its own transaction, so an interrupted run keeps the chat
+    sessions already numbered; sessions whose messages all have a sequence number are skipped.
+    """
+    ChatMessage = apps.get_model('chat_app', 'ChatMessage')
+    ChatSession = apps.get_model('chat_app', 'ChatSession')
+    for session_id in ChatSession.objects.values_list('id', flat=True).iterator():
+        with transaction.atomic():
+            if not ChatMessage.objects.filter(chat_session_id=session_id, seq__isnull=True).exists():
+                continue
+            messages = list(ChatMessage.objects.filter(chat_session_id=session_id).order_by('created_at', 'id').only('id'))
+            for seq, msg in enumerate(messages, start=1):
+                msg.seq = seq
+            ChatMessage.objects.bulk_update(messages, ['seq'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chat_app', '0015_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unreadcounter',
+            name='last_read_seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['chat_session', 'seq'], name='chat_msg_session_seq_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.2 on 2026-10-17 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0016_room_sequence_numbers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='unread_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
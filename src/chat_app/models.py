@@ -1,8 +1,11 @@
 import os
 import random
-from django.db import models
+from collections import namedtuple
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import Q, F, Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 import uuid
 
 
@@ -39,6 +42,21 @@ def uploadImagePath(instance, fileName):
     return f"avatars/{instance.user}/{finalFileName}"
 
 
+class UnreadState(namedtuple('UnreadState', ['session_id', 'recipient_id', 'sender_id', 'count', 'total', 'version'])):
+    """
+    The unread counts of a recipient after new messages were stored.
+
+    Attributes:
+        session_id (int): The ID of the chat session of the messages.
+        recipient_id (int): The ID of the recipient.
+        sender_id (int): The ID of the other participant, who sent the messages.
+        count (int): The number of unread messages of the recipient in the chat session.
+        total (int): The overall number of unread messages of the recipient.
+        version (int): The `Profile.unread_version` of the recipient the counts belong to.
+    """
+    __slots__ = ()
+
+
 class Profile(models.Model):
     """
     Represents a user profile with additional information.
@@ -47,6 +65,10 @@ class Profile(models.Model):
         user (User): The user associated with the profile.
         avatar (ImageField): The avatar image of the user.
         is_online (bool): Indicates whether the user is currently online.
+        unread_msg_count (int): The overall number of unread messages of the user, maintained
+            alongside the per-session `UnreadCounter` rows.
+        unread_version (int): Incremented with every change of the unread counts of the user, in
+            the same update, so pushed counts can be ordered whatever worker process sent them.
 
     Properties:
         avatarUrl (str): The URL of the user's avatar image.
@@ -54,6 +76,8 @@ class Profile(models.Model):
     user = models.OneToOneField(User,on_delete=models.CASCADE,related_name='profile_detail')
     avatar = models.ImageField(upload_to=uploadImagePath, null=True, blank=True, default="avatars/default/default.jpg")
     is_online = models.BooleanField(default = False)
+    unread_msg_count = models.PositiveIntegerField(default = 0)
+    unread_version = models.PositiveBigIntegerField(default = 0)
 
     @property
     def avatarUrl(self):
@@ -77,6 +101,8 @@ class ChatSession(models.Model):
         user1 (User): The first user in the chat session.
         user2 (User): The second user in the chat session.
         updated_on (DateTimeField): The timestamp of the last update to the chat session.
+        pair_key (CharField): The canonical "<lower user id>_<higher user id>" key of the participants,
+            identical for both orderings of user1 and user2.
 
     Meta:
         unique_together (tuple): Specifies that each combination of user1 and user2 must be unique.
@@ -84,14 +110,19 @@ class ChatSession(models.Model):
 
     Methods:
         __str__(): Returns a string representation of the chat session.
+        save(*args, **kwargs): Saves the chat session with its canonical pair key.
         room_group_name(): Generates the name of the room group for this chat session.
+        other_user_id(user_id): Returns the ID of the other participant of the chat session.
+        make_pair_key(user1_id, user2_id): Returns the canonical pair key of two users.
         chat_session_exists(user1, user2): Checks if a chat session exists between the given users.
+        get_or_create_pair(user1, user2): Returns the chat session of two users, creating it atomically if needed.
         create_if_not_exists(user1, user2): Creates a new chat session if it does not already exist.
 
     """
     user1 = models.ForeignKey(User,on_delete=models.CASCADE,related_name='user1_name')
     user2 = models.ForeignKey(User,on_delete=models.CASCADE,related_name='user2_name')
     updated_on = models.DateTimeField(auto_now = True)
+    pair_key = models.CharField(max_length = 41, unique = True, editable = False)
     
     class Meta:
         unique_together = ("user1", "user2")
@@ -105,6 +136,13 @@ class ChatSession(models.Model):
             str: The string representation of the chat session in the format "user1_username_user2_username".
         """
         return '%s_%s' % (self.user1.username, self.user2.username)
+
+    def save(self,*args,**kwargs):
+        """
+        Saves the chat session with the canonical pair key of its participants.
+        """
+        self.pair_key = ChatSession.make_pair_key(self.user1_id, self.user2_id)
+        super().save(*args,**kwargs)
         
     @property
     def room_group_name(self):
@@ -116,6 +154,33 @@ class ChatSession(models.Model):
         """
         return f'chat_{self.id}'
 
+    def other_user_id(self, user_id):
+        """
+        Returns the ID of the participant of this chat session who is not the given user.
+
+        Args:
+            user_id (int): The ID of one of the participants.
+
+        Returns:
+            int: The ID of the other participant.
+        """
+        return self.user2_id if user_id == self.user1_id else self.user1_id
+
+    @staticmethod
+    def make_pair_key(user1_id, user2_id):
+        """
+        Returns the canonical pair key of two users.
+
+        Args:
+            user1_id (int): The ID of one user.
+            user2_id (int): The ID of the other user.
+
+        Returns:
+            str: The key "<lower user id>_<higher user id>".
+        """
+        low, high = sorted((int(user1_id), int(user2_id)))
+        return f'{low}_{high}'
+
     @staticmethod
     def chat_session_exists(user1,user2):
         """
@@ -128,7 +193,37 @@ class ChatSession(models.Model):
         Returns:
             ChatSession or None: The chat session if it exists, otherwise None.
         """
-        return ChatSession.objects.filter(Q(user1=user1, user2=user2) | Q(user1=user2, user2=user1)).first()
+        return ChatSession.objects.filter(pair_key = ChatSession.make_pair_key(user1.id, user2.id)).first()
+
+    @staticmethod
+    def get_or_create_pair(user1,user2):
+        """
+        Returns the chat session between the given users, creating it if it does not exist.
+
+        The insert runs in a savepoint and relies on the unique pair key, so concurrent requests
+        for the same pair in either order create exactly one chat session; the losers read the
+        winner's row. The cached chat partners of both users are invalidated by the `post_save`
+        signal of the new chat session.
+
+        Args:
+            user1 (User): The first user.
+            user2 (User): The second user.
+
+        Returns:
+            tuple: The chat session and a boolean that is True if it was created by this call.
+        """
+        ch_session = ChatSession.chat_session_exists(user1,user2)
+        if ch_session:
+            return ch_session, False
+        try:
+            with transaction.atomic():
+                ch_session = ChatSession.objects.create(user1=user1,user2=user2)
+        except IntegrityError:
+            ch_session = ChatSession.chat_session_exists(user1,user2)
+            if ch_session is None:
+                raise
+            return ch_session, False
+        return ch_session, True
     
     @staticmethod
     def create_if_not_exists(user1,user2):
@@ -140,10 +235,10 @@ class ChatSession(models.Model):
             user2 (User): The second user.
 
         Returns:
-            bool: True if a new chat session was created, False if it already existed.
+            ChatSession or bool: The new chat session if it was created, False if it already existed.
         """
-        res = ChatSession.chat_session_exists(user1,user2)
-        return False if res else ChatSession.objects.create(user1=user1,user2=user2)
+        ch_session, created = ChatSession.get_or_create_pair(user1,user2)
+        return ch_session if created else False
 
 
 class ChatMessage(models.Model):
@@ -154,17 +249,26 @@ class ChatMessage(models.Model):
         id (UUIDField): The unique identifier for the message.
         chat_session (ForeignKey): The chat session to which the message belongs.
         user (ForeignKey): The user who sent the message.
-        message_detail (JSONField): Details of the message, including timestamp and read status.
+        message_detail (JSONField): Details of the message, including the text and user-specific flags.
+        created_at (DateTimeField): The time at which the message was sent. A message has been read
+            once it is not newer than the read watermark (`UnreadCounter.last_read_at`) of its recipient.
+        seq (BigIntegerField): The sequence number of the message among the events of its chat session.
 
     Meta:
         ordering (list): Specifies the default ordering of instances in queries.
+        indexes (list): Indexes serving the history, unread and replay range scans of a chat session.
 
     Methods:
         __str__(): Returns a string representation of the message.
         save(*args, **kwargs): Saves the message instance and updates the corresponding chat session's timestamp.
+        persist_messages(messages): Inserts a batch of new messages together with their bookkeeping.
+        serialize(read_until): Returns the message as a JSON serializable dictionary.
+        history_page(session_id, before, limit): Returns one keyset paginated page of the history of a chat session.
+        messages_since(session_id, after, limit): Returns the messages of a chat session newer than a position.
         count_overall_unread_msg(user_id): Counts the overall number of unread messages for a user.
-        message_read_true(message_id): Marks a specific message as read.
-        all_msg_read(room_id, user): Marks all unread messages in a chat session as read for a specific user.
+        meassage_read_true(session_id, reader_id, message_id): Marks a message of a chat session, and every earlier one, as read.
+        newest_read(session_id, reader_id, message_ids): Returns the timestamp of the newest of a batch of read messages.
+        all_msg_read(session_id, reader_id): Marks all unread messages in a chat session as read for a participant.
         sender_inactive_msg(message_id): Marks a message as sender inactive.
         receiver_inactive_msg(message_id): Marks a message as receiver inactive.
     """
@@ -172,9 +276,15 @@ class ChatMessage(models.Model):
     chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='user_messages')
     user = models.ForeignKey(User, verbose_name='message_sender', on_delete=models.CASCADE)
     message_detail = models.JSONField()
+    created_at = models.DateTimeField(default = timezone.now)
+    seq = models.BigIntegerField(null = True, blank = True)
 
     class Meta:
-        ordering = ['-message_detail__timestamp']
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields = ['chat_session', 'created_at'], name = 'chat_msg_session_created_idx'),
+            models.Index(fields = ['chat_session', 'seq'], name = 'chat_msg_session_seq_idx'),
+        ]
     
     def __str__(self):
         """
@@ -183,59 +293,214 @@ class ChatMessage(models.Model):
         Returns:
             str: The timestamp of the message.
         """
-        return '%s' %(self.message_detail["timestamp"])
+        return '%s' %(self.created_at)
 
     def save(self,*args,**kwargs):
         """
         Saves the message instance and updates the corresponding chat session's timestamp.
+
+        The timestamp update is coalesced by `session_touches` instead of re-saving the chat session.
+        New messages also move the inbox rows of the chat session and are added to the search index.
         """
+        from .session_touch import session_touches
+        from .search import message_index
+        adding = self._state.adding
         super().save(*args,**kwargs)
-        ChatSession.objects.get(id = self.chat_session.id).save()   # Update ChatSession TimeStampe
+        if adding:
+            InboxEntry.record_messages([self])
+            transaction.on_commit(lambda: message_index.add([self]))
+        session_touches.touch(self.chat_session_id)   # Update ChatSession TimeStampe
+
+    @staticmethod
+    def persist_messages(messages):
+        """
+        Inserts a batch of new messages and applies their bookkeeping in one transaction.
+
+        The messages are written with a single `bulk_create`. The unread counters are incremented
+        once per (chat session, recipient), in key order so that concurrent batches lock the counter
+        rows in the same order, the inbox rows are moved to the newest message of
+        each chat session and the `updated_on` timestamp of every chat session in the batch is
+        marked as touched. Once committed, the messages are added to the in-process search index.
+        `save()` and the `post_save` signals are bypassed, so the caller must have checked that
+        each sender is a participant of the chat session.
+
+        The unread counts after the batch are read back from the counter rows and profiles that
+        were just updated, by key, so that they can be pushed to the recipients without any count.
+
+        Args:
+            messages (list): (ChatMessage, recipient_id) pairs of unsaved messages.
+
+        Returns:
+            list: An UnreadState per (chat session, recipient) of the batch.
+        """
+        from .session_touch import session_touches
+        from .search import message_index
+        unread = {}
+        senders = {}
+        for msg, recipient_id in messages:
+            key = (msg.chat_session_id, recipient_id)
+            unread.setdefault(key, []).append(msg.created_at)
+            senders[key] = msg.user_id
+        with transaction.atomic():
+            ChatMessage.objects.bulk_create([msg for msg, recipient_id in messages])
+            for (session_id, recipient_id) in sorted(unread):
+                UnreadCounter.increment(session_id, recipient_id, unread[(session_id, recipient_id)])
+            InboxEntry.record_messages([msg for msg, recipient_id in messages])
+            counts = UnreadCounter.counts_for(unread.keys())
+            totals = {user_id: (total, version) for user_id, total, version in Profile.objects.filter(user__id__in = {recipient_id for session_id, recipient_id in unread}).values_list('user_id', 'unread_msg_count', 'unread_version')}
+            transaction.on_commit(lambda: message_index.add([msg for msg, recipient_id in messages]))
+        session_touches.touch(*{session_id for session_id, recipient_id in unread})
+        return [UnreadState(session_id, recipient_id, senders[(session_id, recipient_id)], counts.get((session_id, recipient_id), 0), *totals.get(recipient_id, (0, 0)))
+                for session_id, recipient_id in unread]
+
+    def serialize(self, read_until = None):
+        """
+        Returns the message as a JSON serializable dictionary.
+
+        Args:
+            read_until (datetime): The read watermark of the recipient of the message, if any.
+
+        Returns:
+            dict: The message id, sender username, text, timestamp and read status.
+        """
+        return {
+            'msg_id': str(self.id),
+            'user': self.user.username,
+            'message': self.message_detail.get('msg'),
+            'timestamp': self.created_at.isoformat(),
+            'read': read_until is not None and self.created_at <= read_until,
+        }
+
+    @staticmethod
+    def history_page(session_id, before = None, limit = 50):
+        """
+        Returns one page of the message history of a chat session using keyset pagination.
+
+        Pages are read newest first from the (chat_session, created_at) index, starting strictly
+        before the given (created_at, id) position, so the cost of a page does not depend on how
+        long the history is.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            before (tuple): The (created_at, id) position to continue from, or None for the latest page.
+            limit (int): The maximum number of messages in the page.
+
+        Returns:
+            tuple: The messages of the page in chronological order, and the (created_at, id) position
+            of the oldest message if older messages exist, otherwise None.
+        """
+        qs = ChatMessage.objects.filter(chat_session_id = session_id).select_related('user').order_by('-created_at', '-id')
+        if before:
+            created_at, msg_id = before
+            qs = qs.filter(Q(created_at__lt = created_at) | Q(created_at = created_at, id__lt = msg_id))
+        page = list(qs[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_position = (page[-1].created_at, page[-1].id) if has_more else None
+        return page[::-1], next_position
+
+    @staticmethod
+    def messages_since(session_id, after = None, limit = 200):
+        """
+        Returns the messages of a chat session that are newer than a position, oldest first.
+
+        This is the delta read of reconnecting clients: a forward range scan of the
+        (chat_session, created_at) index starting strictly after the given (created_at, id) position.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            after (tuple): The (created_at, id) position of the newest message known to the client,
+                or None to start at the beginning of the history.
+            limit (int): The maximum number of messages to return.
+
+        Returns:
+            tuple: The messages in chronological order and a boolean that is True if further
+            messages exist after the last returned one.
+        """
+        qs = ChatMessage.objects.filter(chat_session_id = session_id).select_related('user').order_by('created_at', 'id')
+        if after:
+            created_at, msg_id = after
+            qs = qs.filter(Q(created_at__gt = created_at) | Q(created_at = created_at, id__gt = msg_id))
+        page = list(qs[:limit + 1])
+        return page[:limit], len(page) > limit
 
     @staticmethod
     def count_overall_unread_msg(user_id):
         """
         Counts the overall number of unread messages for a user.
 
+        The total is maintained on the user's `Profile` by `UnreadCounter`, so this is a single
+        row read instead of one count per chat session.
+
         Args:
             user_id (int): The ID of the user.
 
         Returns:
             int: The total number of unread messages.
         """
-        total_unread_msg = 0
-        user_all_friends = ChatSession.objects.filter(Q(user1__id = user_id) | Q(user2__id = user_id))
-        for ch_session in user_all_friends:
-            un_read_msg_count = ChatMessage.objects.filter(chat_session = ch_session.id,message_detail__read = False).exclude(user__id = user_id).count()        
-            total_unread_msg += un_read_msg_count
-        return total_unread_msg
+        return Profile.objects.filter(user__id = user_id).values_list('unread_msg_count', flat = True).first() or 0
 
     @staticmethod
-    def meassage_read_true(message_id):
+    def meassage_read_true(session_id, reader_id, message_id, seq = None):
         """
-        Marks a specific message as read.
+        Marks a message read by a participant, and every earlier message of the other participant, as read.
+
+        The read watermark of the reader is advanced to the timestamp of the message and the
+        reader's unread counter is recomputed for the messages after the watermark. Only a message
+        of the other participant in the given chat session moves the watermark, see `newest_read`.
 
         Args:
+            session_id (int): The ID of the chat session.
+            reader_id (int): The ID of the user who read the message.
             message_id (UUID): The ID of the message.
+            seq (int): The sequence number of the read event, if it was sequenced.
+
+        Returns:
+            datetime: The new watermark, or None if the message does not qualify.
         """
-        msg_inst = ChatMessage.objects.filter(id = message_id).first()
-        msg_inst.message_detail['read'] = True
-        msg_inst.save(update_fields = ['message_detail',])
-        return None
+        read_until = ChatMessage.newest_read(session_id, reader_id, [message_id])
+        if read_until is not None:
+            UnreadCounter.advance_watermark(session_id, reader_id, read_until, seq = seq)
+        return read_until
 
     @staticmethod
-    def all_msg_read(room_id,user):
+    def newest_read(session_id, reader_id, message_ids):
         """
-        Marks all unread messages in a chat session as read for a specific user.
+        Returns the timestamp of the newest message of a batch of read receipts.
+
+        Read state is a watermark, so a batch of read messages marks every message of the other
+        participant up to the newest of them as read. Messages of other chat sessions or of the
+        reader are ignored.
 
         Args:
-            room_id (UUID): The ID of the chat session.
-            user (str): The username of the user.
+            session_id (int): The ID of the chat session.
+            reader_id (int): The ID of the user who read the messages.
+            message_ids (list): The IDs of the read messages.
+
+        Returns:
+            datetime: The timestamp of the newest read message, or None if no message of the batch qualifies.
+        """
+        if not message_ids:
+            return None
+        return (ChatMessage.objects.filter(chat_session_id = session_id, id__in = message_ids)
+                .exclude(user_id = reader_id).aggregate(read_until = Max('created_at'))['read_until'])
+
+    @staticmethod
+    def all_msg_read(session_id, reader_id, seq = None):
         """
-        all_msg = ChatMessage.objects.filter(chat_session = room_id,message_detail__read = False).exclude(user__username = user)
-        for msg in all_msg:
-            msg.message_detail['read'] = True
-            msg.save(update_fields = ['message_detail',])
+        Marks all unread messages in a chat session as read for a participant.
+
+        This moves the read watermark of the participant to the newest stored message of the other
+        participant and resets the unread counter of the participant for this chat session,
+        regardless of the number of unread messages. The caller must have checked that the reader
+        is a participant of the chat session.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            reader_id (int): The ID of the participant who read the chat session.
+            seq (int): The sequence number of the read event, if it was sequenced.
+        """
+        UnreadCounter.reset(session_id, reader_id, seq = seq)
         return None
 
     @staticmethod
@@ -257,3 +522,337 @@ class ChatMessage(models.Model):
             message_id (UUID): The ID of the message.
         """
         return ChatMessage.objects.filter(id = message_id).update(message_detail__Rclr = True)
+
+
+class UnreadCounter(models.Model):
+    """
+    Maintains the read watermark and the number of unread messages of a participant in a chat session.
+
+    One row exists per (chat session, participant). Every message of the other participant newer than
+    `last_read_at` is unread. The counter is incremented when a message newer than the watermark is
+    persisted and recomputed or reset when the watermark moves, always under the lock of the row, so that per-session and overall unread counts never have to be
+    recomputed from `ChatMessage`. The overall count of a user is kept in `Profile.unread_msg_count`
+    and updated in the same transaction.
+
+    Attributes:
+        chat_session (ForeignKey): The chat session the counter belongs to.
+        user (ForeignKey): The participant whose unread messages are counted.
+        count (int): The number of unread messages.
+        last_read_at (DateTimeField): The timestamp up to which the participant has read the chat session.
+        last_read_seq (BigIntegerField): The sequence number of the room event that last moved the watermark.
+
+    Meta:
+        unique_together (tuple): Specifies that there is only one counter per chat session and user.
+
+    Methods:
+        increment(session_id, user_id, timestamps): Adds the new messages newer than the watermark to a counter.
+        advance_watermark(session_id, user_id, read_until): Marks the messages up to a timestamp as read.
+        reset(session_id, user_id): Marks every stored message of a counter as read.
+        count_for(session_id, user_id): Returns the unread count of a chat session for a user.
+        counts_for(keys): Returns the unread counts of several (chat session, user) pairs.
+        watermarks(session_id): Returns the read watermarks of the participants of a chat session.
+        rebuild(): Recomputes every counter from the stored messages.
+    """
+    chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='unread_counters')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='unread_counters')
+    count = models.PositiveIntegerField(default = 0)
+    last_read_at = models.DateTimeField(null = True, blank = True)
+    last_read_seq = models.BigIntegerField(null = True, blank = True)
+
+    class Meta:
+        unique_together = ("chat_session", "user")
+
+    def __str__(self):
+        """
+        Returns a string representation of the counter.
+
+        Returns:
+            str: The chat session id, the user id and the unread count.
+        """
+        return '%s_%s_%s' % (self.chat_session_id, self.user_id, self.count)
+
+    @staticmethod
+    def increment(session_id, user_id, timestamps):
+        """
+        Adds new messages to the unread counter of a user in a chat session.
+
+        Messages are stamped before they are stored, so a message may be stored after the
+        watermark already moved past its timestamp, e.g. when it waited in the write-behind queue
+        or was inserted by another worker while the recipient read the chat session. Such a
+        message is already read and is not counted. The watermark is read under the lock of the
+        counter row, which `advance_watermark` and `reset` hold while they move it.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            user_id (int): The ID of the recipient.
+            timestamps (list): The `created_at` timestamps of the new messages.
+
+        Returns:
+            int: The number of messages counted as unread.
+        """
+        with transaction.atomic():
+            counter, created = UnreadCounter.objects.select_for_update().get_or_create(chat_session_id = session_id, user_id = user_id)
+            amount = sum(1 for created_at in timestamps if counter.last_read_at is None or created_at > counter.last_read_at)
+            if amount:
+                UnreadCounter.objects.filter(pk = counter.pk).update(count = F('count') + amount)
+                Profile.objects.filter(user__id = user_id).update(unread_msg_count = F('unread_msg_count') + amount, unread_version = F('unread_version') + 1)
+        return amount
+
+    @staticmethod
+    def advance_watermark(session_id, user_id, read_until, seq = None):
+        """
+        Marks the messages of a chat session up to a timestamp as read for a user.
+
+        The watermark only moves forward. The unread counter is recomputed from the messages of
+        the other participant that are still newer than the watermark, and the overall count of
+        the user is moved by the difference, never below zero, so a counter that drifted heals.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            user_id (int): The ID of the reader.
+            read_until (datetime): The timestamp of the newest message that has been read.
+            seq (int): The sequence number of the read event, recorded for replays.
+
+        Returns:
+            bool: True if the watermark moved, False if it was already at or past the timestamp.
+        """
+        with transaction.atomic():
+            counter, created = UnreadCounter.objects.select_for_update().get_or_create(chat_session_id = session_id, user_id = user_id)
+            if counter.last_read_at is not None and counter.last_read_at >= read_until:
+                return False
+            remaining = ChatMessage.objects.filter(chat_session_id = session_id, created_at__gt = read_until).exclude(user_id = user_id).count()
+            UnreadCounter.objects.filter(pk = counter.pk).update(count = remaining, last_read_at = read_until, last_read_seq = F('last_read_seq') if seq is None else seq)
+            change = remaining - counter.count
+            if change:
+                Profile.objects.filter(user__id = user_id).update(unread_msg_count = Greatest(F('unread_msg_count') + change, 0), unread_version = F('unread_version') + 1)
+        return True
+
+    @staticmethod
+    def reset(session_id, user_id, seq = None):
+        """
+        Marks every stored message of a chat session as read for a user.
+
+        The watermark is moved to the newest message of the other participant stored when the
+        counter row is locked, never backwards, and the counter is set to zero. A message stamped
+        earlier but stored later is covered by the watermark and not counted by `increment`; a
+        newer one is. The overall count of the user is lowered by the counter, never below zero.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            user_id (int): The ID of the reader.
+            seq (int): The sequence number of the read event, recorded for replays.
+        """
+        with transaction.atomic():
+            counter, created = UnreadCounter.objects.select_for_update().get_or_create(chat_session_id = session_id, user_id = user_id)
+            newest = ChatMessage.objects.filter(chat_session_id = session_id).exclude(user_id = user_id).aggregate(newest = Max('created_at'))['newest']
+            read_until = counter.last_read_at
+            if newest is not None and (read_until is None or newest > read_until):
+                read_until = newest
+            UnreadCounter.objects.filter(pk = counter.pk).update(count = 0, last_read_at = read_until, last_read_seq = F('last_read_seq') if seq is None else seq)
+            if counter.count:
+                Profile.objects.filter(user__id = user_id).update(unread_msg_count = Greatest(F('unread_msg_count') - counter.count, 0), unread_version = F('unread_version') + 1)
+
+    @staticmethod
+    def count_for(session_id, user_id):
+        """
+        Returns the unread count of a chat session for a user.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            user_id (int): The ID of the recipient.
+
+        Returns:
+            int: The number of unread messages.
+        """
+        return UnreadCounter.objects.filter(chat_session_id = session_id, user_id = user_id).values_list('count', flat = True).first() or 0
+
+    @staticmethod
+    def counts_for(keys):
+        """
+        Returns the unread counts of several (chat session, user) pairs with one query.
+
+        Args:
+            keys (iterable): (chat session ID, user ID) pairs.
+
+        Returns:
+            dict: The unread count keyed by (chat session ID, user ID). Pairs without a counter are missing.
+        """
+        condition = Q()
+        for session_id, user_id in keys:
+            condition |= Q(chat_session_id = session_id, user_id = user_id)
+        if not condition:
+            return {}
+        return {(session_id, user_id): count for session_id, user_id, count in UnreadCounter.objects.filter(condition).values_list('chat_session_id', 'user_id', 'count')}
+
+    @staticmethod
+    def watermarks(session_id):
+        """
+        Returns the read watermarks of the participants of a chat session.
+
+        Args:
+            session_id (int): The ID of the chat session.
+
+        Returns:
+            dict: The `last_read_at` timestamp keyed by user ID. Participants that have never read
+            the chat session are missing.
+        """
+        return dict(UnreadCounter.objects.filter(chat_session_id = session_id, last_read_at__isnull = False).values_list('user_id', 'last_read_at'))
+
+    @staticmethod
+    def rebuild():
+        """
+        Recomputes every unread counter and overall unread count from the stored messages and watermarks.
+
+        The unread messages of all chat sessions are counted with one grouped query, per (chat
+        session, sender), of the messages newer than the watermark of the recipient. The counters
+        are locked for the duration, so read receipts and new messages wait for the rebuild
+        instead of being overwritten by it.
+
+        Returns:
+            int: The number of counters written.
+        """
+        with transaction.atomic():
+            counters = {(counter.chat_session_id, counter.user_id): counter for counter in UnreadCounter.objects.select_for_update()}
+            watermark = (UnreadCounter.objects.filter(chat_session_id = OuterRef('chat_session_id'))
+                         .exclude(user_id = OuterRef('user_id')).values('last_read_at')[:1])
+            unread = (ChatMessage.objects.order_by().annotate(watermark = Subquery(watermark))
+                      .filter(Q(watermark__isnull = True) | Q(created_at__gt = F('watermark')))
+                      .values_list('chat_session_id', 'user_id').annotate(unread = Count('id')))
+            counts = {(session_id, sender_id): count for session_id, sender_id, count in unread}
+            totals = {}
+            for session_id, user1_id, user2_id in ChatSession.objects.values_list('id', 'user1_id', 'user2_id').iterator():
+                for user_id, sender_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                    counter = counters.get((session_id, user_id))
+                    if counter is None:
+                        counter = counters[(session_id, user_id)] = UnreadCounter(chat_session_id = session_id, user_id = user_id)
+                    counter.count = counts.get((session_id, sender_id), 0)
+                    totals[user_id] = totals.get(user_id, 0) + counter.count
+            UnreadCounter.objects.bulk_create([counter for counter in counters.values() if counter.pk is None], batch_size = 1000)
+            UnreadCounter.objects.bulk_update([counter for counter in counters.values() if counter.pk is not None], ['count'], batch_size = 1000)
+            Profile.objects.exclude(user__id__in = totals.keys()).update(unread_msg_count = 0, unread_version = F('unread_version') + 1)
+            for user_id, total in totals.items():
+                Profile.objects.filter(user__id = user_id).update(unread_msg_count = total, unread_version = F('unread_version') + 1)
+        return len(counters)
+
+
+class InboxEntry(models.Model):
+    """
+    Denormalized inbox row of a participant of a chat session.
+
+    One row exists per (participant, chat session). It holds a preview of the newest message of the
+    chat session and is updated in the same transaction in which messages are persisted, so that an
+    inbox sorted by the last activity, including the previews, is read with one range scan of the
+    (user, last_message_at) index instead of looking up the newest message of every chat session.
+
+    Attributes:
+        user (ForeignKey): The participant owning the inbox row.
+        chat_session (ForeignKey): The chat session the row belongs to.
+        other_user (ForeignKey): The other participant of the chat session.
+        last_message_id (UUIDField): The ID of the newest message, None if no message has been sent yet.
+        last_message_snippet (CharField): The beginning of the text of the newest message.
+        last_message_at (DateTimeField): The time of the newest message, or of the creation of the chat session.
+        last_sender (ForeignKey): The sender of the newest message.
+
+    Meta:
+        unique_together (tuple): Specifies that there is only one inbox row per chat session and user.
+        indexes (list): Index serving the keyset paginated inbox of a user.
+
+    Methods:
+        create_for_session(ch_session): Creates the inbox rows of both participants of a chat session.
+        record_messages(messages): Moves the inbox rows of chat sessions to their newest message.
+        page(user_id, before, limit): Returns one keyset paginated page of the inbox of a user.
+    """
+    SNIPPET_LENGTH = 100
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox_entries')
+    chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='inbox_entries')
+    other_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message_id = models.UUIDField(null = True, blank = True)
+    last_message_snippet = models.CharField(max_length = SNIPPET_LENGTH, blank = True, default = '')
+    last_message_at = models.DateTimeField(default = timezone.now)
+    last_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null = True, blank = True, related_name='+')
+
+    class Meta:
+        unique_together = ("user", "chat_session")
+        indexes = [
+            models.Index(fields = ['user', '-last_message_at', '-id'], name = 'chat_inbox_user_last_msg_idx'),
+        ]
+
+    def __str__(self):
+        """
+        Returns a string representation of the inbox row.
+
+        Returns:
+            str: The user id, the chat session id and the time of the newest message.
+        """
+        return '%s_%s_%s' % (self.user_id, self.chat_session_id, self.last_message_at)
+
+    @staticmethod
+    def create_for_session(ch_session):
+        """
+        Creates the inbox rows of both participants of a new chat session.
+
+        Args:
+            ch_session (ChatSession): The chat session.
+        """
+        InboxEntry.objects.bulk_create([
+            InboxEntry(user_id = ch_session.user1_id, chat_session = ch_session, other_user_id = ch_session.user2_id),
+            InboxEntry(user_id = ch_session.user2_id, chat_session = ch_session, other_user_id = ch_session.user1_id),
+        ], ignore_conflicts = True)
+
+    @staticmethod
+    def record_messages(messages):
+        """
+        Moves the inbox rows of the chat sessions of the given messages to their newest message.
+
+        Both rows of a chat session are updated with one UPDATE. Rows that already show a newer
+        message are left untouched, so batches may be applied out of order.
+
+        Args:
+            messages (iterable): Saved or about to be saved ChatMessage instances.
+        """
+        newest = {}
+        for msg in messages:
+            current = newest.get(msg.chat_session_id)
+            if current is None or msg.created_at >= current.created_at:
+                newest[msg.chat_session_id] = msg
+        for session_id, msg in newest.items():
+            InboxEntry.objects.filter(chat_session_id = session_id, last_message_at__lte = msg.created_at).update(
+                last_message_id = msg.id,
+                last_message_snippet = str(msg.message_detail.get('msg', ''))[:InboxEntry.SNIPPET_LENGTH],
+                last_message_at = msg.created_at,
+                last_sender_id = msg.user_id,
+            )
+
+    @staticmethod
+    def page(user_id, before = None, limit = 50):
+        """
+        Returns one page of the inbox of a user, newest activity first.
+
+        The page is a single query: the profile of the other participant is joined and the
+        unread count is read from the unread counter of the user.
+
+        Args:
+            user_id (int): The ID of the owner of the inbox.
+            before (tuple): The (last_message_at, id) position of the last row of the previous page,
+                or None for the first page.
+            limit (int): The maximum number of rows of the page.
+
+        Returns:
+            tuple: The inbox rows of the page and the (last_message_at, id) position to request the
+            next page with, or None if there are no further rows.
+        """
+        unread_counter = UnreadCounter.objects.filter(chat_session = OuterRef('chat_session'), user_id = user_id).values('count')[:1]
+        entries = (InboxEntry.objects.filter(user_id = user_id)
+                   .select_related('other_user__profile_detail')
+                   .annotate(un_read_msg_count = Coalesce(Subquery(unread_counter), Value(0)))
+                   .order_by('-last_message_at', '-id'))
+        if before is not None:
+            last_message_at, entry_id = before
+            entries = entries.filter(Q(last_message_at__lt = last_message_at) | Q(last_message_at = last_message_at, id__lt = entry_id))
+        page = list(entries[:limit + 1])
+        next_position = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_position = (page[-1].last_message_at, page[-1].id)
+        return page, next_position
@@ -0,0 +1,39 @@
+import base64
+import json
+
+
+def encode_cursor(*values):
+    """
+    Encodes the keyset values of the last row of a page into an opaque cursor.
+
+    Args:
+        *values: The values identifying the position of the row, e.g. its timestamp and id.
+            Values that are not JSON serializable are converted to strings.
+
+    Returns:
+        str: A URL safe cursor string.
+    """
+    raw = json.dumps([value if isinstance(value, (int, float)) else str(value) for value in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor, size):
+    """
+    Decodes a cursor created by `encode_cursor`.
+
+    Args:
+        cursor (str): The cursor received from the client.
+        size (int): The number of values the cursor must contain.
+
+    Returns:
+        list or None: The keyset values, or None if the cursor is empty or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
@@ -0,0 +1,574 @@
+import asyncio
+import atexit
+import logging
+import time
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .cache import cached_friend_ids, get_friend_ids
+from .cluster import shared_redis
+from .wire import frame_event
+
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    """
+    Tracks the live personal connections of every user in this process.
+
+    A user is online while at least one of their connections is present. Connections are
+    reference counted per channel name, so a user with several tabs only goes offline when the
+    last one leaves. Every connection must send a heartbeat within `heartbeat_ttl` seconds or it
+    is expired by the periodic sweep, which takes crashed clients offline. Online and offline
+    events are only broadcast on 0 to 1 and 1 to 0 transitions, and the resulting
+    `Profile.is_online` values are written in batches every `flush_interval` seconds.
+
+    Attributes:
+        heartbeat_ttl (float): Seconds after the last heartbeat at which a connection expires.
+        flush_interval (float): Seconds between batched writes of `Profile.is_online`.
+
+    Methods:
+        from_settings(): Creates the registry from the `CHAT_PRESENCE` setting.
+        connect(user_id, user_name, channel_name): Marks a connection as present.
+        disconnect(user_id, channel_name): Marks a connection as gone.
+        heartbeat(user_id, channel_name): Refreshes the expiry of a present connection.
+        is_online(user_id): Checks if a user has a present connection.
+        expire(now): Removes the connections whose heartbeat expired.
+        flush(): Writes the pending online statuses to the database.
+        metrics(): Returns the presence counters.
+    """
+
+    def __init__(self, heartbeat_ttl = 60, flush_interval = 1):
+        self.heartbeat_ttl = heartbeat_ttl
+        self.flush_interval = flush_interval
+        self._connections = {}
+        self._names = {}
+        self._dirty = {}
+        self._flush_handle = None
+        self._sweep_handle = None
+        self._stats = {
+            'online_transitions': 0,
+            'offline_transitions': 0,
+            'suppressed_events': 0,
+            'expired_connections': 0,
+            'status_writes': 0,
+        }
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the registry from the `CHAT_PRESENCE` setting.
+
+        Returns:
+            PresenceRegistry: The configured registry.
+        """
+        config = getattr(settings, 'CHAT_PRESENCE', {})
+        return cls(
+            heartbeat_ttl = config.get('HEARTBEAT_TTL', 60),
+            flush_interval = config.get('FLUSH_INTERVAL', 1),
+        )
+
+    async def connect(self, user_id, user_name, channel_name):
+        """
+        Marks a connection as present and broadcasts WENT_ONLINE if it is the first one of the user.
+
+        Args:
+            user_id (int): The ID of the user.
+            user_name (str): The username, used for the broadcast.
+            channel_name (str): The channel name of the connection.
+
+        Returns:
+            bool: True if the user went online.
+        """
+        self._ensure_sweeper()
+        connections = self._connections.setdefault(user_id, {})
+        went_online = not connections
+        connections[channel_name] = time.monotonic()
+        self._names[user_id] = user_name
+        if not went_online:
+            self._stats['suppressed_events'] += 1
+            return False
+        self._stats['online_transitions'] += 1
+        self._mark_dirty(user_id, True)
+        await broadcast_presence(user_id, user_name, True)
+        return True
+
+    async def disconnect(self, user_id, channel_name):
+        """
+        Marks a connection as gone and broadcasts WENT_OFFLINE if it was the last one of the user.
+
+        Args:
+            user_id (int): The ID of the user.
+            channel_name (str): The channel name of the connection.
+
+        Returns:
+            bool: True if the user went offline.
+        """
+        connections = self._connections.get(user_id)
+        if not connections or connections.pop(channel_name, None) is None:
+            self._stats['suppressed_events'] += 1
+            return False
+        if connections:
+            self._stats['suppressed_events'] += 1
+            return False
+        await self._went_offline(user_id)
+        return True
+
+    async def heartbeat(self, user_id, channel_name):
+        """
+        Refreshes the expiry of a present connection.
+
+        Heartbeats of connections that are not present, e.g. hidden tabs, are ignored.
+
+        Args:
+            user_id (int): The ID of the user.
+            channel_name (str): The channel name of the connection.
+
+        Returns:
+            bool: True if the connection was present.
+        """
+        connections = self._connections.get(user_id)
+        if not connections or channel_name not in connections:
+            return False
+        connections[channel_name] = time.monotonic()
+        return True
+
+    def is_online(self, user_id):
+        """
+        Checks if a user has a present connection in this process.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            bool: True if the user is online.
+        """
+        return bool(self._connections.get(user_id))
+
+    async def expire(self, now = None):
+        """
+        Removes the connections whose heartbeat expired and takes their users offline.
+
+        Args:
+            now (float): The current `time.monotonic()` value, for tests.
+
+        Returns:
+            list: The IDs of the users that went offline.
+        """
+        deadline = (time.monotonic() if now is None else now) - self.heartbeat_ttl
+        went_offline = []
+        for user_id, connections in list(self._connections.items()):
+            expired = [channel_name for channel_name, last_seen in connections.items() if last_seen < deadline]
+            for channel_name in expired:
+                del connections[channel_name]
+            self._stats['expired_connections'] += len(expired)
+            if expired and not connections:
+                went_offline.append(user_id)
+        for user_id in went_offline:
+            await self._went_offline(user_id)
+        return went_offline
+
+    async def _went_offline(self, user_id):
+        """
+        Records and broadcasts the 1 to 0 transition of a user.
+        """
+        self._connections.pop(user_id, None)
+        user_name = self._names.pop(user_id, None)
+        self._stats['offline_transitions'] += 1
+        self._mark_dirty(user_id, False)
+        await broadcast_presence(user_id, user_name, False)
+
+    def _mark_dirty(self, user_id, is_online):
+        """
+        Queues the online status of a user for the next batched write.
+        """
+        self._dirty[user_id] = is_online
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+
+    def _ensure_sweeper(self):
+        """
+        Starts the periodic heartbeat expiry sweep on the running event loop.
+        """
+        if self._sweep_handle is None:
+            loop = asyncio.get_running_loop()
+            self._sweep_handle = loop.call_later(self.heartbeat_ttl / 3, self._sweep, loop)
+
+    def _sweep(self, loop):
+        """
+        Runs one expiry sweep and schedules the next one.
+        """
+        self._sweep_handle = loop.call_later(self.heartbeat_ttl / 3, self._sweep, loop)
+        loop.create_task(self.expire())
+
+    async def flush(self):
+        """
+        Writes the pending online statuses to the database with at most two updates.
+        """
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, {}
+        if dirty:
+            try:
+                await database_sync_to_async(write_online_status)(await self.current_statuses(dirty))
+            except Exception:
+                logger.exception('Writing the online status of %s users failed', len(dirty))
+                for user_id, is_online in dirty.items():
+                    self._dirty.setdefault(user_id, is_online)
+                return
+            self._stats['status_writes'] += 1
+
+    async def current_statuses(self, statuses):
+        """
+        Returns the online statuses to write for users whose status changed.
+
+        Every transition of this registry happens in this process, so the recorded statuses are current.
+
+        Args:
+            statuses (dict): The online status keyed by user ID, as recorded at the transitions.
+
+        Returns:
+            dict: The online status to write keyed by user ID.
+        """
+        return statuses
+
+    def flush_on_shutdown(self):
+        """
+        Takes every user connected to this process offline in the database when the process exits.
+        """
+        dirty = dict(self._dirty)
+        dirty.update({user_id: False for user_id in self._connections})
+        self._dirty, self._connections = {}, {}
+        if dirty:
+            try:
+                write_online_status(dirty)
+            except Exception:
+                logger.exception('Writing the online status of %s users on shutdown failed', len(dirty))
+
+    def metrics(self):
+        """
+        Returns the presence counters.
+
+        Returns:
+            dict: The number of online users and connections, transitions, suppressed events,
+            expired connections and batched status writes.
+        """
+        stats = dict(self._stats)
+        stats['online_users'] = len(self._connections)
+        stats['connections'] = sum(len(connections) for connections in self._connections.values())
+        stats['pending_status_writes'] = len(self._dirty)
+        return stats
+
+
+PRESENCE_KEY_PREFIX = 'chat:presence:'
+PRESENCE_EXPIRY_KEY = 'chat:presence-expiry'
+PRESENCE_NAMES_KEY = 'chat:presence-names'
+
+# The scripts read the clock of the Redis server, so the hosts of the workers need not agree on the time.
+# The connections of a user are a hash of channel name -> expiry; the expiry sorted set holds every
+# connection as "<user id>|<channel name>" scored by its expiry and is how the sweep finds expired
+# connections whatever worker they belong to. The scripts derive keys from user IDs, so a single
+# Redis server (or a primary with replicas) is required, not Redis Cluster.
+
+PRESENCE_CONNECT_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local connections = redis.call('HGETALL', KEYS[1])
+for i = 1, #connections, 2 do
+    if tonumber(connections[i + 1]) < now then
+        redis.call('HDEL', KEYS[1], connections[i])
+        redis.call('ZREM', KEYS[2], ARGV[1] .. '|' .. connections[i])
+    end
+end
+local went_online = redis.call('HLEN', KEYS[1]) == 0
+local expires_at = now + tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], ARGV[2], expires_at)
+redis.call('ZADD', KEYS[2], expires_at, ARGV[1] .. '|' .. ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+if went_online then
+    return 1
+end
+return 0
+"""
+
+PRESENCE_DISCONNECT_SCRIPT = """
+if redis.call('HDEL', KEYS[1], ARGV[2]) == 0 then
+    return false
+end
+redis.call('ZREM', KEYS[2], ARGV[1] .. '|' .. ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local connections = redis.call('HGETALL', KEYS[1])
+for i = 1, #connections, 2 do
+    if tonumber(connections[i + 1]) < now then
+        redis.call('HDEL', KEYS[1], connections[i])
+        redis.call('ZREM', KEYS[2], ARGV[1] .. '|' .. connections[i])
+    end
+end
+if redis.call('HLEN', KEYS[1]) > 0 then
+    return false
+end
+local user_name = redis.call('HGET', KEYS[3], ARGV[1]) or ''
+redis.call('HDEL', KEYS[3], ARGV[1])
+return user_name
+"""
+
+PRESENCE_HEARTBEAT_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[2]) == 0 then
+    return 0
+end
+local clock = redis.call('TIME')
+local expires_at = tonumber(clock[1]) + tonumber(clock[2]) / 1000000 + tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], ARGV[2], expires_at)
+redis.call('ZADD', KEYS[2], expires_at, ARGV[1] .. '|' .. ARGV[2])
+return 1
+"""
+
+PRESENCE_EXPIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local expired = 0
+local went_offline = {}
+for _, member in ipairs(members) do
+    redis.call('ZREM', KEYS[1], member)
+    local separator = string.find(member, '|', 1, true)
+    local user_id = string.sub(member, 1, separator - 1)
+    local key = ARGV[1] .. user_id
+    if redis.call('HDEL', key, string.sub(member, separator + 1)) == 1 then
+        expired = expired + 1
+        if redis.call('HLEN', key) == 0 then
+            table.insert(went_offline, user_id)
+            table.insert(went_offline, redis.call('HGET', KEYS[2], user_id) or '')
+            redis.call('HDEL', KEYS[2], user_id)
+        end
+    end
+end
+return {#members, expired, went_offline}
+"""
+
+
+class SharedPresenceRegistry(PresenceRegistry):
+    """
+    Tracks the live personal connections of every user across all worker processes, in Redis.
+
+    The connections of a user are kept in Redis instead of the memory of the process, so the
+    0 to 1 and 1 to 0 transitions are decided once for the whole cluster by atomic scripts: a
+    user with tabs connected to different workers goes offline only when the last of them
+    leaves, and exactly one worker broadcasts each transition. The periodic sweep of every
+    worker expires the connections of all workers, so users connected to a worker that died
+    are taken offline by the others within `heartbeat_ttl` seconds. `Profile.is_online` is
+    written with the status found in Redis at flush time, so batched writes of different
+    workers cannot leave a stale status behind. This process still remembers its own
+    connections, to skip heartbeats of connections that are not present and for the metrics.
+
+    Attributes:
+        redis (SharedRedis): The connections to the shared Redis server.
+        expire_batch (int): The maximum number of connections expired by one script call.
+    """
+    expire_batch = 1000
+
+    def __init__(self, redis, heartbeat_ttl = 60, flush_interval = 1):
+        super().__init__(heartbeat_ttl = heartbeat_ttl, flush_interval = flush_interval)
+        self.redis = redis
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the registry from the `CHAT_PRESENCE` setting, sharing the state through `shared_redis`.
+
+        Returns:
+            SharedPresenceRegistry: The configured registry.
+        """
+        config = getattr(settings, 'CHAT_PRESENCE', {})
+        return cls(
+            shared_redis,
+            heartbeat_ttl = config.get('HEARTBEAT_TTL', 60),
+            flush_interval = config.get('FLUSH_INTERVAL', 1),
+        )
+
+    def _keys(self, user_id):
+        """
+        Returns the keys the presence scripts of a user work on.
+        """
+        return [f'{PRESENCE_KEY_PREFIX}{user_id}', PRESENCE_EXPIRY_KEY, PRESENCE_NAMES_KEY]
+
+    async def connect(self, user_id, user_name, channel_name):
+        """
+        Marks a connection as present and broadcasts WENT_ONLINE if the user had no present connection on any worker.
+
+        Args:
+            user_id (int): The ID of the user.
+            user_name (str): The username, used for the broadcasts of any worker.
+            channel_name (str): The channel name of the connection.
+
+        Returns:
+            bool: True if the user went online.
+        """
+        self._ensure_sweeper()
+        self._connections.setdefault(user_id, {})[channel_name] = time.monotonic()
+        went_online = await self.redis.script(PRESENCE_CONNECT_SCRIPT)(keys = self._keys(user_id), args = [user_id, channel_name, self.heartbeat_ttl, user_name])
+        if not went_online:
+            self._stats['suppressed_events'] += 1
+            return False
+        self._stats['online_transitions'] += 1
+        self._mark_dirty(user_id, True)
+        await broadcast_presence(user_id, user_name, True)
+        return True
+
+    async def disconnect(self, user_id, channel_name):
+        """
+        Marks a connection as gone and broadcasts WENT_OFFLINE if it was the last one of the user on any worker.
+
+        Args:
+            user_id (int): The ID of the user.
+            channel_name (str): The channel name of the connection.
+
+        Returns:
+            bool: True if the user went offline.
+        """
+        connections = self._connections.get(user_id)
+        if connections is not None:
+            connections.pop(channel_name, None)
+            if not connections:
+                del self._connections[user_id]
+        user_name = await self.redis.script(PRESENCE_DISCONNECT_SCRIPT)(keys = self._keys(user_id), args = [user_id, channel_name])
+        if user_name is None:
+            self._stats['suppressed_events'] += 1
+            return False
+        await self._went_offline(user_id, user_name)
+        return True
+
+    async def heartbeat(self, user_id, channel_name):
+        """
+        Refreshes the expiry of a present connection of this process.
+
+        Args:
+            user_id (int): The ID of the user.
+            channel_name (str): The channel name of the connection.
+
+        Returns:
+            bool: True if the connection was present.
+        """
+        if channel_name not in self._connections.get(user_id, ()):
+            return False
+        return bool(await self.redis.script(PRESENCE_HEARTBEAT_SCRIPT)(keys = self._keys(user_id), args = [user_id, channel_name, self.heartbeat_ttl]))
+
+    def is_online(self, user_id):
+        """
+        Checks if a user has a present connection on any worker.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            bool: True if the user is online.
+        """
+        return bool(self.redis.sync_client().exists(f'{PRESENCE_KEY_PREFIX}{user_id}'))
+
+    async def expire(self, now = None):
+        """
+        Removes the connections of every worker whose heartbeat expired and takes their users offline.
+
+        Args:
+            now (float): Ignored, expiry is decided with the clock of the Redis server.
+
+        Returns:
+            list: The IDs of the users that went offline.
+        """
+        script = self.redis.script(PRESENCE_EXPIRE_SCRIPT)
+        went_offline = []
+        scanned = self.expire_batch
+        while scanned == self.expire_batch:
+            scanned, expired, users = await script(keys = [PRESENCE_EXPIRY_KEY, PRESENCE_NAMES_KEY], args = [PRESENCE_KEY_PREFIX, self.expire_batch])
+            self._stats['expired_connections'] += expired
+            for user_id, user_name in zip(users[::2], users[1::2]):
+                went_offline.append(int(user_id))
+                await self._went_offline(int(user_id), user_name)
+        return went_offline
+
+    async def _went_offline(self, user_id, user_name = None):
+        """
+        Records and broadcasts the 1 to 0 transition of a user decided in Redis.
+        """
+        self._connections.pop(user_id, None)
+        self._stats['offline_transitions'] += 1
+        self._mark_dirty(user_id, False)
+        await broadcast_presence(user_id, user_name, False)
+
+    async def current_statuses(self, statuses):
+        """
+        Returns the online statuses of users whose status changed, as found in Redis.
+
+        Another worker may have seen a later transition of the same user, so the recorded status
+        is replaced by whether the user has any connection now.
+
+        Args:
+            statuses (dict): The online status keyed by user ID, as recorded at the transitions.
+
+        Returns:
+            dict: The online status to write keyed by user ID.
+        """
+        async with self.redis.client().pipeline(transaction = False) as pipe:
+            for user_id in statuses:
+                pipe.exists(f'{PRESENCE_KEY_PREFIX}{user_id}')
+            present = await pipe.execute()
+        return {user_id: bool(exists) for user_id, exists in zip(statuses, present)}
+
+    def flush_on_shutdown(self):
+        """
+        Writes the pending online statuses when the process exits.
+
+        The connections of this process are left in Redis: the sweep of the remaining workers
+        takes their users offline, and broadcasts it, once their heartbeats expire.
+        """
+        dirty, self._dirty, self._connections = self._dirty, {}, {}
+        if dirty:
+            try:
+                pipe = self.redis.sync_client().pipeline(transaction = False)
+                for user_id in dirty:
+                    pipe.exists(f'{PRESENCE_KEY_PREFIX}{user_id}')
+                write_online_status({user_id: bool(exists) for user_id, exists in zip(dirty, pipe.execute())})
+            except Exception:
+                logger.exception('Writing the online status of %s users on shutdown failed', len(dirty))
+
+def write_online_status(statuses):
+    """
+    Writes online statuses to `Profile.is_online`.
+
+    Args:
+        statuses (dict): The online status keyed by user ID.
+    """
+    from .models import Profile
+    for is_online in (True, False):
+        user_ids = [user_id for user_id, status in statuses.items() if status is is_online]
+        if user_ids:
+            Profile.objects.filter(user__id__in = user_ids).update(is_online = is_online)
+
+
+async def broadcast_presence(user_id, user_name, is_online):
+    """
+    Notifies the personal rooms of the friends of a user that the user went online or offline.
+
+    The WENT_ONLINE or WENT_OFFLINE frame is encoded once and sent to every friend.
+
+    Args:
+        user_id (int): The ID of the user.
+        user_name (str): The username shown to the friends.
+        is_online (bool): True if the user went online, False if offline.
+    """
+    friend_ids = cached_friend_ids(user_id)
+    if friend_ids is None:
+        friend_ids = await database_sync_to_async(get_friend_ids)(user_id)
+    channel_layer = get_channel_layer()
+    event = frame_event('user_online' if is_online else 'user_offline', {
+        'msg_type': 'WENT_ONLINE' if is_online else 'WENT_OFFLINE',
+        'user_name': user_name
+    })
+    for friend_id in friend_ids:
+        await channel_layer.group_send(f'personal__{friend_id}', event)
+
+
+presence = SharedPresenceRegistry.from_settings() if shared_redis.enabled else PresenceRegistry.from_settings()
+atexit.register(presence.flush_on_shutdown)
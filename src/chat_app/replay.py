@@ -0,0 +1,287 @@
+import asyncio
+from collections import deque
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Max
+from .cache import LRUCache
+from .cluster import shared_redis
+
+
+def stored_last_seq(session_id):
+    """
+    Returns the highest sequence number stored for the events of a chat session.
+
+    Sequence numbers are stored on the messages and on the unread counters (for the read
+    events that moved a watermark), so the highest one is the last event that reached the database.
+
+    Args:
+        session_id (int): The ID of the chat session.
+
+    Returns:
+        int: The highest stored sequence number, 0 if no event has been stored.
+    """
+    from .models import ChatMessage, UnreadCounter
+    message_seq = ChatMessage.objects.filter(chat_session_id = session_id).aggregate(seq = Max('seq'))['seq']
+    read_seq = UnreadCounter.objects.filter(chat_session_id = session_id).aggregate(seq = Max('last_read_seq'))['seq']
+    return max(message_seq or 0, read_seq or 0)
+
+
+class RoomSequencer:
+    """
+    Hands out monotonic per-room sequence numbers in this process.
+
+    The counter of a room is seeded from the database the first time the room is used, then
+    incremented in memory. The counters of the least recently used rooms are evicted beyond
+    `maxsize` rooms and re-seeded on their next use.
+
+    Attributes:
+        maxsize (int): The maximum number of rooms whose counter is kept.
+
+    Methods:
+        next(session_id): Returns the next sequence number of a room.
+        current(session_id): Returns the last sequence number handed out for a room, if known.
+    """
+
+    def __init__(self, maxsize = 10000):
+        self.maxsize = maxsize
+        self._counters = LRUCache(maxsize)
+        self._seeding = {}
+
+    async def next(self, session_id):
+        """
+        Returns the next sequence number of a room, seeding its counter from the database if needed.
+
+        Args:
+            session_id (int): The ID of the chat session.
+
+        Returns:
+            int: The sequence number of the new event.
+        """
+        session_id = int(session_id)
+        if self._counters.get(session_id) is None:
+            seeding = self._seeding.get(session_id)
+            if seeding is None:
+                seeding = self._seeding[session_id] = asyncio.ensure_future(database_sync_to_async(stored_last_seq)(session_id))
+            try:
+                seed = await seeding
+            finally:
+                self._seeding.pop(session_id, None)
+            if self._counters.get(session_id) is None:
+                self._counters.set(session_id, [seed])
+        counter = self._counters.get(session_id)
+        counter[0] += 1
+        return counter[0]
+
+    def current(self, session_id):
+        """
+        Returns the last sequence number handed out for a room by this process.
+
+        Args:
+            session_id (int): The ID of the chat session.
+
+        Returns:
+            int or None: The last sequence number, or None if the room has no counter in this process.
+        """
+        counter = self._counters.get(int(session_id))
+        return counter[0] if counter else None
+
+
+SEQUENCE_KEY_PREFIX = 'chat:seq:'
+
+# Returns nothing if the counter of the room is unknown and no seed was passed.
+NEXT_SEQUENCE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[1] == '' then
+        return false
+    end
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+local seq = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return seq
+"""
+
+
+class SharedRoomSequencer:
+    """
+    Hands out monotonic per-room sequence numbers shared by all worker processes, from Redis.
+
+    The counter of a room is a Redis key seeded from the database by the first worker that
+    needs it, then incremented atomically, so events of the same room sent through different
+    workers never share a sequence number. A counter unused for `ttl` seconds expires and is
+    re-seeded from the database, which by then holds every event it handed out.
+
+    Attributes:
+        redis (SharedRedis): The connections to the shared Redis server.
+        ttl (int): Seconds an unused counter is kept.
+
+    Methods:
+        next(session_id): Returns the next sequence number of a room.
+        current(session_id): Returns the last sequence number handed out for a room, if known.
+    """
+
+    def __init__(self, redis, ttl = 86400):
+        self.redis = redis
+        self.ttl = ttl
+
+    async def next(self, session_id):
+        """
+        Returns the next sequence number of a room, seeding its counter from the database if needed.
+
+        Args:
+            session_id (int): The ID of the chat session.
+
+        Returns:
+            int: The sequence number of the new event.
+        """
+        key = f'{SEQUENCE_KEY_PREFIX}{int(session_id)}'
+        script = self.redis.script(NEXT_SEQUENCE_SCRIPT)
+        seq = await script(keys = [key], args = ['', self.ttl])
+        if seq is None:
+            seed = await database_sync_to_async(stored_last_seq)(int(session_id))
+            seq = await script(keys = [key], args = [seed, self.ttl])
+        return seq
+
+    def current(self, session_id):
+        """
+        Returns the last sequence number handed out for a room by any worker.
+
+        Args:
+            session_id (int): The ID of the chat session.
+
+        Returns:
+            int or None: The last sequence number, or None if the room has no counter in Redis.
+        """
+        seq = self.redis.sync_client().get(f'{SEQUENCE_KEY_PREFIX}{int(session_id)}')
+        return int(seq) if seq is not None else None
+
+class ReplayBuffer:
+    """
+    Keeps the most recent sequenced events of the active rooms of this process.
+
+    Every room has a ring buffer of at most `size` events, in sequence order. A room is only able to
+    replay from memory if its oldest buffered event directly follows the position of the client and
+    no event after that position is missing from the buffer. At most `max_rooms` rooms are kept, the least recently used ones are dropped.
+
+    Attributes:
+        size (int): The maximum number of events kept per room.
+        max_rooms (int): The maximum number of rooms kept.
+
+    Methods:
+        from_settings(): Creates the buffer from the `CHAT_REPLAY` setting.
+        record(session_id, seq, frame): Stores an event of a room.
+        since(session_id, last_seq): Returns the events after a position if they are all buffered.
+        metrics(): Returns the replay counters.
+    """
+
+    def __init__(self, size = 256, max_rooms = 10000):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = LRUCache(max_rooms)
+        self._stats = {'recorded_events': 0, 'memory_replays': 0, 'database_replays': 0}
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the buffer from the `CHAT_REPLAY` setting.
+
+        Returns:
+            ReplayBuffer: The configured buffer.
+        """
+        config = getattr(settings, 'CHAT_REPLAY', {})
+        return cls(size = config.get('BUFFER_SIZE', 256), max_rooms = config.get('MAX_ROOMS', 10000))
+
+    def record(self, session_id, seq, frame):
+        """
+        Stores an event of a room unless it is already buffered.
+
+        Events usually arrive in sequence order and are appended. When an event arrives after a
+        gap, the skipped sequence numbers are remembered as missing until they arrive late (and
+        are inserted at their position) or fall out of the buffer. A gap larger than the buffer,
+        e.g. because no connection of this process was in the room for a while, restarts the
+        buffer at the new event.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            seq (int): The sequence number of the event.
+            frame (tuple): The event as sent to the clients, in every encoding.
+        """
+        session_id = int(session_id)
+        room = self._rooms.get(session_id)
+        if room is None:
+            room = (deque(maxlen = self.size), set())
+            self._rooms.set(session_id, room)
+        events, missing = room
+        if events and seq <= events[-1][0]:
+            if seq not in missing:
+                return
+            missing.discard(seq)
+            if len(events) == self.size:
+                events.popleft()
+            position = next(index for index, (event_seq, event) in enumerate(events) if event_seq > seq)
+            events.insert(position, (seq, frame))
+        else:
+            if events and seq - events[-1][0] > self.size:
+                events.clear()
+                missing.clear()
+            elif events:
+                missing.update(range(events[-1][0] + 1, seq))
+            events.append((seq, frame))
+        if missing:
+            missing.difference_update([missing_seq for missing_seq in missing if missing_seq < events[0][0]])
+        self._stats['recorded_events'] += 1
+
+    def since(self, session_id, last_seq):
+        """
+        Returns the buffered events of a room after a position.
+
+        Args:
+            session_id (int): The ID of the chat session.
+            last_seq (int): The sequence number of the last event the client has seen.
+
+        Returns:
+            list or None: The (seq, frame) pairs after `last_seq` in sequence order, or None if
+            the buffer does not hold every event after `last_seq` and the database must be used.
+        """
+        room = self._rooms.get(int(session_id))
+        if room is None or not room[0] or room[0][0][0] > last_seq + 1 or any(seq > last_seq for seq in room[1]):
+            self._stats['database_replays'] += 1
+            return None
+        self._stats['memory_replays'] += 1
+        return [(seq, frame) for seq, frame in room[0] if seq > last_seq]
+
+    def metrics(self):
+        """
+        Returns the replay counters.
+
+        Returns:
+            dict: The number of recorded events, of replays served from memory and from the
+            database, and of buffered rooms.
+        """
+        return dict(self._stats, rooms = len(self._rooms))
+
+
+def stored_events_since(session_id, last_seq, limit):
+    """
+    Loads the stored events of a chat session after a position, for gaps the replay buffer cannot serve.
+
+    Messages are read from the (chat_session, seq) index. Read events are represented by the
+    current watermark of each participant whose watermark was last moved after the position.
+
+    Args:
+        session_id (int): The ID of the chat session.
+        last_seq (int): The sequence number of the last event the client has seen.
+        limit (int): The maximum number of messages to load.
+
+    Returns:
+        tuple: The messages (ChatMessage) and the unread counters (UnreadCounter) carrying the events,
+        and a boolean that is True if more than `limit` messages are missing.
+    """
+    from .models import ChatMessage, UnreadCounter
+    messages = list(ChatMessage.objects.filter(chat_session_id = session_id, seq__gt = last_seq).select_related('user').order_by('seq')[:limit + 1])
+    counters = list(UnreadCounter.objects.filter(chat_session_id = session_id, last_read_seq__gt = last_seq).select_related('user'))
+    return messages[:limit], counters, len(messages) > limit
+
+
+room_sequencer = SharedRoomSequencer(shared_redis) if shared_redis.enabled else RoomSequencer(getattr(settings, 'CHAT_REPLAY', {}).get('MAX_ROOMS', 10000))
+replay_buffer = ReplayBuffer.from_settings()
@@ -0,0 +1,236 @@
+import math
+import re
+import threading
+from collections import Counter, namedtuple
+from django.db import connection
+from django.db.models import Q, BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+from .models import ChatMessage, ChatSession
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Must match the expression of the `chat_msg_fts_idx` GIN index created by the migrations.
+SEARCH_VECTOR_SQL = "to_tsvector('simple', COALESCE(\"chat_app_chatmessage\".\"message_detail\" ->> 'msg', ''))"
+
+
+def tokenize(text):
+    """
+    Splits a text into lower-cased word tokens with their positions.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: (token, start, end) tuples, where `start` and `end` are character offsets into the text.
+    """
+    return [(match.group().lower(), match.start(), match.end()) for match in TOKEN_RE.finditer(text or '')]
+
+
+def query_terms(query):
+    """
+    Returns the distinct search terms of a query in the order they appear.
+
+    Args:
+        query (str): The search query entered by the user.
+
+    Returns:
+        list: The lower-cased terms.
+    """
+    return list(dict.fromkeys(token for token, start, end in tokenize(query)))
+
+
+def highlight_offsets(text, terms):
+    """
+    Returns the character ranges of a text that match the search terms.
+
+    Args:
+        text (str): The text of a message.
+        terms (iterable): The lower-cased search terms.
+
+    Returns:
+        list: [start, end] pairs of character offsets, in text order.
+    """
+    terms = set(terms)
+    return [[start, end] for token, start, end in tokenize(text) if token in terms]
+
+
+class SearchHit(namedtuple('SearchHit', ['message', 'rank', 'highlights'])):
+    """
+    A message matching a search.
+
+    Attributes:
+        message (ChatMessage): The matching message.
+        rank (float): The relevance of the message, higher is better.
+        highlights (list): [start, end] character offsets of the matched terms in the message text.
+    """
+    __slots__ = ()
+
+
+class InvertedIndex:
+    """
+    An in-process inverted index over the text of chat messages.
+
+    This is the search backend for databases without full-text indexes (e.g. SQLite test setups).
+    The index is built from the database on the first search and then kept up to date
+    incrementally as `ChatMessage.persist_messages` stores new messages. Messages stored before the
+    first search are never indexed twice because incremental updates are ignored until the index
+    is built. Every process keeps its own index.
+
+    Methods:
+        add(messages): Indexes newly stored messages.
+        build(): Indexes every stored message.
+        search(terms, session_ids, after, limit): Returns the best ranked messages containing every term.
+        clear(): Drops the index; it is rebuilt on the next search.
+        metrics(): Returns the size of the index.
+    """
+
+    def __init__(self):
+        self._postings = {}     # token -> {message id: term frequency}
+        self._documents = {}    # message id -> (chat session id, number of tokens)
+        self._built = False
+        self._lock = threading.RLock()
+
+    def add(self, messages):
+        """
+        Indexes newly stored messages.
+
+        Args:
+            messages (iterable): ChatMessage instances.
+        """
+        with self._lock:
+            if not self._built:
+                return
+            for msg in messages:
+                self._add(str(msg.id), msg.chat_session_id, msg.message_detail.get('msg', ''))
+
+    def _add(self, msg_id, session_id, text):
+        if msg_id in self._documents:
+            return
+        tokens = Counter(token for token, start, end in tokenize(str(text)))
+        self._documents[msg_id] = (session_id, sum(tokens.values()))
+        for token, frequency in tokens.items():
+            self._postings.setdefault(token, {})[msg_id] = frequency
+
+    def build(self):
+        """
+        Indexes every stored message unless the index has already been built.
+        """
+        with self._lock:
+            if self._built:
+                return
+            for row in ChatMessage.objects.order_by().values('id', 'chat_session_id', 'message_detail').iterator():
+                self._add(str(row['id']), row['chat_session_id'], (row['message_detail'] or {}).get('msg', ''))
+            self._built = True
+
+    def search(self, terms, session_ids, after = None, limit = 20):
+        """
+        Returns the best ranked messages that contain every search term.
+
+        Messages are ranked by the sum of the TF-IDF weights of the terms, normalized by the
+        length of the message, and ordered by (rank, message id) descending.
+
+        Args:
+            terms (list): The lower-cased search terms.
+            session_ids (set): The chat sessions the search is restricted to.
+            after (tuple): The (rank, message id) position of the last hit of the previous page, or None.
+            limit (int): The maximum number of hits to return.
+
+        Returns:
+            list: (message id, rank) pairs.
+        """
+        self.build()
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not postings or not all(postings):
+                return []
+            postings.sort(key = len)
+            total = len(self._documents)
+            hits = []
+            for msg_id in postings[0]:
+                session_id, length = self._documents[msg_id]
+                if session_id not in session_ids or not all(msg_id in posting for posting in postings[1:]):
+                    continue
+                rank = sum(posting[msg_id] * math.log(1 + total / len(posting)) for posting in postings) / (1 + math.log(length))
+                hits.append((msg_id, rank))
+        if after is not None:
+            hits = [hit for hit in hits if (hit[1], hit[0]) < after]
+        hits.sort(key = lambda hit: (hit[1], hit[0]), reverse = True)
+        return hits[:limit]
+
+    def clear(self):
+        """
+        Drops the index; it is rebuilt on the next search.
+        """
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._built = False
+
+    def metrics(self):
+        """
+        Returns the size of the index.
+
+        Returns:
+            dict: The number of indexed messages and distinct terms.
+        """
+        with self._lock:
+            return {'built': self._built, 'documents': len(self._documents), 'terms': len(self._postings)}
+
+
+message_index = InvertedIndex()
+
+
+def uses_database_search():
+    """
+    Returns whether message search is served by the PostgreSQL full-text index.
+
+    Returns:
+        bool: True on PostgreSQL, False if the in-process index is used.
+    """
+    return connection.vendor == 'postgresql'
+
+
+def search_messages(user, query, after = None, limit = 20):
+    """
+    Searches the messages of the chat sessions of a user.
+
+    A message matches when its text contains every term of the query. On PostgreSQL the match
+    and the rank (`ts_rank`) are computed with the `chat_msg_fts_idx` GIN index, elsewhere with
+    the in-process `message_index`. Hits are ordered by (rank, message id) descending, which is
+    also the keyset of the pagination.
+
+    Args:
+        user (User): The user searching; only the chat sessions of this user are searched.
+        query (str): The search query.
+        after (tuple): The (rank, message id) position of the last hit of the previous page, or None.
+        limit (int): The maximum number of hits of the page.
+
+    Returns:
+        tuple: The SearchHit objects of the page and the (rank, message id) position to request
+        the next page with, or None if there are no further hits.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], None
+    sessions = ChatSession.objects.filter(Q(user1 = user) | Q(user2 = user))
+    if uses_database_search():
+        tsquery = ' '.join(terms)
+        messages = (ChatMessage.objects.filter(chat_session__in = sessions.values('id')).select_related('user')
+                    .filter(RawSQL(f"{SEARCH_VECTOR_SQL} @@ plainto_tsquery('simple', %s)", (tsquery,), output_field = BooleanField()))
+                    # ts_rank returns a real; as float8 the rank in the cursor compares equal to the stored one
+                    .annotate(rank = RawSQL(f"ts_rank({SEARCH_VECTOR_SQL}, plainto_tsquery('simple', %s))::float8", (tsquery,), output_field = FloatField()))
+                    .order_by('-rank', '-id'))
+        if after is not None:
+            rank, msg_id = after
+            messages = messages.filter(Q(rank__lt = rank) | Q(rank = rank, id__lt = msg_id))
+        ranked = [(msg, msg.rank) for msg in messages[:limit + 1]]
+    else:
+        hits = message_index.search(terms, set(sessions.values_list('id', flat = True)), after = after, limit = limit + 1)
+        found = {str(msg.id): msg for msg in ChatMessage.objects.filter(id__in = [msg_id for msg_id, rank in hits]).select_related('user')}
+        ranked = [(found[msg_id], rank) for msg_id, rank in hits if msg_id in found]
+    next_position = None
+    if len(ranked) > limit:
+        ranked = ranked[:limit]
+        next_position = (ranked[-1][1], str(ranked[-1][0].id))
+    page = [SearchHit(msg, rank, highlight_offsets(str(msg.message_detail.get('msg', '')), terms)) for msg, rank in ranked]
+    return page, next_position
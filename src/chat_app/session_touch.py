@@ -0,0 +1,106 @@
+import atexit
+import threading
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+
+class SessionTouchBuffer:
+    """
+    Coalesces the `updated_on` bumps of chat sessions.
+
+    Every persisted message used to re-save its `ChatSession` only to refresh `updated_on`, which
+    costs two queries per message and contends on the row lock of busy sessions. Instead, the ids
+    of touched sessions are recorded in memory and written with a single
+    `UPDATE ... WHERE id IN (...)` at most `interval` seconds later. `updated_on`, and therefore the
+    ordering of the friend list, lags behind the newest message by at most `interval` seconds.
+
+    Attributes:
+        interval (float): The maximum staleness of `updated_on` in seconds. With 0 or less every
+            touch is written immediately.
+
+    Methods:
+        from_settings(): Creates the buffer from the `CHAT_SESSION_TOUCH_INTERVAL` setting.
+        touch(*session_ids): Marks chat sessions as updated.
+        flush(): Writes every pending touch.
+    """
+
+    def __init__(self, interval = 2.0):
+        self.interval = interval
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the buffer from the `CHAT_SESSION_TOUCH_INTERVAL` setting.
+
+        Returns:
+            SessionTouchBuffer: The configured buffer.
+        """
+        return cls(getattr(settings, 'CHAT_SESSION_TOUCH_INTERVAL', 2.0))
+
+    def touch(self, *session_ids):
+        """
+        Marks chat sessions as updated.
+
+        Args:
+            *session_ids (int): The IDs of the chat sessions that received a message.
+        """
+        if self.interval <= 0:
+            self._write(set(session_ids))
+            return
+        self._schedule(session_ids)
+
+    def flush(self):
+        """
+        Writes every pending touch with one update.
+
+        If the update fails, the session ids are put back so that the next flush retries them.
+        """
+        with self._lock:
+            session_ids, self._dirty = self._dirty, set()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        try:
+            self._write(session_ids)
+        except Exception:
+            self._schedule(session_ids)
+            raise
+
+    def _schedule(self, session_ids):
+        """
+        Records pending touches and starts the flush timer if it is not running.
+        """
+        if not session_ids:
+            return
+        with self._lock:
+            self._dirty.update(session_ids)
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_from_timer(self):
+        """
+        Flushes from the timer thread and releases the database connection of that thread.
+        """
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def _write(self, session_ids):
+        """
+        Bumps `updated_on` of the given chat sessions.
+        """
+        if not session_ids:
+            return
+        from .models import ChatSession
+        ChatSession.objects.filter(id__in = session_ids).update(updated_on = timezone.now())
+
+
+session_touches = SessionTouchBuffer.from_settings()
+atexit.register(session_touches.flush)
@@ -1,6 +1,7 @@
 from django.dispatch.dispatcher import receiver
-from django.db.models.signals import post_save
-from .models import ChatSession,ChatMessage,Profile
+from django.db.models.signals import post_save, post_delete
+from .models import ChatSession,ChatMessage,Profile,InboxEntry
+from .cache import get_session_participants, invalidate_friend_ids, invalidate_participants, clear_participants
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 
@@ -30,6 +31,22 @@ def sender_receiver_no_same(sender, instance, created, **kwargs):
             raise ValidationError("Sender and Receiver are not same!!", code='Invalid')
 
 
+@receiver(post_save,sender=ChatSession)
+def create_inbox_entries(sender, instance, created, **kwargs):
+    """
+    Creates the inbox rows of both participants after saving a new chat session.
+
+    Args:
+        sender (Model): The model class that sent the signal, which is `ChatSession`.
+        instance (ChatSession): The instance of the `ChatSession` model that was saved.
+        created (bool): A boolean indicating whether the instance was created or updated.
+        **kwargs: Additional keyword arguments.
+
+    """
+    if created:
+        InboxEntry.create_for_session(instance)
+
+
 @receiver(post_save,sender=User)
 def at_ending_save(sender, instance, created, **kwargs):
     """
@@ -59,8 +76,9 @@ def user_must_sender_or_receiver(sender, instance, created, **kwargs):
 
     This signal receiver function is triggered after a new `ChatMessage` instance
     is saved. It checks if the message sender is either the sender or receiver of
-    the associated chat session. If not, it raises a ValidationError to indicate
-    that the sender must be one of the participants of the chat session.
+    the associated chat session, using the cached participants of the chat session.
+    If not, it raises a ValidationError to indicate that the sender must be one of
+    the participants of the chat session.
 
     Args:
         sender (Model): The model class that sent the signal, which is `ChatMessage`.
@@ -73,5 +91,62 @@ def user_must_sender_or_receiver(sender, instance, created, **kwargs):
 
     """
     if created:
-        if instance.user != instance.chat_session.user1 and instance.user != instance.chat_session.user2:
-            raise ValidationError("Invalid sender!!", code='Invalid')
\ No newline at end of file
+        participants = get_session_participants(instance.chat_session_id)
+        if participants is None or not participants.includes(instance.user_id):
+            raise ValidationError("Invalid sender!!", code='Invalid')
+
+
+@receiver(post_save,sender=ChatSession)
+@receiver(post_delete,sender=ChatSession)
+def invalidate_session_participants(sender, instance, **kwargs):
+    """
+    Removes a chat session from the participant cache when it is saved or deleted.
+
+    Args:
+        sender (Model): The model class that sent the signal, which is `ChatSession`.
+        instance (ChatSession): The chat session that was saved or deleted.
+        **kwargs: Additional keyword arguments.
+
+    """
+    invalidate_participants(instance.id)
+
+
+@receiver(post_save,sender=ChatSession)
+@receiver(post_delete,sender=ChatSession)
+def invalidate_friend_index(sender, instance, created=True, **kwargs):
+    """
+    Removes the cached chat partners of both participants when a chat session is created or deleted.
+
+    The invalidation is published to every worker process, however the chat session was created
+    (e.g. `ChatSession.get_or_create_pair` or the admin). Updates of existing chat sessions, such as
+    the coalesced `updated_on` bumps, keep the cache.
+
+    Args:
+        sender (Model): The model class that sent the signal, which is `ChatSession`.
+        instance (ChatSession): The chat session that was created or deleted.
+        created (bool): A boolean indicating whether the instance was created or updated; True for deletions.
+        **kwargs: Additional keyword arguments.
+
+    """
+    if created:
+        invalidate_friend_ids(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_save,sender=User)
+def invalidate_participant_names(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Clears the participant cache when the username of an existing user may have changed.
+
+    Saves limited to other fields, such as the `last_login` update performed on every login,
+    keep the cache.
+
+    Args:
+        sender (Model): The model class that sent the signal, which is `User`.
+        instance (User): The user that was saved.
+        created (bool): A boolean indicating whether the instance was created or updated.
+        update_fields (frozenset): The fields passed to `save()`, or None if every field was saved.
+        **kwargs: Additional keyword arguments.
+
+    """
+    if not created and (update_fields is None or 'username' in update_fields):
+        clear_participants()
@@ -0,0 +1,266 @@
+/**
+ * MessagePack encoder and decoder for the binary WebSocket protocol of the chat.
+ *
+ * Served from the static files of the app instead of a CDN. Exposes `MessagePack.encode(value)`,
+ * returning a Uint8Array, and `MessagePack.decode(bytes)`, the subset of the `@msgpack/msgpack`
+ * API the chat uses. Supports nil, booleans, integers, floats, strings, binary (Uint8Array),
+ * arrays and maps; integers beyond 2^53 lose precision and extension types are rejected.
+ */
+(function (root) {
+    'use strict';
+
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    /**
+     * Growable output buffer.
+     */
+    class Writer {
+        constructor() {
+            this.bytes = new Uint8Array(256);
+            this.view = new DataView(this.bytes.buffer);
+            this.pos = 0;
+        }
+
+        reserve(size) {
+            if (this.pos + size <= this.bytes.length) {
+                return
+            }
+            let length = this.bytes.length * 2;
+            while (length < this.pos + size) {
+                length *= 2;
+            }
+            const bytes = new Uint8Array(length);
+            bytes.set(this.bytes);
+            this.bytes = bytes;
+            this.view = new DataView(bytes.buffer);
+        }
+
+        u8(value) {
+            this.reserve(1);
+            this.view.setUint8(this.pos, value);
+            this.pos += 1;
+        }
+
+        u16(value) {
+            this.reserve(2);
+            this.view.setUint16(this.pos, value);
+            this.pos += 2;
+        }
+
+        u32(value) {
+            this.reserve(4);
+            this.view.setUint32(this.pos, value);
+            this.pos += 4;
+        }
+
+        u64(value) {
+            this.u32(Math.floor(value / 0x100000000));
+            this.u32(value >>> 0);
+        }
+
+        i64(value) {
+            const high = Math.floor(value / 0x100000000);
+            this.reserve(8);
+            this.view.setInt32(this.pos, high);
+            this.view.setUint32(this.pos + 4, value - high * 0x100000000);
+            this.pos += 8;
+        }
+
+        f64(value) {
+            this.reserve(8);
+            this.view.setFloat64(this.pos, value);
+            this.pos += 8;
+        }
+
+        raw(bytes) {
+            this.reserve(bytes.length);
+            this.bytes.set(bytes, this.pos);
+            this.pos += bytes.length;
+        }
+    }
+
+    const encodeInteger = (writer, value) => {
+        if (value >= 0) {
+            if (value < 0x80) {
+                writer.u8(value);
+            } else if (value < 0x100) {
+                writer.u8(0xcc);
+                writer.u8(value);
+            } else if (value < 0x10000) {
+                writer.u8(0xcd);
+                writer.u16(value);
+            } else if (value < 0x100000000) {
+                writer.u8(0xce);
+                writer.u32(value);
+            } else {
+                writer.u8(0xcf);
+                writer.u64(value);
+            }
+        } else if (value >= -0x20) {
+            writer.u8(value & 0xff);
+        } else if (value >= -0x80) {
+            writer.u8(0xd0);
+            writer.u8(value & 0xff);
+        } else if (value >= -0x8000) {
+            writer.u8(0xd1);
+            writer.u16(value & 0xffff);
+        } else if (value >= -0x80000000) {
+            writer.u8(0xd2);
+            writer.u32(value >>> 0);
+        } else {
+            writer.u8(0xd3);
+            writer.i64(value);
+        }
+    };
+
+    const encodeHeader = (writer, length, fix, fixLimit, codes) => {
+        if (fix !== null && length < fixLimit) {
+            writer.u8(fix | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            writer.u8(codes[0]);
+            writer.u8(length);
+        } else if (length < 0x10000) {
+            writer.u8(codes[1]);
+            writer.u16(length);
+        } else {
+            writer.u8(codes[2]);
+            writer.u32(length);
+        }
+    };
+
+    const encodeValue = (writer, value) => {
+        if (value === null || value === undefined) {
+            writer.u8(0xc0);
+        } else if (value === false) {
+            writer.u8(0xc2);
+        } else if (value === true) {
+            writer.u8(0xc3);
+        } else if (typeof value === 'number') {
+            if (Number.isSafeInteger(value)) {
+                encodeInteger(writer, value);
+            } else {
+                writer.u8(0xcb);
+                writer.f64(value);
+            }
+        } else if (typeof value === 'string') {
+            const bytes = textEncoder.encode(value);
+            encodeHeader(writer, bytes.length, 0xa0, 32, [0xd9, 0xda, 0xdb]);
+            writer.raw(bytes);
+        } else if (value instanceof Uint8Array) {
+            encodeHeader(writer, value.length, null, 0, [0xc4, 0xc5, 0xc6]);
+            writer.raw(value);
+        } else if (Array.isArray(value)) {
+            encodeHeader(writer, value.length, 0x90, 16, [null, 0xdc, 0xdd]);
+            value.forEach(item => encodeValue(writer, item));
+        } else if (typeof value === 'object') {
+            const entries = Object.entries(value).filter(([key, item]) => item !== undefined);
+            encodeHeader(writer, entries.length, 0x80, 16, [null, 0xde, 0xdf]);
+            entries.forEach(([key, item]) => {
+                encodeValue(writer, key);
+                encodeValue(writer, item);
+            });
+        } else {
+            throw new TypeError('MessagePack cannot encode a ' + typeof value);
+        }
+    };
+
+    /**
+     * Encodes a value.
+     * @param {*} value - The value.
+     * @returns {Uint8Array} The encoding.
+     */
+    const encode = (value) => {
+        const writer = new Writer();
+        encodeValue(writer, value);
+        return writer.bytes.slice(0, writer.pos)
+    };
+
+    /**
+     * Decodes the value encoded in a byte array.
+     * @param {Uint8Array} bytes - The encoding of a single value.
+     * @returns {*} The value.
+     */
+    const decode = (bytes) => {
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+
+        const take = (size) => {
+            if (pos + size > bytes.length) {
+                throw new RangeError('MessagePack data is truncated');
+            }
+            const start = pos;
+            pos += size;
+            return start
+        };
+        const u8 = () => view.getUint8(take(1));
+        const u16 = () => view.getUint16(take(2));
+        const u32 = () => view.getUint32(take(4));
+        const str = (length) => textDecoder.decode(bytes.subarray(take(length), pos));
+        const bin = (length) => bytes.slice(take(length), pos);
+        const array = (length) => {
+            const items = new Array(length);
+            for (let i = 0; i < length; i++) {
+                items[i] = value();
+            }
+            return items
+        };
+        const map = (length) => {
+            const items = {};
+            for (let i = 0; i < length; i++) {
+                const key = value();
+                items[key] = value();
+            }
+            return items
+        };
+
+        const value = () => {
+            const code = u8();
+            if (code < 0x80) {
+                return code
+            } else if (code < 0x90) {
+                return map(code & 0x0f)
+            } else if (code < 0xa0) {
+                return array(code & 0x0f)
+            } else if (code < 0xc0) {
+                return str(code & 0x1f)
+            } else if (code >= 0xe0) {
+                return code - 0x100
+            }
+            switch (code) {
+                case 0xc0: return null
+                case 0xc2: return false
+                case 0xc3: return true
+                case 0xc4: return bin(u8())
+                case 0xc5: return bin(u16())
+                case 0xc6: return bin(u32())
+                case 0xca: return view.getFloat32(take(4))
+                case 0xcb: return view.getFloat64(take(8))
+                case 0xcc: return u8()
+                case 0xcd: return u16()
+                case 0xce: return u32()
+                case 0xcf: return u32() * 0x100000000 + u32()
+                case 0xd0: return view.getInt8(take(1))
+                case 0xd1: return view.getInt16(take(2))
+                case 0xd2: return view.getInt32(take(4))
+                case 0xd3: return view.getInt32(take(4)) * 0x100000000 + u32()
+                case 0xd9: return str(u8())
+                case 0xda: return str(u16())
+                case 0xdb: return str(u32())
+                case 0xdc: return array(u16())
+                case 0xdd: return array(u32())
+                case 0xde: return map(u16())
+                case 0xdf: return map(u32())
+            }
+            throw new TypeError('MessagePack type 0x' + code.toString(16) + ' is not supported');
+        };
+
+        const result = value();
+        if (pos !== bytes.length) {
+            throw new RangeError('MessagePack data has trailing bytes');
+        }
+        return result
+    };
+
+    root.MessagePack = {encode, decode};
+})(typeof window !== 'undefined' ? window : globalThis);
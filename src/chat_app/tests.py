@@ -0,0 +1,1283 @@
+import asyncio
+import base64
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_channel.local_layer import LocalChannelLayer
+from .cache import friend_index, get_friend_ids, session_participants
+from .management.commands.bench_channel_layer import RedisServer
+from .models import ChatSession, ChatMessage, Profile, UnreadCounter, UnreadState
+from .presence import PresenceRegistry
+from .replay import ReplayBuffer, RoomSequencer, replay_buffer, room_sequencer
+from .routing import websocket_urlpatterns
+from .search import message_index
+from .session_touch import SessionTouchBuffer, session_touches
+from .typing_indicator import TypingTracker
+from .unread_push import UnreadPusher
+from .write_behind import MessageWriteBehind
+
+
+def setUpModule():
+    # Write session touches inline, the flush timer would otherwise fire between tests
+    setUpModule.interval, session_touches.interval = session_touches.interval, 0
+
+
+def tearDownModule():
+    session_touches.interval = setUpModule.interval
+
+
+def reset_process_state():
+    """
+    Drops the per-process caches and room state keyed by database ids.
+
+    TransactionTestCase empties the tables without sending signals, and SQLite hands out the
+    same ids again, so state left by an earlier test would describe the rows of the next one.
+    """
+    friend_index.clear()
+    session_participants.clear()
+    if isinstance(room_sequencer, RoomSequencer):
+        room_sequencer._counters.clear()
+    replay_buffer._rooms.clear()
+
+
+class FriendListQueryCountTest(TestCase):
+    """
+    Ensures the friend list is built with a constant number of queries.
+
+    The request itself costs two queries (the session and the authenticated user); the
+    friend list, including unread counts and profiles, must be a single query on top of that.
+    """
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.client.login(username='owner', password='secret')
+
+    def add_friends(self, count):
+        """
+        Creates chat sessions with `count` new friends, each with one unread message for the owner.
+        """
+        start = User.objects.count()
+        for i in range(count):
+            friend = User.objects.create_user(f'friend_{start + i}', password='secret')
+            ch_session = ChatSession.create_if_not_exists(self.owner, friend)
+            ChatMessage.persist_messages([(
+                ChatMessage(id=uuid.uuid4(), chat_session=ch_session, user=friend, message_detail={'msg': 'hi'}),
+                self.owner.id,
+            )])
+
+    def test_query_count_is_constant(self):
+        self.add_friends(2)
+        with self.assertNumQueries(3):
+            response = self.client.get('/friend_list/')
+        self.assertEqual(len(response.context['user_list']), 2)
+
+        self.add_friends(30)
+        with self.assertNumQueries(3):
+            response = self.client.get('/friend_list/')
+        self.assertEqual(len(response.context['user_list']), 32)
+        self.assertTrue(all(friend['un_read_msg_count'] == 1 for friend in response.context['user_list']))
+
+    def test_unread_count_without_counter(self):
+        friend = User.objects.create_user('lonely', password='secret')
+        ChatSession.create_if_not_exists(self.owner, friend)
+        UnreadCounter.objects.all().delete()
+        response = self.client.get('/friend_list/')
+        self.assertEqual(response.context['user_list'][0]['un_read_msg_count'], 0)
+
+
+def raw_cursor(*values):
+    """
+    Encodes a cursor like `encode_cursor`, but without converting the values, to forge malformed cursors.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+class InboxTest(TestCase):
+    """
+    Covers the ordering and pagination of the materialized inbox.
+    """
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.friends = [User.objects.create_user(f'friend_{i}', password='secret') for i in range(5)]
+        self.sessions = [ChatSession.create_if_not_exists(self.owner, friend) for friend in self.friends]
+        self.client.login(username='owner', password='secret')
+        self.start = timezone.now()
+        # friend_1 and friend_2 share a timestamp, so the page boundary falls between equal timestamps
+        for i, seconds in enumerate([0, 1, 1, 3, 4]):
+            self.store(self.sessions[i], self.friends[i], self.owner, f'hello {i} ' * 20, seconds)
+
+    def store(self, ch_session, sender, recipient, text, seconds):
+        msg = ChatMessage(id=uuid.uuid4(), chat_session=ch_session, user=sender, message_detail={'msg': text},
+                          created_at=self.start + timedelta(seconds=seconds))
+        ChatMessage.persist_messages([(msg, recipient.id)])
+        return msg
+
+    def test_most_recent_conversation_comes_first(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/inbox/', {'limit': 3}).json()
+        conversations = response['conversations']
+        self.assertEqual([c['user_name'] for c in conversations], ['friend_4', 'friend_3', 'friend_2'])
+        self.assertEqual(len(conversations[0]['last_message']['snippet']), 100)
+        self.assertEqual(conversations[0]['un_read_msg_count'], 1)
+
+        response = self.client.get('/inbox/', {'limit': 3, 'before': response['next_cursor']}).json()
+        self.assertEqual([c['user_name'] for c in response['conversations']], ['friend_1', 'friend_0'])
+        self.assertIsNone(response['next_cursor'])
+
+    def test_new_message_moves_the_conversation_up(self):
+        self.store(self.sessions[0], self.owner, self.friends[0], 'hi again', 5)
+        conversations = self.client.get('/inbox/').json()['conversations']
+        self.assertEqual(conversations[0]['user_name'], 'friend_0')
+        self.assertEqual(conversations[0]['last_message']['snippet'], 'hi again')
+        self.assertEqual(conversations[0]['last_message']['sender_id'], self.owner.id)
+
+    def test_late_older_message_keeps_the_preview(self):
+        self.store(self.sessions[4], self.owner, self.friends[4], 'old', -60)
+        conversations = self.client.get('/inbox/').json()['conversations']
+        self.assertEqual(conversations[0]['user_name'], 'friend_4')
+        self.assertTrue(conversations[0]['last_message']['snippet'].startswith('hello 4'))
+
+    def test_malformed_cursor_is_rejected(self):
+        self.assertEqual(self.client.get('/inbox/', {'before': raw_cursor('x', 1)}).status_code, 400)
+
+
+class ChatHistoryTest(TestCase):
+    """
+    Covers the keyset pagination of the chat history.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.ch_session = ChatSession.create_if_not_exists(self.alice, self.bob)
+        self.client.login(username='alice', password='secret')
+        start = timezone.now() - timedelta(minutes=5)
+        # Pairs of messages share a timestamp, so the pages must be split by id as well
+        for i in range(2 * settings.CHAT_HISTORY_PAGE_SIZE + 7):
+            ChatMessage.objects.create(id=uuid.uuid4(), chat_session=self.ch_session, user=self.alice, message_detail={'msg': str(i)},
+                                       created_at=start + timedelta(seconds=i // 2))
+
+    def test_pages_cover_every_message_once(self):
+        response = self.client.get(f'/chat/chat_{self.ch_session.id}/')
+        page = [msg.message_detail['msg'] for msg in response.context['fetch_all_message']]
+        self.assertEqual(len(page), settings.CHAT_HISTORY_PAGE_SIZE)
+        seen, cursor = page, response.context['history_cursor']
+        while cursor:
+            response = self.client.get(f'/chat/chat_{self.ch_session.id}/history/', {'before': cursor, 'limit': 13}).json()
+            self.assertLessEqual(len(response['messages']), 13)
+            seen = [msg['message'] for msg in response['messages']] + seen
+            cursor = response['next_cursor']
+        self.assertEqual(sorted(seen, key=int), [str(i) for i in range(2 * settings.CHAT_HISTORY_PAGE_SIZE + 7)])
+        self.assertEqual(len(set(seen)), len(seen))
+
+    def test_malformed_cursor_is_rejected(self):
+        for values in (['yesterday', str(uuid.uuid4())], [timezone.now().isoformat(), 'x'], [[1], None]):
+            response = self.client.get(f'/chat/chat_{self.ch_session.id}/history/', {'before': raw_cursor(*values)})
+            self.assertEqual(response.status_code, 400, values)
+
+    def test_other_users_are_refused(self):
+        User.objects.create_user('carol', password='secret')
+        self.client.login(username='carol', password='secret')
+        self.assertEqual(self.client.get(f'/chat/chat_{self.ch_session.id}/history/').status_code, 403)
+
+
+class UserDirectoryTest(TestCase):
+    """
+    Covers the keyset pagination of the user directory.
+    """
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.client.login(username='owner', password='secret')
+        for name in ['bob', 'Alice', 'carol', 'dave', 'Eve']:
+            User.objects.create_user(name, password='secret')
+
+    def test_pages_follow_the_cursor(self):
+        names, cursor = [], None
+        while True:
+            response = self.client.get('/users/search/', {'limit': 2, **({'after': cursor} if cursor else {})}).json()
+            names.extend(user['user_name'] for user in response['users'])
+            cursor = response['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(names, ['Alice', 'bob', 'carol', 'dave', 'Eve'])
+
+    def test_malformed_cursor_is_rejected(self):
+        for values in (['A', [1]], ['A', None], [['A'], 1], ['A', 'x']):
+            response = self.client.get('/users/search/', {'after': raw_cursor(*values)})
+            self.assertEqual(response.status_code, 400, values)
+
+
+class MessageSearchTest(TestCase):
+    """
+    Covers message search with the in-process inverted index used on SQLite.
+    """
+
+    def setUp(self):
+        message_index.clear()
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.friend = User.objects.create_user('friend', password='secret')
+        self.client.login(username='owner', password='secret')
+        self.ch_session = ChatSession.create_if_not_exists(self.owner, self.friend)
+
+    def store(self, text, ch_session=None, user=None):
+        msg = ChatMessage(id=uuid.uuid4(), chat_session=ch_session or self.ch_session, user=user or self.friend, message_detail={'msg': text})
+        ChatMessage.persist_messages([(msg, self.owner.id)])
+        return msg
+
+    def search(self, query, **params):
+        response = self.client.get('/search/', {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_every_term_must_match(self):
+        both = self.store('hello big world')
+        self.store('hello there')
+        self.store('world peace')
+        results = self.search('World hello')['results']
+        self.assertEqual([hit['msg_id'] for hit in results], [str(both.id)])
+        self.assertEqual(results[0]['highlights'], [[0, 5], [10, 15]])
+
+    def test_shorter_messages_rank_higher(self):
+        long = self.store('the cat sat on the mat all day')
+        short = self.store('cat')
+        self.store('dog')
+        results = self.search('cat')['results']
+        self.assertEqual([hit['msg_id'] for hit in results], [str(short.id), str(long.id)])
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+
+    def test_pages_follow_the_cursor(self):
+        for i in range(5):
+            self.store('ping ' + 'x ' * i)
+        expected = [hit['msg_id'] for hit in self.search('ping')['results']]
+        self.assertEqual(len(expected), 5)
+        found, cursor = [], None
+        while True:
+            response = self.search('ping', limit=2, **({'after': cursor} if cursor else {}))
+            found.extend(hit['msg_id'] for hit in response['results'])
+            cursor = response['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(found, expected)
+
+    def test_rank_ties_across_a_page_boundary(self):
+        # Identical messages share a rank, so the message id alone decides the boundary
+        tied = sorted(str(self.store('pong pong').id) for _ in range(4))[::-1]
+        first = self.search('pong', limit=3)
+        self.assertEqual(len({hit['rank'] for hit in first['results']}), 1)
+        second = self.search('pong', limit=3, after=first['next_cursor'])
+        self.assertEqual([hit['msg_id'] for hit in first['results'] + second['results']], tied)
+        self.assertIsNone(second['next_cursor'])
+
+    def test_only_own_chat_sessions_are_searched(self):
+        stranger = User.objects.create_user('stranger', password='secret')
+        other = ChatSession.create_if_not_exists(self.friend, stranger)
+        self.store('secret plans', ch_session=other, user=stranger)
+        own = self.store('secret recipe')
+        self.assertEqual([hit['msg_id'] for hit in self.search('secret')['results']], [str(own.id)])
+
+    def test_malformed_cursor_is_rejected(self):
+        msg_id = str(uuid.uuid4())
+        for cursor in ('[NaN, "%s"]' % msg_id, '[Infinity, "%s"]' % msg_id, '[[1], "%s"]' % msg_id, '[null, "%s"]' % msg_id, '[1.0, null]'):
+            after = base64.urlsafe_b64encode(cursor.encode()).decode()
+            response = self.client.get('/search/', {'q': 'ping', 'after': after})
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+class ReplayBufferTest(TestCase):
+    """
+    Covers the in-memory replay of room events.
+    """
+
+    def setUp(self):
+        self.buffer = ReplayBuffer(size=4)
+
+    def record(self, *seqs):
+        for seq in seqs:
+            self.buffer.record(1, seq, f'frame {seq}')
+
+    def seqs(self, last_seq):
+        events = self.buffer.since(1, last_seq)
+        return None if events is None else [seq for seq, frame in events]
+
+    def test_in_order_events_are_replayed(self):
+        self.record(1, 2, 3, 3)
+        self.assertEqual(self.seqs(0), [1, 2, 3])
+        self.assertEqual(self.seqs(2), [3])
+        self.assertEqual(self.seqs(3), [])
+        self.assertEqual(self.buffer.metrics()['recorded_events'], 3)
+
+    def test_open_gap_falls_back_to_the_database(self):
+        self.record(1, 3)
+        self.assertEqual(self.seqs(0), None)
+        self.assertEqual(self.seqs(1), None)
+        self.assertEqual(self.seqs(2), [3])
+
+        self.record(2)
+        self.assertEqual(self.seqs(0), [1, 2, 3])
+        self.assertEqual(self.buffer.since(1, 0)[1], (2, 'frame 2'))
+
+    def test_late_event_fills_a_full_buffer(self):
+        self.record(1, 2, 4, 5)
+        self.record(3)
+        self.assertEqual(self.seqs(1), [2, 3, 4, 5])
+        self.assertEqual(self.seqs(0), None)
+
+    def test_gap_larger_than_the_buffer_restarts_it(self):
+        self.record(1, 2, 10)
+        self.assertEqual(self.seqs(9), [10])
+        self.assertEqual(self.seqs(2), None)
+        self.record(1)
+        self.assertEqual(self.seqs(9), [10])
+
+    def test_unknown_room_falls_back_to_the_database(self):
+        self.assertEqual(self.buffer.since(2, 0), None)
+        self.assertEqual(self.buffer.metrics()['database_replays'], 1)
+
+
+class RoomSequencerTest(TransactionTestCase):
+    """
+    Covers the per-room sequence numbers of a single process.
+    """
+
+    def setUp(self):
+        reset_process_state()
+
+    def test_concurrent_first_use_is_seeded_once(self):
+        owner = User.objects.create_user('owner', password='secret')
+        friend = User.objects.create_user('friend', password='secret')
+        ch_session = ChatSession.create_if_not_exists(owner, friend)
+        ChatMessage.persist_messages([(
+            ChatMessage(id=uuid.uuid4(), chat_session=ch_session, user=friend, message_detail={'msg': 'hi'}, seq=7),
+            owner.id,
+        )])
+        sequencer = RoomSequencer()
+
+        async def use():
+            return await asyncio.gather(*(sequencer.next(ch_session.id) for _ in range(5)))
+
+        self.assertEqual(sorted(async_to_sync(use)()), [8, 9, 10, 11, 12])
+        self.assertEqual(sequencer.current(ch_session.id), 12)
+        self.assertEqual(sequencer._seeding, {})
+
+
+class ChatSessionPairTest(TransactionTestCase):
+    """
+    Covers the uniqueness of the chat session between two users.
+    """
+
+    def setUp(self):
+        reset_process_state()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+
+    def test_either_order_returns_the_same_chat_session(self):
+        ch_session, created = ChatSession.get_or_create_pair(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(ChatSession.get_or_create_pair(self.bob, self.alice), (ch_session, False))
+
+    def test_losing_a_concurrent_insert_returns_the_winner(self):
+        winner = ChatSession.objects.create(user1=self.bob, user2=self.alice)
+        lookup = ChatSession.chat_session_exists
+        calls = []
+
+        def exists_after_first_check(user1, user2):
+            # The first check runs before the concurrent request inserted its row
+            calls.append((user1, user2))
+            return None if len(calls) == 1 else lookup(user1, user2)
+
+        with mock.patch.object(ChatSession, 'chat_session_exists', staticmethod(exists_after_first_check)):
+            ch_session, created = ChatSession.get_or_create_pair(self.alice, self.bob)
+        self.assertEqual((ch_session, created), (winner, False))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(ChatSession.objects.count(), 1)
+
+    def test_created_chat_session_invalidates_the_friend_index(self):
+        self.assertEqual(get_friend_ids(self.alice.id), set())
+        ch_session = ChatSession.objects.create(user1=self.alice, user2=self.bob)
+        self.assertEqual(get_friend_ids(self.alice.id), {self.bob.id})
+        ch_session.save()
+        self.assertEqual(get_friend_ids(self.bob.id), {self.alice.id})
+        ch_session.delete()
+        self.assertEqual(get_friend_ids(self.alice.id), set())
+
+
+class PairKeyMigrationTest(TransactionTestCase):
+    """
+    Covers the merge of reversed duplicate chat sessions by migration 0012.
+    """
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('chat_app'))
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_reversed_duplicates_are_merged(self):
+        alice = User.objects.create_user('alice', password='secret')
+        bob = User.objects.create_user('bob', password='secret')
+        apps = self.migrate([('chat_app', '0011_inbox_entries')])
+        ChatSession = apps.get_model('chat_app', 'ChatSession')
+        ChatMessage = apps.get_model('chat_app', 'ChatMessage')
+        Profile = apps.get_model('chat_app', 'Profile')
+        UnreadCounter = apps.get_model('chat_app', 'UnreadCounter')
+        Profile.objects.filter(user_id=alice.id).update(unread_msg_count=0)
+        Profile.objects.filter(user_id=bob.id).update(unread_msg_count=9)
+        keep = ChatSession.objects.create(user1_id=alice.id, user2_id=bob.id)
+        duplicate = ChatSession.objects.create(user1_id=bob.id, user2_id=alice.id)
+        start = timezone.now()
+        for seconds, ch_session in enumerate([keep, duplicate, keep]):
+            ChatMessage.objects.create(id=uuid.uuid4(), chat_session=ch_session, user_id=alice.id, message_detail={'msg': 'hi'},
+                                       created_at=start + timedelta(seconds=seconds))
+        UnreadCounter.objects.create(chat_session=keep, user_id=bob.id, count=2, last_read_at=start)
+        UnreadCounter.objects.create(chat_session=duplicate, user_id=bob.id, count=1)
+
+        apps = self.migrate([('chat_app', '0012_chat_session_pair_key')])
+        ChatSession = apps.get_model('chat_app', 'ChatSession')
+        UnreadCounter = apps.get_model('chat_app', 'UnreadCounter')
+        Profile = apps.get_model('chat_app', 'Profile')
+        self.assertEqual(list(ChatSession.objects.values_list('id', 'pair_key')), [(keep.id, f'{alice.id}_{bob.id}')])
+        self.assertEqual(apps.get_model('chat_app', 'ChatMessage').objects.filter(chat_session_id=keep.id).count(), 3)
+        self.assertEqual(list(UnreadCounter.objects.values_list('chat_session_id', 'user_id', 'count')), [(keep.id, bob.id, 2)])
+        self.assertEqual(Profile.objects.get(user_id=bob.id).unread_msg_count, 2)
+        self.assertEqual(Profile.objects.get(user_id=alice.id).unread_msg_count, 0)
+
+
+class UnreadCounterTest(TestCase):
+    """
+    Checks the incrementally maintained unread counts against a recount of the stored messages.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.carol = User.objects.create_user('carol', password='secret')
+        self.start = timezone.now() - timedelta(minutes=5)
+        self.sent = 0
+
+    def send(self, sender, recipient, count=1):
+        """
+        Persists `count` messages from `sender` to `recipient`, each a second newer than the previous one.
+        """
+        ch_session, created = ChatSession.get_or_create_pair(sender, recipient)
+        messages = []
+        for _ in range(count):
+            self.sent += 1
+            messages.append((ChatMessage(id=uuid.uuid4(), chat_session=ch_session, user=sender, message_detail={'msg': 'hi'},
+                                         created_at=self.start + timedelta(seconds=self.sent)), recipient.id))
+        ChatMessage.persist_messages(messages)
+        return [msg for msg, recipient_id in messages]
+
+    def assertMatchesRecount(self):
+        """
+        Asserts that every counter and overall count equals the number of messages after the watermark.
+        """
+        totals = {}
+        for ch_session in ChatSession.objects.all():
+            watermarks = UnreadCounter.watermarks(ch_session.id)
+            for reader, sender in ((ch_session.user1, ch_session.user2), (ch_session.user2, ch_session.user1)):
+                unread = ChatMessage.objects.filter(chat_session=ch_session, user=sender)
+                if reader.id in watermarks:
+                    unread = unread.filter(created_at__gt=watermarks[reader.id])
+                self.assertEqual(UnreadCounter.count_for(ch_session.id, reader.id), unread.count(), (ch_session.id, reader.username))
+                totals[reader.id] = totals.get(reader.id, 0) + unread.count()
+        for user in (self.alice, self.bob, self.carol):
+            self.assertEqual(ChatMessage.count_overall_unread_msg(user.id), totals.get(user.id, 0), user.username)
+
+    def test_counts_follow_sends_and_reads(self):
+        to_bob = self.send(self.alice, self.bob, 3)
+        self.send(self.carol, self.bob, 2)
+        self.send(self.bob, self.alice)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 5)
+        self.assertMatchesRecount()
+
+        ChatMessage.meassage_read_true(to_bob[1].chat_session_id, self.bob.id, to_bob[1].id)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 3)
+        self.assertMatchesRecount()
+        # An older message does not move the watermark back
+        ChatMessage.meassage_read_true(to_bob[0].chat_session_id, self.bob.id, to_bob[0].id)
+        self.assertMatchesRecount()
+
+        self.send(self.alice, self.bob, 2)
+        ChatMessage.all_msg_read(to_bob[0].chat_session_id, self.bob.id)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 2)
+        self.assertMatchesRecount()
+
+    def test_increment_skips_messages_before_the_watermark(self):
+        ch_session = self.send(self.alice, self.bob, 2)[0].chat_session
+        ChatMessage.all_msg_read(ch_session.id, self.bob.id)
+        self.assertEqual(UnreadCounter.increment(ch_session.id, self.bob.id, [self.start, self.start + timedelta(minutes=1)]), 1)
+        self.assertEqual(UnreadCounter.count_for(ch_session.id, self.bob.id), 1)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 1)
+
+    def test_reconcile_repairs_drifted_counters(self):
+        self.send(self.alice, self.bob, 3)
+        self.send(self.bob, self.carol, 2)
+        UnreadCounter.objects.update(count=7)
+        Profile.objects.update(unread_msg_count=9)
+        UnreadCounter.objects.filter(user=self.carol).delete()
+        out = StringIO()
+        call_command('reconcile_unread_counters', stdout=out)
+        self.assertIn('Rebuilt', out.getvalue())
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 3)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.carol.id), 2)
+        self.assertMatchesRecount()
+
+
+    def test_rebuild_counts_every_chat_session_in_one_query(self):
+        to_bob = self.send(self.alice, self.bob, 3)
+        self.send(self.carol, self.bob, 2)
+        self.send(self.bob, self.carol, 4)
+        ChatMessage.meassage_read_true(to_bob[0].chat_session_id, self.bob.id, to_bob[0].id)
+        UnreadCounter.objects.update(count=0)
+        with CaptureQueriesContext(connection) as queries:
+            UnreadCounter.rebuild()
+        self.assertEqual(sum('FROM "chat_app_chatmessage"' in query['sql'] for query in queries.captured_queries), 1)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 4)
+        self.assertMatchesRecount()
+
+class ReadWatermarkTest(TestCase):
+    """
+    Checks that the unread counts follow the read watermark when messages are stored after it moved.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.ch_session = ChatSession.create_if_not_exists(self.alice, self.bob)
+        self.start = timezone.now() - timedelta(minutes=5)
+
+    def store(self, seconds):
+        """
+        Persists a message of alice to bob stamped `seconds` after the start of the test.
+        """
+        msg = ChatMessage(id=uuid.uuid4(), chat_session=self.ch_session, user=self.alice, message_detail={'msg': 'hi'}, created_at=self.start + timedelta(seconds=seconds))
+        ChatMessage.persist_messages([(msg, self.bob.id)])
+        return msg
+
+    def assertUnread(self, count):
+        self.assertEqual(UnreadCounter.count_for(self.ch_session.id, self.bob.id), count)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), count)
+
+    def test_reset_covers_the_newest_stored_message(self):
+        self.store(2)
+        ChatMessage.all_msg_read(self.ch_session.id, self.bob.id)
+        self.assertEqual(UnreadCounter.watermarks(self.ch_session.id)[self.bob.id], self.start + timedelta(seconds=2))
+        self.store(1)
+        self.assertUnread(0)
+        self.store(3)
+        self.assertUnread(1)
+        UnreadCounter.rebuild()
+        self.assertUnread(1)
+
+    def test_drifted_total_is_clamped(self):
+        self.store(1)
+        self.store(2)
+        Profile.objects.filter(user=self.bob).update(unread_msg_count=1)
+        ChatMessage.all_msg_read(self.ch_session.id, self.bob.id)
+        self.assertUnread(0)
+        self.store(3)
+        self.store(4)
+        UnreadCounter.objects.filter(chat_session=self.ch_session, user=self.bob).update(count=0)
+        Profile.objects.filter(user=self.bob).update(unread_msg_count=0)
+        UnreadCounter.advance_watermark(self.ch_session.id, self.bob.id, self.start + timedelta(seconds=3))
+        self.assertUnread(1)
+
+
+class SessionTouchTest(TestCase):
+    """
+    Covers the coalesced `updated_on` bumps of chat sessions.
+    """
+
+    def test_failed_flush_keeps_the_touches(self):
+        buffer = SessionTouchBuffer(interval=60)
+        buffer.touch(1, 2)
+        buffer._write = lambda session_ids: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            buffer.flush()
+        self.assertEqual(buffer._dirty, {1, 2})
+
+        written = []
+        buffer._write = written.append
+        buffer.flush()
+        self.assertEqual(written, [{1, 2}])
+        self.assertEqual(buffer._dirty, set())
+        self.assertIsNone(buffer._timer)
+
+
+class WriteBehindTest(TransactionTestCase):
+    """
+    Checks that a message that cannot be written does not lose the other messages of its batch.
+    """
+
+    def setUp(self):
+        reset_process_state()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.ch_session = ChatSession.create_if_not_exists(self.alice, self.bob)
+
+    def message(self, msg_id=None):
+        return ChatMessage(id=msg_id or uuid.uuid4(), chat_session=self.ch_session, user=self.alice, message_detail={'msg': 'hi'})
+
+    def test_failed_batch_is_retried_one_message_at_a_time(self):
+        existing = self.message()
+        ChatMessage.persist_messages([(existing, self.bob.id)])
+        writer = MessageWriteBehind(enabled=True, flush_interval=0.01)
+        batch = [self.message(), self.message(existing.id), self.message()]
+
+        async def scenario():
+            return await asyncio.gather(*(writer.submit(msg, self.bob.id) for msg in batch), return_exceptions=True)
+
+        with self.assertLogs('chat_app.write_behind', 'ERROR'):
+            results = async_to_sync(scenario)()
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], Exception)
+        self.assertIsNone(results[2])
+        self.assertEqual(set(ChatMessage.objects.values_list('id', flat=True)), {existing.id, batch[0].id, batch[2].id})
+        self.assertEqual(UnreadCounter.count_for(self.ch_session.id, self.bob.id), 3)
+        metrics = writer.metrics()
+        self.assertEqual((metrics['flushes'], metrics['flushed_messages'], metrics['failed_messages'], metrics['retried_batches'], metrics['queue_depth']), (1, 2, 1, 1, 0))
+
+    def test_metrics_are_served_to_staff(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get('/metrics/write_behind/').status_code, 302)
+        User.objects.filter(id=self.alice.id).update(is_staff=True)
+        response = self.client.get('/metrics/write_behind/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queue_depth', response.json()['metrics'])
+
+
+class PresenceRegistryTest(TransactionTestCase):
+    """
+    Covers the reference counted presence of users with several connections, and heartbeat expiry.
+    """
+
+    def setUp(self):
+        reset_process_state()
+
+    def test_connections_are_counted_and_expire(self):
+        alice = User.objects.create_user('alice', password='secret')
+        bob = User.objects.create_user('bob', password='secret')
+        ChatSession.create_if_not_exists(alice, bob)
+        registry = PresenceRegistry(heartbeat_ttl=60, flush_interval=0.01)
+        is_online = database_sync_to_async(lambda: Profile.objects.get(user=alice).is_online)
+
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(f'personal__{bob.id}', channel)
+            received = lambda: asyncio.wait_for(layer.receive(channel), 2)
+            self.assertTrue(await registry.connect(alice.id, 'alice', 'tab1'))
+            self.assertEqual(json.loads((await received())['frame']), {'msg_type': 'WENT_ONLINE', 'user_name': 'alice'})
+            self.assertFalse(await registry.connect(alice.id, 'alice', 'tab2'))
+            self.assertFalse(await registry.disconnect(alice.id, 'tab1'))
+            self.assertTrue(registry.is_online(alice.id))
+            await asyncio.sleep(0.1)
+            self.assertTrue(await is_online())
+
+            self.assertFalse(await registry.heartbeat(alice.id, 'tab1'))
+            self.assertTrue(await registry.heartbeat(alice.id, 'tab2'))
+            self.assertEqual(await registry.expire(now=time.monotonic() + 30), [])
+            # The remaining connection misses its heartbeat
+            self.assertEqual(await registry.expire(now=time.monotonic() + 61), [alice.id])
+            self.assertEqual(json.loads((await received())['frame']), {'msg_type': 'WENT_OFFLINE', 'user_name': 'alice'})
+            self.assertFalse(await registry.disconnect(alice.id, 'tab2'))
+            self.assertFalse(registry.is_online(alice.id))
+            await asyncio.sleep(0.1)
+            self.assertFalse(await is_online())
+            registry._sweep_handle.cancel()
+            await layer.group_discard(f'personal__{bob.id}', channel)
+
+        async_to_sync(scenario)()
+        metrics = registry.metrics()
+        self.assertEqual(
+            {key: metrics[key] for key in ('online_transitions', 'offline_transitions', 'suppressed_events', 'expired_connections', 'online_users')},
+            {'online_transitions': 1, 'offline_transitions': 1, 'suppressed_events': 3, 'expired_connections': 1, 'online_users': 0},
+        )
+        self.assertEqual(metrics['status_writes'], 2)
+
+    def test_failed_shutdown_flush_is_logged(self):
+        registry = PresenceRegistry(heartbeat_ttl=60, flush_interval=1)
+        registry._connections = {1: {'tab1': time.monotonic()}}
+        with mock.patch('chat_app.presence.write_online_status', side_effect=OperationalError('database is gone')) as write:
+            with self.assertLogs('chat_app.presence', 'ERROR'):
+                registry.flush_on_shutdown()
+        write.assert_called_once_with({1: False})
+        self.assertEqual(registry._connections, {})
+
+
+class TypingTrackerTest(TestCase):
+    """
+    Covers the debouncing and expiry of typing indicators, with a short window and timeout.
+    """
+
+    def test_transitions_are_debounced_and_expire(self):
+        tracker = TypingTracker(window=0.05, timeout=0.3)
+
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add('chat_1', channel)
+            received = lambda: asyncio.wait_for(layer.receive(channel), 2)
+            self.assertTrue(await tracker.update('chat_1', 'alice', True))
+            self.assertEqual((await received())['type'], 'user_is_typing')
+            self.assertFalse(await tracker.update('chat_1', 'alice', True))
+            # Reverted within the window, nothing is broadcast
+            self.assertFalse(await tracker.update('chat_1', 'alice', False))
+            self.assertFalse(await tracker.update('chat_1', 'alice', True))
+            await asyncio.sleep(0.1)
+            # Not refreshed within the timeout
+            event = await received()
+            self.assertEqual(event['type'], 'user_not_typing')
+            self.assertEqual(json.loads(event['frame']), {'msg_type': 'NOT_TYPING', 'user': 'alice', 'room': 'chat_1'})
+            await asyncio.sleep(0.1)
+            await layer.group_discard('chat_1', channel)
+
+        async_to_sync(scenario)()
+        self.assertEqual(tracker.metrics(), {'received': 4, 'emitted': 2, 'suppressed': 3, 'expired': 1, 'tracked': 0})
+
+    def test_metrics_are_served_to_staff(self):
+        staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get('/metrics/typing/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['metrics']), {'received', 'emitted', 'suppressed', 'expired', 'tracked'})
+
+
+class LocalChannelLayerTest(SimpleTestCase):
+    """
+    Covers the overflow policies of the in-process channel layer.
+    """
+
+    def run_layer(self, overflow, scenario):
+        """
+        Runs `scenario(layer, channel)` with a layer holding two messages per channel.
+        """
+        async def run():
+            layer = LocalChannelLayer(capacity=2, overflow=overflow)
+            channel = await layer.new_channel()
+            await layer.group_add('chat_1', channel)
+            await scenario(layer, channel)
+            return layer.metrics()
+        return async_to_sync(run)()
+
+    def test_drop_keeps_the_pending_messages(self):
+        async def scenario(layer, channel):
+            for n in range(4):
+                await layer.group_send('chat_1', {'type': 'chat.message', 'n': n})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'chat.message', 'n': 4})
+            self.assertEqual([(await layer.receive(channel))['n'] for _ in range(2)], [0, 1])
+
+        metrics = self.run_layer('drop', scenario)
+        self.assertEqual((metrics['dropped'], metrics['queue_depth']), (3, 0))
+
+    def test_oldest_makes_room_for_new_messages(self):
+        async def scenario(layer, channel):
+            for n in range(4):
+                await layer.group_send('chat_1', {'type': 'chat.message', 'n': n})
+            await layer.send(channel, {'type': 'chat.message', 'n': 4})
+            self.assertEqual([(await layer.receive(channel))['n'] for _ in range(2)], [3, 4])
+
+        metrics = self.run_layer('oldest', scenario)
+        self.assertEqual((metrics['evicted'], metrics['channels']), (3, 0))
+
+    def test_close_tells_the_consumer_to_disconnect(self):
+        async def scenario(layer, channel):
+            await layer.group_add('personal__1', channel)
+            for n in range(3):
+                await layer.group_send('chat_1', {'type': 'chat.message', 'n': n})
+            await layer.group_send('personal__1', {'type': 'chat.message', 'n': 3})
+            self.assertEqual(await layer.receive(channel), {'type': 'channel.overflow'})
+
+        metrics = self.run_layer('close', scenario)
+        self.assertEqual((metrics['closed_channels'], metrics['groups']), (1, 0))
+
+    def test_unknown_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            LocalChannelLayer(overflow='block')
+
+
+class ChatConsumerTest(TransactionTestCase):
+    """
+    Checks the read receipts and unread counters sent over the chat room and personal sockets.
+    """
+
+    def setUp(self):
+        reset_process_state()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.ch_session = ChatSession.create_if_not_exists(self.alice, self.bob)
+
+    async def connect(self, user, path):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user
+        connected, code = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def send_messages(self, sender, count):
+        """
+        Sends `count` text messages from a chat room socket and returns the echoed frames.
+        """
+        for i in range(count):
+            await sender.send_json_to({'msg_type': 'TEXT_MESSAGE', 'message': f'message {i}', 'user': 'alice'})
+        return [await sender.receive_json_from(timeout=5) for _ in range(count)]
+
+    def test_read_receipts_are_batched(self):
+        async def scenario():
+            alice = await self.connect(self.alice, f'/ws/chat/chat_{self.ch_session.id}/')
+            bob = await self.connect(self.bob, f'/ws/chat/chat_{self.ch_session.id}/')
+            await self.send_messages(alice, 6)
+            received = [await bob.receive_json_from(timeout=5) for _ in range(6)]
+            # Unknown ids are ignored, the newest known message moves the watermark
+            msg_ids = [frame['msg_id'] for frame in received[:4]] + ['not-a-uuid', 5, str(uuid.uuid4())]
+            await bob.send_json_to({'msg_type': 'MESSAGES_READ', 'msg_ids': msg_ids[::-1]})
+            receipt = await alice.receive_json_from(timeout=5)
+            self.assertEqual((receipt['msg_type'], receipt['user'], receipt['seq']), ('READ_UNTIL', 'bob', 7))
+            self.assertEqual(receipt['read_until'], received[3]['timestampe'])
+            await bob.send_json_to({'msg_type': 'MESSAGES_READ', 'msg_ids': ['not-a-uuid']})
+            self.assertTrue(await alice.receive_nothing(0.2))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(UnreadCounter.count_for(self.ch_session.id, self.bob.id), 2)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 2)
+
+    def test_sender_cannot_mark_the_recipients_messages_read(self):
+        carol = User.objects.create_user('carol', password='secret')
+        foreign = ChatMessage(id=uuid.uuid4(), chat_session=ChatSession.create_if_not_exists(self.bob, carol), user=carol, message_detail={'msg': 'hi'})
+        ChatMessage.persist_messages([(foreign, self.bob.id)])
+
+        async def scenario():
+            alice = await self.connect(self.alice, f'/ws/chat/chat_{self.ch_session.id}/')
+            bob = await self.connect(self.bob, f'/ws/chat/chat_{self.ch_session.id}/')
+            sent = await self.send_messages(alice, 2)
+            for _ in sent:
+                await bob.receive_json_from(timeout=5)
+            # Her own message, a message of another chat session and a malformed id
+            for msg_id in (sent[-1]['msg_id'], str(foreign.id), 'not-a-uuid'):
+                await alice.send_json_to({'msg_type': 'MESSAGE_READ', 'msg_id': msg_id, 'user': 'bob'})
+                error = await alice.receive_json_from(timeout=5)
+                self.assertEqual((error['msg_type'], error['error_message']), ('ERROR_OCCURED', 'INVALID_MESSAGE'))
+            self.assertTrue(await bob.receive_nothing(0.2))
+
+            await bob.send_json_to({'msg_type': 'MESSAGE_READ', 'msg_id': sent[0]['msg_id'], 'user': 'alice'})
+            receipt = await alice.receive_json_from(timeout=5)
+            self.assertEqual((receipt['msg_type'], receipt['msg_id'], receipt['user']), ('MESSAGE_READ', sent[0]['msg_id'], 'bob'))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(UnreadCounter.count_for(self.ch_session.id, self.bob.id), 1)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 2)
+
+    def test_all_read_applies_to_the_connected_user_only(self):
+        carol = User.objects.create_user('carol', password='secret')
+
+        async def scenario():
+            alice = await self.connect(self.alice, f'/ws/chat/chat_{self.ch_session.id}/')
+            bob = await self.connect(self.bob, f'/ws/chat/chat_{self.ch_session.id}/')
+            await self.send_messages(alice, 2)
+            for _ in range(2):
+                await bob.receive_json_from(timeout=5)
+            for user_name in ('bob', 'carol'):
+                await alice.send_json_to({'msg_type': 'ALL_MESSAGE_READ', 'user': user_name})
+                event = await bob.receive_json_from(timeout=5)
+                self.assertEqual((event['msg_type'], event['user']), ('ALL_MESSAGE_READ', 'alice'))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(UnreadCounter.count_for(self.ch_session.id, self.bob.id), 2)
+        self.assertEqual(ChatMessage.count_overall_unread_msg(self.bob.id), 2)
+        self.assertFalse(UnreadCounter.objects.filter(user=carol).exists())
+
+    def test_read_events_are_broadcast_after_they_are_stored(self):
+        async def scenario():
+            alice = await self.connect(self.alice, f'/ws/chat/chat_{self.ch_session.id}/')
+            bob = await self.connect(self.bob, f'/ws/chat/chat_{self.ch_session.id}/')
+            sent = await self.send_messages(alice, 3)
+            for _ in sent:
+                await bob.receive_json_from(timeout=5)
+            await bob.send_json_to({'msg_type': 'MESSAGE_READ', 'msg_id': sent[0]['msg_id']})
+            receipt = await alice.receive_json_from(timeout=5)
+            self.assertEqual(await database_sync_to_async(UnreadCounter.count_for)(self.ch_session.id, self.bob.id), 2)
+            await bob.send_json_to({'msg_type': 'ALL_MESSAGE_READ'})
+            everything = await alice.receive_json_from(timeout=5)
+            self.assertEqual(await database_sync_to_async(UnreadCounter.count_for)(self.ch_session.id, self.bob.id), 0)
+            self.assertEqual([receipt['seq'] + 1, 'bob'], [everything['seq'], everything['user']])
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_unread_counters_are_pushed_once_per_burst(self):
+        async def scenario():
+            bob = await self.connect(self.bob, f'/ws/personal_chat/{self.bob.id}/')
+            alice = await self.connect(self.alice, f'/ws/chat/chat_{self.ch_session.id}/')
+            await self.send_messages(alice, 3)
+            counter = await bob.receive_json_from(timeout=5)
+            self.assertTrue(await bob.receive_nothing(0.3))
+            await alice.disconnect()
+            await bob.disconnect()
+            return counter
+
+        counter = async_to_sync(scenario)()
+        self.assertEqual(counter, {
+            'msg_type': 'MESSAGE_COUNTER',
+            'counters': [{'session_id': self.ch_session.id, 'user_id': self.alice.id, 'unread': 3}],
+            'overall_unread_msg': 3,
+            'version': Profile.objects.get(user=self.bob).unread_version,
+        })
+
+
+class UnreadPusherTest(TestCase):
+    """
+    Covers the coalescing of unread count pushes per recipient.
+    """
+
+    def test_states_within_the_window_are_pushed_once(self):
+        pusher = UnreadPusher(window=0.05)
+
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add('personal__2', channel)
+            pusher.publish([UnreadState(10, 2, 1, 1, 1, 1), UnreadState(11, 2, 3, 1, 2, 2)])
+            # A state read at an older version, e.g. by another worker, does not win
+            pusher.publish([UnreadState(10, 2, 1, 3, 4, 4), UnreadState(10, 2, 1, 2, 3, 3), UnreadState(12, 5, 1, 1, 1, 1)])
+            event = await asyncio.wait_for(layer.receive(channel), 2)
+            await asyncio.sleep(0.1)
+            await layer.group_discard('personal__2', channel)
+            return json.loads(event['frame'])
+
+        frame = async_to_sync(scenario)()
+        self.assertEqual(frame, {
+            'msg_type': 'MESSAGE_COUNTER',
+            'counters': [{'session_id': 10, 'user_id': 1, 'unread': 3}, {'session_id': 11, 'user_id': 3, 'unread': 1}],
+            'overall_unread_msg': 4,
+            'version': 4,
+        })
+        self.assertEqual(pusher.metrics(), {'published_states': 5, 'pushes': 2, 'coalesced_states': 3, 'pending_recipients': 0})
+
+
+class ClientConsumerTest(TransactionTestCase):
+    """
+    Checks that one multiplexed connection carries presence, counters and several chat rooms.
+    """
+
+    def setUp(self):
+        reset_process_state()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.carol = User.objects.create_user('carol', password='secret')
+        self.room_name = f'chat_{ChatSession.create_if_not_exists(self.alice, self.bob).id}'
+        self.other_room_name = f'chat_{ChatSession.create_if_not_exists(self.alice, self.carol).id}'
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/client/')
+        communicator.scope['user'] = user
+        connected, code = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def next_frame(self, communicator, msg_type):
+        """
+        Returns the next frame of a type received by a connection, skipping frames of other types.
+        """
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=5))
+            if frame['msg_type'] == msg_type:
+                return frame
+
+    def test_rooms_share_the_connection(self):
+        async def scenario():
+            alice = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            for room_name in (self.room_name, self.other_room_name):
+                await alice.send_json_to({'msg_type': 'SUBSCRIBE', 'room': room_name})
+                self.assertEqual(await self.next_frame(alice, 'SUBSCRIBED'), {'msg_type': 'SUBSCRIBED', 'room': room_name})
+            await bob.send_json_to({'msg_type': 'SUBSCRIBE', 'room': self.other_room_name})
+            error = await self.next_frame(bob, 'ERROR_OCCURED')
+            self.assertEqual((error['error_message'], error['room']), ('UN_AUTHORIZED', self.other_room_name))
+            await bob.send_json_to({'msg_type': 'SUBSCRIBE', 'room': self.room_name})
+            await self.next_frame(bob, 'SUBSCRIBED')
+
+            await alice.send_json_to({'msg_type': 'TEXT_MESSAGE', 'message': 'hi', 'user': 'alice', 'room': self.room_name})
+            received = await self.next_frame(bob, 'TEXT_MESSAGE')
+            self.assertEqual((received['message'], received['room'], received['seq']), ('hi', self.room_name, 1))
+            self.assertEqual((await self.next_frame(bob, 'MESSAGE_COUNTER'))['overall_unread_msg'], 1)
+
+            await bob.send_json_to({'msg_type': 'UNSUBSCRIBE', 'room': self.room_name})
+            await self.next_frame(bob, 'UNSUBSCRIBED')
+            await alice.send_json_to({'msg_type': 'TEXT_MESSAGE', 'message': 'again', 'user': 'alice', 'room': self.room_name})
+            self.assertEqual((await self.next_frame(alice, 'TEXT_MESSAGE'))['seq'], 1)
+            self.assertEqual((await self.next_frame(alice, 'TEXT_MESSAGE'))['seq'], 2)
+            self.assertEqual((await self.next_frame(bob, 'MESSAGE_COUNTER'))['overall_unread_msg'], 2)
+            await bob.send_json_to({'msg_type': 'SUBSCRIBE', 'room': self.room_name, 'last_seq': 1})
+            await self.next_frame(bob, 'SUBSCRIBED')
+            replayed = await self.next_frame(bob, 'TEXT_MESSAGE')
+            self.assertEqual((replayed['message'], replayed['seq']), ('again', 2))
+            await alice.disconnect()
+            await bob.disconnect()
+        async_to_sync(scenario)()
+
+    def test_pages_use_json_unless_msgpack_is_enabled(self):
+        self.client.login(username='alice', password='secret')
+        page = self.client.get('/friend_list/').content.decode()
+        self.assertIn('const WIRE_PROTOCOLS = false ?', page)
+        self.assertNotIn('msgpack.js', page)
+        page = self.client.get('/friend_list/', {'protocol': 'msgpack'}).content.decode()
+        self.assertIn('const WIRE_PROTOCOLS = true ?', page)
+        self.assertIn('/static/chat/msgpack.js', page)
+        with override_settings(CHAT_WIRE_BINARY=True):
+            self.assertIn('/static/chat/msgpack.js', self.client.get('/friend_list/').content.decode())
+
+    def test_malformed_room_keeps_the_connection(self):
+        async def scenario():
+            alice = await self.connect(self.alice)
+            for frame in ({'msg_type': 'SUBSCRIBE', 'room': [self.room_name]}, {'msg_type': 'UNSUBSCRIBE', 'room': {'name': self.room_name}},
+                          {'msg_type': 'TEXT_MESSAGE', 'message': 'hi', 'user': 'alice', 'room': [1]}):
+                await alice.send_json_to(frame)
+                error = await self.next_frame(alice, 'ERROR_OCCURED')
+                self.assertEqual(error['error_message'], 'INVALID_MESSAGE')
+            await alice.send_json_to({'msg_type': 'SUBSCRIBE', 'room': self.room_name})
+            self.assertEqual(await self.next_frame(alice, 'SUBSCRIBED'), {'msg_type': 'SUBSCRIBED', 'room': self.room_name})
+            await alice.disconnect()
+        async_to_sync(scenario)()
+
+
+class ClientSocket:
+    """
+    A minimal WebSocket client over asyncio streams, exchanging JSON text frames with a worker.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port, path, cookie):
+        """
+        Performs the opening handshake.
+
+        Args:
+            port (int): The port of the worker.
+            path (str): The WebSocket path.
+            cookie (str): The session cookie of the user.
+
+        Returns:
+            ClientSocket: The open connection.
+
+        Raises:
+            ConnectionError: If the worker did not switch protocols.
+        """
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\nOrigin: http://127.0.0.1\r\nCookie: {cookie}\r\n\r\n'
+        ).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise ConnectionError(response.decode(errors='replace'))
+        return cls(reader, writer)
+
+    async def send(self, frame):
+        await self.write(0x1, json.dumps(frame).encode())
+
+    async def write(self, opcode, payload):
+        """
+        Sends a single masked frame.
+        """
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, 0x80 | length])
+        else:
+            header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, 'big')
+        self.writer.write(header + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)))
+        await self.writer.drain()
+
+    async def receive(self):
+        """
+        Returns the next JSON frame, answering pings on the way.
+
+        Returns:
+            dict or None: The frame, or None once the worker closed the connection.
+        """
+        while True:
+            first, second = await asyncio.wait_for(self.reader.readexactly(2), 10)
+            length = second & 0x7f
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), 'big')
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x1:
+                return json.loads(payload)
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                await self.write(0xa, payload)
+
+    async def close(self):
+        """
+        Performs the closing handshake, dropping the frames still in flight.
+        """
+        await self.write(0x8, (1000).to_bytes(2, 'big'))
+        while await self.receive() is not None:
+            pass
+        self.writer.close()
+
+
+@skipUnless(shutil.which('redis-server'), 'redis-server is not installed')
+@skipUnless(connection.vendor == 'postgresql', 'the worker processes share the test database, which needs PostgreSQL')
+class MultiWorkerTest(TransactionTestCase):
+    """
+    Runs several daphne worker processes sharing a Redis channel layer and a Redis server for
+    the chat state, and checks that room events, presence and unread counts cross the workers.
+    """
+    workers = 3
+
+    def setUp(self):
+        self.redis = RedisServer(shutil.which('redis-server')).__enter__()
+        self.addCleanup(self.redis.__exit__)
+        self.ports = [self.start_worker() for _ in range(self.workers)]
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.room_name = f'chat_{ChatSession.create_if_not_exists(self.alice, self.bob).id}'
+        self.cookies = {}
+        for user in (self.alice, self.bob):
+            client = Client()
+            client.force_login(user)
+            self.cookies[user.username] = f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    def start_worker(self):
+        """
+        Starts a daphne worker on a free port, using the Redis channel layer and the test database.
+
+        Returns:
+            int: The port of the worker.
+        """
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        env = dict(os.environ, CHANNEL_LAYER='redis', CHANNEL_REDIS_HOSTS=self.redis.url, DATABASE_NAME=connection.settings_dict['NAME'])
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'django_channel.asgi:application'],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.addCleanup(self.stop_worker, process)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                return port
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    self.fail(f'Worker on port {port} did not start')
+                time.sleep(0.1)
+
+    def stop_worker(self, process):
+        process.terminate()
+        process.wait(10)
+
+    async def connect(self, worker, path, user):
+        """
+        Opens a WebSocket connection of a user to a worker.
+
+        Args:
+            worker (int): The index of the worker.
+            path (str): The WebSocket path.
+            user (User): The authenticated user.
+
+        Returns:
+            ClientSocket: The open connection.
+        """
+        return await ClientSocket.connect(self.ports[worker], path, self.cookies[user.username])
+
+    async def next_frame(self, client_socket, msg_type):
+        """
+        Returns the next frame of a type received by a connection, skipping frames of other types.
+        """
+        while True:
+            frame = await client_socket.receive()
+            if frame is None or frame['msg_type'] == msg_type:
+                return frame
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Condition not met within 10 seconds')
+            time.sleep(0.1)
+
+    def test_room_events_and_unread_counts_cross_workers(self):
+        async def scenario():
+            alice = await self.connect(0, f'/ws/chat/{self.room_name}/', self.alice)
+            bob = await self.connect(1, f'/ws/chat/{self.room_name}/', self.bob)
+            bob_personal = await self.connect(2, f'/ws/personal_chat/{self.bob.id}/', self.bob)
+            await alice.send({'msg_type': 'TEXT_MESSAGE', 'message': 'hi', 'user': 'alice'})
+            received = await self.next_frame(bob, 'TEXT_MESSAGE')
+            self.assertEqual((received['message'], received['user'], received['seq']), ('hi', 'alice', 1))
+            self.assertEqual((await self.next_frame(alice, 'TEXT_MESSAGE'))['seq'], 1)
+            await bob.send({'msg_type': 'TEXT_MESSAGE', 'message': 'hey', 'user': 'bob'})
+            received = await self.next_frame(alice, 'TEXT_MESSAGE')
+            self.assertEqual((received['message'], received['user'], received['seq']), ('hey', 'bob', 2))
+            await alice.send({'msg_type': 'TEXT_MESSAGE', 'message': 'again', 'user': 'alice'})
+            versions = []
+            while True:
+                counter = await self.next_frame(bob_personal, 'MESSAGE_COUNTER')
+                versions.append(counter['version'])
+                if counter['overall_unread_msg'] == 2:
+                    break
+            self.assertEqual(versions, sorted(set(versions)))
+            for client_socket in (alice, bob, bob_personal):
+                await client_socket.close()
+        async_to_sync(scenario)()
+        self.wait_for(lambda: ChatMessage.objects.count() == 3)
+        self.assertEqual(sorted(ChatMessage.objects.values_list('seq', flat=True)), [1, 2, 3])
+
+    def test_presence_across_workers(self):
+        async def scenario():
+            bob = await self.connect(0, f'/ws/personal_chat/{self.bob.id}/', self.bob)
+            first = await self.connect(1, f'/ws/personal_chat/{self.alice.id}/', self.alice)
+            self.assertEqual(await self.next_frame(bob, 'WENT_ONLINE'), {'msg_type': 'WENT_ONLINE', 'user_name': 'alice'})
+            second = await self.connect(2, f'/ws/personal_chat/{self.alice.id}/', self.alice)
+            await first.close()
+            third = await self.connect(0, f'/ws/personal_chat/{self.alice.id}/', self.alice)
+            await second.close()
+            await third.close()
+            self.assertEqual(await bob.receive(), {'msg_type': 'WENT_OFFLINE', 'user_name': 'alice'})
+            await bob.close()
+        async_to_sync(scenario)()
+        self.wait_for(lambda: not Profile.objects.get(user=self.alice).is_online)
@@ -0,0 +1,178 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .wire import frame_event
+
+
+class TypingState:
+    """
+    The typing state of a user in a room.
+
+    Attributes:
+        typing (bool): The state last broadcast to the room.
+        wanted (bool): The state last reported by the user.
+        deferred (int): The transitions received since the last broadcast that are waiting for the window to end.
+        flush_handle (TimerHandle): The end of the current window, if one is open.
+        expire_handle (TimerHandle): The expiry of the typing state, if the user is typing.
+    """
+    __slots__ = ('typing', 'wanted', 'deferred', 'flush_handle', 'expire_handle')
+
+    def __init__(self):
+        self.typing = False
+        self.wanted = False
+        self.deferred = 0
+        self.flush_handle = None
+        self.expire_handle = None
+
+
+class TypingTracker:
+    """
+    Debounces the typing indicators of the users of this process before they are broadcast.
+
+    Every user has a typing state per room. Reports that repeat the current state are dropped,
+    and at most one transition per `window` seconds is broadcast: transitions reported while a
+    window is open are coalesced, and only the latest state is broadcast when the window ends,
+    if it differs from the broadcast one. A typing state that is not refreshed by an IS_TYPING
+    report within `timeout` seconds expires and NOT_TYPING is broadcast, so a client that
+    never sends NOT_TYPING does not leave the indicator on.
+
+    Attributes:
+        window (float): The minimum number of seconds between two broadcasts for a user in a room.
+        timeout (float): Seconds after the last IS_TYPING report at which the typing state expires.
+
+    Methods:
+        from_settings(): Creates the tracker from the `CHAT_TYPING` setting.
+        update(room_group, user_name, is_typing): Handles a typing report of a user.
+        disconnect(room_group, user_name): Ends the typing state of a user leaving a room.
+        metrics(): Returns the typing counters.
+    """
+
+    def __init__(self, window = 1.0, timeout = 6.0):
+        self.window = window
+        self.timeout = timeout
+        self._states = {}
+        self._stats = {'received': 0, 'emitted': 0, 'suppressed': 0, 'expired': 0}
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the tracker from the `CHAT_TYPING` setting.
+
+        Returns:
+            TypingTracker: The configured tracker.
+        """
+        config = getattr(settings, 'CHAT_TYPING', {})
+        return cls(window = config.get('WINDOW', 1.0), timeout = config.get('TIMEOUT', 6.0))
+
+    async def update(self, room_group, user_name, is_typing):
+        """
+        Handles an IS_TYPING or NOT_TYPING report of a user.
+
+        Args:
+            room_group (str): The group name of the room.
+            user_name (str): The username of the reporting user.
+            is_typing (bool): True for IS_TYPING, False for NOT_TYPING.
+
+        Returns:
+            bool: True if the report was broadcast right away.
+        """
+        self._stats['received'] += 1
+        key = (room_group, user_name)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = TypingState()
+        loop = asyncio.get_running_loop()
+        if state.expire_handle is not None:
+            state.expire_handle.cancel()
+            state.expire_handle = None
+        if is_typing:
+            state.expire_handle = loop.call_later(self.timeout, lambda: loop.create_task(self._expire(key)))
+        if is_typing == state.wanted:
+            self._stats['suppressed'] += 1
+            return False
+        state.wanted = is_typing
+        if state.flush_handle is not None:
+            state.deferred += 1
+            return False
+        await self._emit(key, state)
+        return True
+
+    async def disconnect(self, room_group, user_name):
+        """
+        Ends the typing state of a user leaving a room, broadcasting NOT_TYPING if the user was typing.
+
+        Args:
+            room_group (str): The group name of the room.
+            user_name (str): The username of the user.
+        """
+        state = self._states.get((room_group, user_name))
+        if state is None:
+            return
+        if state.expire_handle is not None:
+            state.expire_handle.cancel()
+            state.expire_handle = None
+        if state.wanted:
+            state.wanted = False
+            if state.flush_handle is None:
+                await self._emit((room_group, user_name), state)
+
+    async def _expire(self, key):
+        """
+        Ends a typing state that was not refreshed within the timeout.
+        """
+        state = self._states.get(key)
+        if state is None or not state.wanted:
+            return
+        state.expire_handle = None
+        state.wanted = False
+        self._stats['expired'] += 1
+        if state.flush_handle is None:
+            await self._emit(key, state)
+
+    async def _flush(self, key):
+        """
+        Ends the window of a user in a room, broadcasting the latest state if it changed.
+        """
+        state = self._states.get(key)
+        if state is None:
+            return
+        state.flush_handle = None
+        deferred, state.deferred = state.deferred, 0
+        if state.wanted != state.typing:
+            self._stats['suppressed'] += max(deferred - 1, 0)
+            await self._emit(key, state)
+        else:
+            self._stats['suppressed'] += deferred
+            if not state.typing and state.expire_handle is None:
+                del self._states[key]
+
+    async def _emit(self, key, state):
+        """
+        Broadcasts the wanted state of a user to the room and opens a new window.
+        """
+        room_group, user_name = key
+        loop = asyncio.get_running_loop()
+        state.typing = state.wanted
+        state.flush_handle = loop.call_later(self.window, lambda: loop.create_task(self._flush(key)))
+        self._stats['emitted'] += 1
+        await get_channel_layer().group_send(
+            room_group,
+            frame_event('user_is_typing' if state.typing else 'user_not_typing', {
+                'msg_type': 'IS_TYPING' if state.typing else 'NOT_TYPING',
+                'user': user_name,
+                'room': room_group,
+            }, room = room_group)
+        )
+
+    def metrics(self):
+        """
+        Returns the typing counters.
+
+        Returns:
+            dict: The number of received reports, broadcast transitions, suppressed reports,
+            expired typing states and tracked (room, user) states.
+        """
+        return dict(self._stats, tracked = len(self._states))
+
+
+typing_tracker = TypingTracker.from_settings()
@@ -0,0 +1,105 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .wire import frame_event
+
+
+class UnreadPusher:
+    """
+    Pushes the unread counts of the recipients of new messages to their personal rooms.
+
+    The counts come from `ChatMessage.persist_messages`, which reads them back from the counter
+    rows it updated, so no count is computed to push them. The states published for a recipient
+    are coalesced for `window` seconds and then sent as one MESSAGE_COUNTER frame holding the
+    latest count of every chat session that changed and the latest overall count, so a burst of
+    messages to the same recipient costs a single push.
+
+    Every state carries the `Profile.unread_version` its counts were read at. Only the newest
+    version of each count is kept, and the frame carries the newest version it contains, so a
+    client can drop a push that arrives after a newer one, e.g. from another worker process.
+
+    Attributes:
+        window (float): Seconds the states of a recipient are collected before they are pushed.
+
+    Methods:
+        from_settings(): Creates the pusher from the `CHAT_UNREAD_PUSH` setting.
+        publish(states): Schedules the push of new unread counts.
+        flush(recipient_id): Pushes the collected counts of a recipient.
+        metrics(): Returns the push counters.
+    """
+
+    def __init__(self, window = 0.1):
+        self.window = window
+        self._pending = {}
+        self._stats = {'published_states': 0, 'pushes': 0, 'coalesced_states': 0}
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the pusher from the `CHAT_UNREAD_PUSH` setting.
+
+        Returns:
+            UnreadPusher: The configured pusher.
+        """
+        config = getattr(settings, 'CHAT_UNREAD_PUSH', {})
+        return cls(window = config.get('WINDOW', 0.1))
+
+    def publish(self, states):
+        """
+        Schedules the push of new unread counts, merging them with the counts already waiting.
+
+        Must be called from the event loop. States of the same recipient and chat session replace
+        each other, the one with the newest version wins.
+
+        Args:
+            states (list): UnreadState tuples returned by `ChatMessage.persist_messages`.
+        """
+        loop = asyncio.get_running_loop()
+        for state in states:
+            self._stats['published_states'] += 1
+            pending = self._pending.get(state.recipient_id)
+            if pending is None:
+                pending = self._pending[state.recipient_id] = {'sessions': {}, 'total': state.total, 'version': state.version}
+                loop.call_later(self.window, lambda recipient_id = state.recipient_id: loop.create_task(self.flush(recipient_id)))
+            else:
+                self._stats['coalesced_states'] += 1
+            current = pending['sessions'].get(state.session_id)
+            if current is None or state.version >= current.version:
+                pending['sessions'][state.session_id] = state
+            if state.version >= pending['version']:
+                pending['total'] = state.total
+                pending['version'] = state.version
+
+    async def flush(self, recipient_id):
+        """
+        Pushes the collected counts of a recipient as one MESSAGE_COUNTER frame.
+
+        Args:
+            recipient_id (int): The ID of the recipient.
+        """
+        pending = self._pending.pop(recipient_id, None)
+        if pending is None:
+            return
+        self._stats['pushes'] += 1
+        await get_channel_layer().group_send(
+            f'personal__{recipient_id}',
+            frame_event('message_counter', {
+                'msg_type': 'MESSAGE_COUNTER',
+                'counters': [{'session_id': state.session_id, 'user_id': state.sender_id, 'unread': state.count} for state in pending['sessions'].values()],
+                'overall_unread_msg': pending['total'],
+                'version': pending['version'],
+            })
+        )
+
+    def metrics(self):
+        """
+        Returns the push counters.
+
+        Returns:
+            dict: The number of published states, pushes, states merged into a waiting push and
+            recipients waiting for a push.
+        """
+        return dict(self._stats, pending_recipients = len(self._pending))
+
+
+unread_pusher = UnreadPusher.from_settings()
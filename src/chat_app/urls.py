@@ -9,10 +9,28 @@ urlpatterns = [
 
     path('create_friend/', create_friend,name = 'create_friend'),
 
+    path('users/search/', user_directory, name = 'user_directory'),
+
     path('friend_list/', friend_list,name = 'friend_list'),
 
     path('chat/<str:room_name>/', start_chat, name='start_chat'),
 
+    path('chat/<str:room_name>/history/', chat_history, name='chat_history'),
+
+    path('chat/<str:room_name>/sync/', chat_sync, name='chat_sync'),
+
+    path('chat/<str:room_name>/last_message/', get_last_message, name='last_message'),
+
+    path('inbox/', inbox, name='inbox'),
+
+    path('search/', message_search, name='message_search'),
+
+    path('metrics/channel_layer/', channel_layer_metrics, name='channel_layer_metrics'),
+
+    path('metrics/write_behind/', write_behind_metrics, name='write_behind_metrics'),
+
+    path('metrics/typing/', typing_metrics, name='typing_metrics'),
+
     path('logout/', logoutView, name='logout'),
 
     path('profileUpdate/', updateProfile, name='profileUpdate'),
@@ -1,11 +1,23 @@
+import math
+import uuid
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
+from django.contrib.admin.views.decorators import staff_member_required
+from channels.layers import get_channel_layer
+from django.db.models import Q, OuterRef, Subquery, Value, Exists
+from django.db.models.functions import Coalesce, Upper
 from django.contrib.auth import logout
 from .forms import ProfileAvatarForm
 from .models import *
-from django.http.response import HttpResponse, HttpResponseRedirect
+from django.http.response import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.contrib import messages
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from .pagination import encode_cursor, decode_cursor
+from .search import search_messages
+from .replay import room_sequencer, stored_last_seq
+from .typing_indicator import typing_tracker
+from .write_behind import message_writer
 
 # def room_name(request):
 #     return render(request, 'chat/enter_room_name.html')
@@ -53,9 +65,9 @@ def create_friend(request):
     the selected user. If the chat session is successfully created, a success message
     is displayed; otherwise, an appropriate message is shown.
 
-    If no user ID is provided in the request, the function retrieves a list of all users
-    who are not already friends with the current user and renders the create friend page
-    template with the available user list.
+    If no user ID is provided in the request, the function renders the create friend page
+    template with the first page of the user directory. Further pages and search results
+    are loaded from `user_directory`.
 
     Args:
         request (HttpRequest): The HTTP request object.
@@ -79,13 +91,82 @@ def create_friend(request):
             messages.add_message(request,messages.SUCCESS,f'{user_2.username} already added in your chat list!!')
         return HttpResponseRedirect('/create_friend')
     else:
-        user_all_friends = ChatSession.objects.filter(Q(user1 = user_1) | Q(user2 = user_1))
-        user_list = []
-        for ch_session in user_all_friends:
-            user_list.append(ch_session.user1.id)
-            user_list.append(ch_session.user2.id)
-        all_user = User.objects.exclude(Q(username=user_1.username)|Q(id__in = list(set(user_list))))
-    return render(request, 'chat/create_friend.html',{'all_user' : all_user})
+        all_user, next_position = directory_page(user_1, limit = settings.CHAT_DIRECTORY_PAGE_SIZE)
+    return render(request, 'chat/create_friend.html',{
+        'all_user' : all_user,
+        'directory_cursor': encode_cursor(*next_position) if next_position else None,
+    })
+
+
+def directory_page(user, prefix = '', after = None, limit = 20):
+    """
+    Returns one page of the users the given user is not chatting with yet.
+
+    Users are matched by a case-insensitive prefix of their username and ordered by the
+    upper-cased username. On PostgreSQL the prefix match is served by the
+    `chat_user_username_upper_like_idx` index and the ordering and cursor range by the
+    `chat_user_username_upper_idx` index. Existing friends are excluded with NOT EXISTS probes of the chat session
+    index instead of collecting their ids in Python.
+
+    Args:
+        user (User): The user looking for new friends.
+        prefix (str): The beginning of the username to search for.
+        after (tuple): The (upper-cased username, id) position of the last user of the previous
+            page, or None for the first page.
+        limit (int): The maximum number of users of the page.
+
+    Returns:
+        tuple: The users of the page and the (upper-cased username, id) position to request the
+        next page with, or None if there are no further users.
+    """
+    all_user = (User.objects.exclude(id = user.id)
+                .annotate(username_upper = Upper('username'))
+                .filter(~Exists(ChatSession.objects.filter(user1 = user, user2 = OuterRef('pk'))))
+                .filter(~Exists(ChatSession.objects.filter(user1 = OuterRef('pk'), user2 = user)))
+                .order_by('username_upper', 'id'))
+    if prefix:
+        all_user = all_user.filter(username__istartswith = prefix)
+    if after is not None:
+        username_upper, user_id = after
+        all_user = all_user.filter(Q(username_upper__gt = username_upper) | Q(username_upper = username_upper, id__gt = user_id))
+    page = list(all_user[:limit + 1])
+    next_position = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_position = (page[-1].username_upper, page[-1].id)
+    return page, next_position
+
+
+@login_required
+def user_directory(request):
+    """
+    Searches the users the current user can add as friends and returns them as JSON.
+
+    This view serves the search-as-you-type box of the create friend page. The `q` query
+    parameter is matched as a case-insensitive prefix of the username, and the `after`
+    query parameter is the cursor returned with the previous page.
+
+    Args:
+        request (HttpRequest): The HTTP request object with the optional `q`, `after` and `limit` query parameters.
+
+    Returns:
+        JsonResponse: The users of the page and the cursor of the next page, which is null when
+        no further users match.
+    """
+    try:
+        after = parse_position_cursor(request.GET.get('after'), int, key_type = cursor_text)
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor.'}, status = 400)
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_DIRECTORY_PAGE_SIZE)), settings.CHAT_DIRECTORY_PAGE_SIZE)
+    except ValueError:
+        limit = settings.CHAT_DIRECTORY_PAGE_SIZE
+    prefix = request.GET.get('q', '').strip()[:150]
+    page, next_position = directory_page(request.user, prefix = prefix, after = after, limit = max(limit, 1))
+    return JsonResponse({
+        'users': [{'user_id': user.id, 'user_name': user.username} for user in page],
+        'next_cursor': encode_cursor(*next_position) if next_position else None,
+    })
 
 
 @login_required
@@ -99,6 +180,10 @@ def friend_list(request):
     about each friend, including their username, unread message count, online
     status, avatar, and user ID.
 
+    Everything is loaded with a single query: the profiles of both participants are
+    joined and the unread count of the current user is annotated from its unread
+    counter, so the number of queries does not grow with the number of friends.
+
     Args:
         request (HttpRequest): The HTTP request object.
 
@@ -108,15 +193,18 @@ def friend_list(request):
 
     """
     user_inst = request.user
-    user_all_friends = ChatSession.objects.filter(Q(user1 = user_inst) | Q(user2 = user_inst)).select_related('user1','user2').order_by('-updated_on')
+    unread_counter = UnreadCounter.objects.filter(chat_session = OuterRef('pk'), user = user_inst).values('count')[:1]
+    user_all_friends = (ChatSession.objects.filter(Q(user1 = user_inst) | Q(user2 = user_inst))
+                        .select_related('user1__profile_detail','user2__profile_detail')
+                        .annotate(un_read_msg_count = Coalesce(Subquery(unread_counter), Value(0)))
+                        .order_by('-updated_on'))
     all_friends = []
     for ch_session in user_all_friends:
-        user, user_inst = [ch_session.user2,ch_session.user1] if request.user.username == ch_session.user1.username else [ch_session.user1,ch_session.user2]
-        un_read_msg_count = ChatMessage.objects.filter(chat_session = ch_session.id,message_detail__read = False).exclude(user = user_inst).count()        
+        user = ch_session.user2 if ch_session.user1_id == user_inst.id else ch_session.user1
         data = {
             "user_name": user.username,
             "room_name": ch_session.room_group_name,
-            "un_read_msg_count": un_read_msg_count,
+            "un_read_msg_count": ch_session.un_read_msg_count,
             "status": user.profile_detail.is_online,
             "avatar": user.profile_detail.avatar,
             "user_id": user.id
@@ -126,6 +214,24 @@ def friend_list(request):
     return render(request, 'chat/friend_list.html', {'user_list': all_friends})
 
 
+def get_chat_session(user, room_name):
+    """
+    Returns the chat session of a room if the user is one of its participants.
+
+    Args:
+        user (User): The user requesting access to the room.
+        room_name (str): The room name in the format "chat_<session id>".
+
+    Returns:
+        ChatSession or None: The chat session with both users loaded, or None if the room does not
+        exist or the user is not a participant.
+    """
+    session_id = room_name[5:]
+    if not session_id.isdigit():
+        return None
+    return ChatSession.objects.filter(Q(id = session_id)&(Q(user1 = user) | Q(user2 = user))).select_related('user1','user2').first()
+
+
 @login_required
 def start_chat(request, room_name):
     """
@@ -135,7 +241,8 @@ def start_chat(request, room_name):
     It first checks if the current user has permission to access the chat session
     specified by the given room name. If the user has permission, it retrieves
     information about the chat session, including the opposite user, and fetches
-    all messages associated with the chat session. It then renders the chat interface
+    the latest page of messages of the chat session. Older messages are loaded by the
+    page through the `chat_history` endpoint. It then renders the chat interface
     template with the necessary data.
 
     Args:
@@ -148,41 +255,331 @@ def start_chat(request, room_name):
 
     """
     current_user = request.user
-    try:
-
-        check_user = ChatSession.objects.filter(Q(id = room_name[5:])&(Q(user1 = current_user) | Q(user2 = current_user)))
-    except Exception:
-        return HttpResponse("Something went wrong!!!")
-    if check_user.exists():
-        chat_user_pair = check_user.first()
+    chat_user_pair = get_chat_session(current_user, room_name)
+    if chat_user_pair:
         opposite_user = chat_user_pair.user2 if chat_user_pair.user1.username == current_user.username else chat_user_pair.user1
-        fetch_all_message = ChatMessage.objects.filter(chat_session__id = room_name[5:]).order_by('message_detail__timestamp')
-        return render(request,'chat/start_chat.html',{'room_name' : room_name,'opposite_user' : opposite_user,'fetch_all_message' : fetch_all_message})
+        # Read before the page so that an event stored in between is replayed rather than skipped
+        last_seq = room_sequencer.current(chat_user_pair.id) or stored_last_seq(chat_user_pair.id)
+        fetch_all_message, next_position = ChatMessage.history_page(chat_user_pair.id, limit = settings.CHAT_HISTORY_PAGE_SIZE)
+        history_cursor = encode_cursor(*next_position) if next_position else ''
+        sync_cursor = encode_cursor(fetch_all_message[-1].created_at, fetch_all_message[-1].id) if fetch_all_message else ''
+        read_until = UnreadCounter.watermarks(chat_user_pair.id).get(opposite_user.id)
+        return render(request,'chat/start_chat.html',{'room_name' : room_name,'opposite_user' : opposite_user,'fetch_all_message' : fetch_all_message,'history_cursor' : history_cursor,'sync_cursor' : sync_cursor,'last_seq' : last_seq,'read_until' : read_until})
     else:
         return HttpResponse("You have't permission to chatting with this user!!!")
 
 
-def get_last_message(request):
+@login_required
+def chat_history(request, room_name):
     """
-    Retrieves the last message from a chat session.
+    Returns an older page of the message history of a chat session as JSON.
 
-    This function handles requests to retrieve the last message from a specified chat session.
-    It expects a POST request containing the 'room_id' parameter in the request data, which
-    represents the unique identifier of the chat session (room). The function retrieves the
-    last message from the chat session specified by the 'room_id' parameter and returns it.
+    This view serves the infinite scroll of the chat interface. The `before` query parameter
+    is the cursor returned by the previous page (or rendered with the chat interface) and
+    identifies the oldest message already shown by its (timestamp, id) pair. The page is read
+    with a keyset range scan, so its cost is independent of the position in the history.
 
     Args:
-        request (HttpRequest): The HTTP request object containing the 'room_id' parameter in the request data.
+        request (HttpRequest): The HTTP request object with the `before` and optional `limit` query parameters.
+        room_name (str): The unique identifier of the chat session (room).
 
     Returns:
-        ChatMessage: The last message object from the specified chat session.
+        JsonResponse: The messages of the page in chronological order and the cursor of the next
+        older page, which is null when the beginning of the history has been reached.
+    """
+    ch_session = get_chat_session(request.user, room_name)
+    if ch_session is None:
+        return JsonResponse({'error': "You have't permission to chatting with this user!!!"}, status = 403)
+    try:
+        before = parse_position_cursor(request.GET.get('before'), uuid.UUID)
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor.'}, status = 400)
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE)), settings.CHAT_HISTORY_PAGE_SIZE)
+    except ValueError:
+        limit = settings.CHAT_HISTORY_PAGE_SIZE
+    page, next_position = ChatMessage.history_page(ch_session.id, before = before, limit = max(limit, 1))
+    watermarks = UnreadCounter.watermarks(ch_session.id)
+    return JsonResponse({
+        'messages': [msg.serialize(watermarks.get(ch_session.other_user_id(msg.user_id))) for msg in page],
+        'next_cursor': encode_cursor(*next_position) if next_position else None,
+    })
+
+
+def parse_position_cursor(cursor, id_type, key_type = parse_datetime):
+    """
+    Decodes a (key, id) keyset cursor.
+
+    Args:
+        cursor (str): The cursor received from the client, or None.
+        id_type (type): The type of the id half of the position, e.g. `uuid.UUID` or `int`.
+        key_type (callable): Converts the key half of the position, a timestamp by default.
+            It returns None or raises TypeError or ValueError for an invalid key.
+
+    Returns:
+        tuple or None: The (key, id) position, or None if no cursor was given or it cannot be decoded.
+
+    Raises:
+        TypeError: If the cursor decodes to values of the wrong type.
+        ValueError: If the cursor decodes to an invalid position.
+    """
+    values = decode_cursor(cursor, 2)
+    if values is None:
+        return None
+    key = key_type(values[0])
+    if key is None:
+        raise ValueError('Invalid cursor.')
+    return key, id_type(str(values[1]))
+
+
+def cursor_text(value):
+    """
+    Returns the text key of a cursor, e.g. a username.
+
+    Raises:
+        TypeError: If the key is not a string.
+    """
+    if not isinstance(value, str):
+        raise TypeError('Invalid cursor.')
+    return value
+
+
+def cursor_rank(value):
+    """
+    Returns the relevance rank key of a search cursor.
 
     Raises:
-        IndexError: If no messages are found in the specified chat session.
+        TypeError: If the key is not a number.
+        ValueError: If the key is not a finite number.
+    """
+    rank = float(value)
+    if not math.isfinite(rank):
+        raise ValueError('Invalid cursor.')
+    return rank
+
+
+def serialize_inbox_entry(entry):
+    """
+    Returns an inbox row as a JSON serializable dictionary.
+
+    Args:
+        entry (InboxEntry): The inbox row, annotated with its unread count.
+
+    Returns:
+        dict: The friend and the preview of the newest message of the chat session.
+    """
+    return {
+        "user_name": entry.other_user.username,
+        "user_id": entry.other_user_id,
+        "room_name": f'chat_{entry.chat_session_id}',
+        "status": entry.other_user.profile_detail.is_online,
+        "avatar": entry.other_user.profile_detail.avatarUrl,
+        "un_read_msg_count": entry.un_read_msg_count,
+        "last_message": {
+            "msg_id": str(entry.last_message_id) if entry.last_message_id else None,
+            "snippet": entry.last_message_snippet,
+            "timestamp": entry.last_message_at.isoformat(),
+            "sender_id": entry.last_sender_id,
+        },
+    }
+
+
+@login_required
+def inbox(request):
+    """
+    Returns a page of the conversations of the user as JSON, most recent activity first.
+
+    Each conversation carries the preview of its newest message from the materialized inbox,
+    so a page is served by one query over the (user, last_message_at) index regardless of how
+    many conversations the user has. The `before` query parameter is the cursor returned with
+    the previous page.
+
+    Args:
+        request (HttpRequest): The HTTP request object with the optional `before` and `limit` query parameters.
+
+    Returns:
+        JsonResponse: The conversations of the page and the cursor of the next page, which is
+        null when the end of the inbox has been reached.
+    """
+    try:
+        before = parse_position_cursor(request.GET.get('before'), int)
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor.'}, status = 400)
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_INBOX_PAGE_SIZE)), settings.CHAT_INBOX_PAGE_SIZE)
+    except ValueError:
+        limit = settings.CHAT_INBOX_PAGE_SIZE
+    page, next_position = InboxEntry.page(request.user.id, before = before, limit = max(limit, 1))
+    return JsonResponse({
+        'conversations': [serialize_inbox_entry(entry) for entry in page],
+        'next_cursor': encode_cursor(*next_position) if next_position else None,
+    })
+
+
+@login_required
+def chat_sync(request, room_name):
+    """
+    Returns the changes of a chat session since a client-provided position as JSON.
+
+    This view serves reconnecting clients, which only need what happened while their websocket
+    was down instead of reloading the whole conversation. The `since` query parameter is the
+    cursor of the newest message known to the client (rendered with the chat interface or returned
+    by the previous sync). The response holds the newer messages, oldest first, and the current
+    read watermarks of both participants, which is the whole read state of the chat session.
+    Messages are never deleted, so there are no deletions to report.
+
+    Args:
+        request (HttpRequest): The HTTP request object with the `since` and optional `limit` query parameters.
+        room_name (str): The unique identifier of the chat session (room).
+
+    Returns:
+        JsonResponse: The new messages, the read watermarks, the cursor to continue from and whether
+        more messages are pending; status 400 for an invalid cursor and 403 for non-participants.
+    """
+    ch_session = get_chat_session(request.user, room_name)
+    if ch_session is None:
+        return JsonResponse({'error': "You have't permission to chatting with this user!!!"}, status = 403)
+    try:
+        since = parse_position_cursor(request.GET.get('since'), uuid.UUID)
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor.'}, status = 400)
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_SYNC_PAGE_SIZE)), settings.CHAT_SYNC_PAGE_SIZE)
+    except ValueError:
+        limit = settings.CHAT_SYNC_PAGE_SIZE
+    page, has_more = ChatMessage.messages_since(ch_session.id, after = since, limit = max(limit, 1))
+    watermarks = UnreadCounter.watermarks(ch_session.id)
+    other_user_id = ch_session.other_user_id(request.user.id)
+    if page:
+        next_cursor = encode_cursor(page[-1].created_at, page[-1].id)
+    else:
+        next_cursor = request.GET.get('since') if since else None
+    return JsonResponse({
+        'messages': [msg.serialize(watermarks.get(ch_session.other_user_id(msg.user_id))) for msg in page],
+        'read_until': watermarks[other_user_id].isoformat() if other_user_id in watermarks else None,
+        'last_read_at': watermarks[request.user.id].isoformat() if request.user.id in watermarks else None,
+        'next_cursor': next_cursor,
+        'has_more': has_more,
+    })
+
+
+@login_required
+def message_search(request):
+    """
+    Searches the messages of the chat sessions of the current user and returns the hits as JSON.
+
+    The `q` query parameter holds the search terms; a message matches when it contains all
+    of them. Hits are ranked by relevance and paginated with the `after` cursor returned with
+    the previous page. Each hit carries the character offsets of the matched terms so the
+    client can highlight them.
+
+    Args:
+        request (HttpRequest): The HTTP request object with the `q` and optional `after` and `limit` query parameters.
+
+    Returns:
+        JsonResponse: The hits of the page and the cursor of the next page, which is null when
+        there are no further hits.
+    """
+    try:
+        after = parse_position_cursor(request.GET.get('after'), lambda msg_id: str(uuid.UUID(msg_id)), key_type = cursor_rank)
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid cursor.'}, status = 400)
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_SEARCH_PAGE_SIZE)), settings.CHAT_SEARCH_PAGE_SIZE)
+    except ValueError:
+        limit = settings.CHAT_SEARCH_PAGE_SIZE
+    hits, next_position = search_messages(request.user, request.GET.get('q', '')[:200], after = after, limit = max(limit, 1))
+    return JsonResponse({
+        'results': [
+            {
+                'msg_id': str(hit.message.id),
+                'room_name': f'chat_{hit.message.chat_session_id}',
+                'user': hit.message.user.username,
+                'message': hit.message.message_detail.get('msg'),
+                'timestamp': hit.message.created_at.isoformat(),
+                'rank': hit.rank,
+                'highlights': hit.highlights,
+            }
+            for hit in hits
+        ],
+        'next_cursor': encode_cursor(*next_position) if next_position else None,
+    })
+
+
+@login_required
+def get_last_message(request, room_name):
+    """
+    Returns the preview of the last message of a chat session as JSON.
+
+    The preview is read from the inbox row of the user instead of querying the messages
+    of the chat session.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        room_name (str): The unique identifier of the chat session (room).
+
+    Returns:
+        JsonResponse: The inbox row of the chat session, or an error with status 404 if the
+        user is not a participant of the chat session.
+    """
+    session_id = room_name[5:]
+    entry = None
+    if session_id.isdigit():
+        unread_counter = UnreadCounter.objects.filter(chat_session = OuterRef('chat_session'), user = request.user).values('count')[:1]
+        entry = (InboxEntry.objects.filter(user = request.user, chat_session_id = session_id)
+                 .select_related('other_user__profile_detail')
+                 .annotate(un_read_msg_count = Coalesce(Subquery(unread_counter), Value(0))).first())
+    if entry is None:
+        return JsonResponse({'error': 'Chat not found.'}, status = 404)
+    return JsonResponse(serialize_inbox_entry(entry))
+
+
+@staff_member_required
+def channel_layer_metrics(request):
+    """
+    Returns the counters of the channel layer of this process as JSON, for scraping by staff users.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: The layer backend and its queue depth, drop and latency counters, or an
+        error with status 404 if the configured layer does not keep counters.
+    """
+    layer = get_channel_layer()
+    if not hasattr(layer, 'metrics'):
+        return JsonResponse({'error': 'The channel layer keeps no metrics.'}, status = 404)
+    return JsonResponse({'backend': type(layer).__name__, 'metrics': layer.metrics()})
+
+
+@staff_member_required
+def write_behind_metrics(request):
+    """
+    Returns the counters of the write-behind queue of this process as JSON, for scraping by staff users.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: Whether the queue is enabled, its durability mode and its queue depth, flush
+        latency and failure counters.
+    """
+    return JsonResponse({'enabled': message_writer.enabled, 'durability': message_writer.durability, 'metrics': message_writer.metrics()})
+
+
+@staff_member_required
+def typing_metrics(request):
+    """
+    Returns the counters of the typing indicator debouncing of this process as JSON, for scraping by staff users.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        JsonResponse: The debounce window and timeout and the received, broadcast, suppressed and
+        expired typing report counters.
     """
-    session_id = request.data.get('room_id')
-    qs = ChatMessage.objects.filter(chat_session__id=session_id)[10]
-    return qs
+    return JsonResponse({'window': typing_tracker.window, 'timeout': typing_tracker.timeout, 'metrics': typing_tracker.metrics()})
 
 
 def logoutView(request):
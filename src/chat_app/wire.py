@@ -0,0 +1,168 @@
+import json
+import msgpack
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+def json_encoder():
+    """
+    Returns the compact standard library JSON encoder.
+
+    Returns:
+        callable: Encodes a frame into a str.
+    """
+    return json.JSONEncoder(separators = (',', ':'), ensure_ascii = False).encode
+
+
+def orjson_encoder():
+    """
+    Returns an encoder based on orjson, which must be installed.
+
+    Returns:
+        callable: Encodes a frame into a str.
+    """
+    import orjson
+    dumps = orjson.dumps
+    return lambda frame: dumps(frame).decode()
+
+
+def ujson_encoder():
+    """
+    Returns an encoder based on ujson, which must be installed.
+
+    Returns:
+        callable: Encodes a frame into a str.
+    """
+    import ujson
+    dumps = ujson.dumps
+    return lambda frame: dumps(frame, ensure_ascii = False)
+
+
+ENCODERS = {
+    'json': json_encoder,
+    'orjson': orjson_encoder,
+    'ujson': ujson_encoder,
+}
+
+
+def load_encoder(name):
+    """
+    Loads the JSON encoder used for the frames sent to WebSocket clients.
+
+    Args:
+        name (str): One of the names in `ENCODERS`, or the dotted path of a callable that
+            encodes a frame (a JSON serializable dict) into a str.
+
+    Returns:
+        callable: The encoder.
+
+    Raises:
+        ImproperlyConfigured: If the encoder or the library it needs cannot be imported.
+    """
+    try:
+        if name in ENCODERS:
+            return ENCODERS[name]()
+        return import_string(name)
+    except ImportError as error:
+        raise ImproperlyConfigured(f'CHAT_WIRE_ENCODER {name!r} cannot be loaded: {error}')
+
+
+encode_frame = load_encoder(getattr(settings, 'CHAT_WIRE_ENCODER', 'json'))
+
+# WebSocket subprotocol (or `protocol` query parameter value) selecting the binary protocol.
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+MSGPACK_QUERY_VALUE = 'msgpack'
+
+# Integer codes of the message types in binary frames. Codes must never be reused or changed, and
+# must match `WIRE_TYPE_CODES` in templates/chat/wire_protocol.html.
+MESSAGE_TYPE_CODES = {
+    'WENT_ONLINE': 1,
+    'WENT_OFFLINE': 2,
+    'HEARTBEAT': 3,
+    'IS_TYPING': 4,
+    'NOT_TYPING': 5,
+    'MESSAGE_COUNTER': 6,
+    'OVERALL_MESSAGE_COUNTER': 7,
+    'TEXT_MESSAGE': 8,
+    'MESSAGE_READ': 9,
+    'ALL_MESSAGE_READ': 10,
+    'READ_UNTIL': 11,
+    'RESUME': 12,
+    'RESYNC_REQUIRED': 13,
+    'ERROR_OCCURED': 14,
+    'MESSAGES_READ': 15,
+    'SUBSCRIBE': 16,
+    'UNSUBSCRIBE': 17,
+    'SUBSCRIBED': 18,
+    'UNSUBSCRIBED': 19,
+}
+MESSAGE_TYPE_NAMES = {code: name for name, code in MESSAGE_TYPE_CODES.items()}
+
+
+def encode_binary_frame(frame):
+    """
+    Encodes a frame for the binary protocol: msgpack, with the message type as its integer code.
+
+    Args:
+        frame (dict): The frame sent to the WebSocket clients.
+
+    Returns:
+        bytes: The encoded frame.
+    """
+    msg_type = frame.get('msg_type')
+    if msg_type in MESSAGE_TYPE_CODES:
+        frame = dict(frame, msg_type = MESSAGE_TYPE_CODES[msg_type])
+    return msgpack.packb(frame)
+
+
+def decode_frame(text_data = None, bytes_data = None):
+    """
+    Decodes a frame received from a WebSocket client in either protocol.
+
+    Args:
+        text_data (str): The frame of a JSON client.
+        bytes_data (bytes): The frame of a binary client.
+
+    Returns:
+        dict: The frame, with the message type as its name.
+
+    Raises:
+        ValueError: If the frame cannot be decoded or is not a map.
+    """
+    if bytes_data is None:
+        frame = json.loads(text_data)
+    else:
+        try:
+            frame = msgpack.unpackb(bytes_data)
+        except Exception as error:
+            raise ValueError(f'Invalid binary frame: {error}')
+    if not isinstance(frame, dict):
+        raise ValueError('A frame must be a map')
+    if isinstance(frame.get('msg_type'), int):
+        frame['msg_type'] = MESSAGE_TYPE_NAMES.get(frame['msg_type'])
+    return frame
+
+
+def frame_event(handler, frame, **extra):
+    """
+    Builds a channel layer event carrying a pre-encoded frame.
+
+    The frame is encoded once per protocol by the sender, however many sockets receive the
+    event: `frame` holds the JSON text and `binary_frame` the msgpack bytes. The consumer
+    handlers forward the one matching the protocol of their socket untouched.
+
+    The sender cannot know the protocols of the receiving sockets, so every event is encoded
+    twice and carries both encodings through the channel layer, even when no binary client is
+    connected. That costs one msgpack encode (about 1-2 us per frame with `bench_wire`) and the
+    msgpack bytes in every channel layer message, in exchange for never encoding per socket.
+
+    Args:
+        handler (str): The consumer handler of the event, e.g. 'chat_message'.
+        frame (dict): The frame sent to the WebSocket clients.
+        **extra: Further event keys for the handler, e.g. the sequence number of a room event.
+
+    Returns:
+        dict: The channel layer event.
+    """
+    return dict(extra, type = handler, frame = encode_frame(frame), binary_frame = encode_binary_frame(frame))
@@ -0,0 +1,226 @@
+import asyncio
+import atexit
+import logging
+import time
+from channels.db import database_sync_to_async
+from django.conf import settings
+from .models import ChatMessage
+from .unread_push import unread_pusher
+
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_COMMIT = 'commit'
+DURABILITY_BUFFERED = 'buffered'
+
+
+class MessageWriteBehind:
+    """
+    Per-process write-behind queue for the messages received by `ChatConsumer`.
+
+    Messages are collected in memory and written with one `ChatMessage.persist_messages` call
+    when `max_batch` messages are waiting or `flush_interval` seconds after the first message of
+    a batch arrived, whichever comes first. Flushes are serialized so the insertion order of the
+    messages is preserved. The unread counts of every flushed batch are handed to the unread pusher.
+    The messages were already broadcast to their room when they are queued, so a batch that fails
+    is retried one message at a time: a message that cannot be written does not take the other
+    messages of its batch down with it.
+
+    Durability modes:
+        commit: `submit` returns once the batch holding the message has been committed, errors are
+            raised to the sender.
+        buffered: `submit` returns immediately, messages still queued are lost if the process dies
+            without running the shutdown hook.
+
+    Attributes:
+        enabled (bool): Whether messages are queued at all.
+        flush_interval (float): The maximum number of seconds a message waits in the queue.
+        max_batch (int): The number of queued messages that triggers an immediate flush.
+        durability (str): One of `DURABILITY_COMMIT` or `DURABILITY_BUFFERED`.
+
+    Methods:
+        from_settings(): Creates the queue from the `CHAT_WRITE_BEHIND` setting.
+        submit(message, recipient_id): Queues a message for insertion.
+        flush(): Writes every queued message.
+        flush_on_shutdown(): Synchronously writes every queued message when the process exits.
+        metrics(): Returns the queue depth and flush latency counters.
+    """
+
+    def __init__(self, enabled = False, flush_interval = 0.005, max_batch = 100, durability = DURABILITY_COMMIT):
+        if durability not in (DURABILITY_COMMIT, DURABILITY_BUFFERED):
+            raise ValueError(f'Unknown write-behind durability mode: {durability}')
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.durability = durability
+        self._pending = []
+        self._timer = None
+        self._lock = None
+        self._stats = {
+            'max_queue_depth': 0,
+            'flushes': 0,
+            'flushed_messages': 0,
+            'failed_messages': 0,
+            'retried_batches': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates the queue from the `CHAT_WRITE_BEHIND` setting.
+
+        Returns:
+            MessageWriteBehind: The configured queue.
+        """
+        config = getattr(settings, 'CHAT_WRITE_BEHIND', {})
+        return cls(
+            enabled = config.get('ENABLED', False),
+            flush_interval = config.get('FLUSH_INTERVAL', 0.005),
+            max_batch = config.get('MAX_BATCH', 100),
+            durability = config.get('DURABILITY', DURABILITY_COMMIT),
+        )
+
+    async def submit(self, message, recipient_id):
+        """
+        Queues a message for insertion.
+
+        Args:
+            message (ChatMessage): The unsaved message.
+            recipient_id (int): The ID of the user receiving the message.
+
+        Raises:
+            DatabaseError: In commit mode, if the batch holding the message could not be written.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future() if self.durability == DURABILITY_COMMIT else None
+        self._pending.append((message, recipient_id, waiter))
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._pending))
+        if len(self._pending) >= self.max_batch:
+            self._cancel_timer()
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush_later, loop)
+        if waiter is not None:
+            await waiter
+
+    def _flush_later(self, loop):
+        """
+        Starts a flush from the timer of the current batch.
+        """
+        self._timer = None
+        loop.create_task(self.flush())
+
+    def _cancel_timer(self):
+        """
+        Cancels the pending flush timer, if any.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def flush(self):
+        """
+        Writes every queued message in one batch.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            start = time.perf_counter()
+            states, errors = await database_sync_to_async(self._persist)(batch)
+            self._record_flush(start)
+            unread_pusher.publish(states)
+            for (message, recipient_id, waiter), exc in zip(batch, errors):
+                if waiter is not None and not waiter.done():
+                    if exc is None:
+                        waiter.set_result(None)
+                    else:
+                        waiter.set_exception(exc)
+
+    def flush_on_shutdown(self):
+        """
+        Synchronously writes every queued message.
+
+        Registered with `atexit`, this runs after the event loop has stopped so the messages of
+        the last batch are not lost on a clean shutdown.
+        """
+        self._cancel_timer()
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        start = time.perf_counter()
+        self._persist(batch)
+        self._record_flush(start)
+
+    def _persist(self, batch):
+        """
+        Writes a batch of queued messages, retrying them one at a time if the batch fails.
+
+        Args:
+            batch (list): The queued (message, recipient_id, waiter) entries.
+
+        Returns:
+            tuple: The unread states of the written messages, and for every entry of the batch
+            the exception that prevented its message from being written, or None.
+        """
+        try:
+            states = ChatMessage.persist_messages([(message, recipient_id) for message, recipient_id, waiter in batch])
+            self._stats['flushed_messages'] += len(batch)
+            return states, [None] * len(batch)
+        except Exception as exc:
+            if len(batch) == 1:
+                self._record_failure(batch[0][0])
+                return [], [exc]
+            logger.exception('Write-behind flush of %s messages failed, retrying them one at a time', len(batch))
+            self._stats['retried_batches'] += 1
+        states = []
+        errors = []
+        for message, recipient_id, waiter in batch:
+            try:
+                states += ChatMessage.persist_messages([(message, recipient_id)])
+                self._stats['flushed_messages'] += 1
+                errors.append(None)
+            except Exception as exc:
+                self._record_failure(message)
+                errors.append(exc)
+        return states, errors
+
+    def _record_failure(self, message):
+        """
+        Records and logs a message that could not be written, from within its exception handler.
+        """
+        self._stats['failed_messages'] += 1
+        logger.exception('Write-behind insert of message %s failed', message.id)
+
+    def _record_flush(self, start):
+        """
+        Records the latency of a flush.
+        """
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._stats['flushes'] += 1
+        self._stats['last_flush_ms'] = elapsed_ms
+        self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+        self._stats['total_flush_ms'] += elapsed_ms
+
+    def metrics(self):
+        """
+        Returns the queue depth and flush latency counters.
+
+        Returns:
+            dict: The current and maximum queue depth, the number of flushes, flushed and failed
+            messages and of batches retried one message at a time, and the last, maximum and
+            average flush latency in milliseconds.
+        """
+        stats = dict(self._stats)
+        stats['queue_depth'] = len(self._pending)
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+
+message_writer = MessageWriteBehind.from_settings()
+atexit.register(message_writer.flush_on_shutdown)
@@ -2,16 +2,20 @@ import os
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-import chat_app.routing
 from channels.security.websocket import AllowedHostsOriginValidator
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_channel.settings")
 
+# Sets up Django before the consumers import models, so daphne can serve this module directly
+django_asgi_app = get_asgi_application()
+
+import chat_app.routing
+
 application = ProtocolTypeRouter({
-  "http": get_asgi_application(),
+  "http": django_asgi_app,
   "websocket": AllowedHostsOriginValidator(AuthMiddlewareStack(
         URLRouter(
             chat_app.routing.websocket_urlpatterns
         )
     )),
-})
\ No newline at end of file
+})
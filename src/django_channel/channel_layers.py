@@ -0,0 +1,38 @@
+from django.core.exceptions import ImproperlyConfigured
+
+
+CHANNEL_LAYER_BACKENDS = {
+    'local': 'django_channel.local_layer.LocalChannelLayer',
+    'memory': 'channels.layers.InMemoryChannelLayer',
+    'redis': 'channels_redis.core.RedisChannelLayer',
+    'redis_pubsub': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+}
+
+
+def channel_layer_config(layer, hosts, capacity, overflow = 'oldest'):
+    """
+    Builds the `CHANNEL_LAYERS` entry of a channel layer.
+
+    Args:
+        layer (str): The name of the layer, a key of `CHANNEL_LAYER_BACKENDS`.
+        hosts (list): The Redis URLs used by the Redis layers; the sharded layer spreads channels and groups over all of them.
+        capacity (int): The number of messages a channel holds before new ones overflow.
+        overflow (str): What the local layer does with a message sent to a full channel: 'drop', 'oldest' or 'close'.
+
+    Returns:
+        dict: The channel layer configuration.
+
+    Raises:
+        ImproperlyConfigured: If the layer name is unknown.
+    """
+    if layer not in CHANNEL_LAYER_BACKENDS:
+        raise ImproperlyConfigured(f'Unknown CHANNEL_LAYER {layer!r}, expected one of {", ".join(CHANNEL_LAYER_BACKENDS)}')
+    if layer == 'local':
+        config = {'capacity': capacity, 'overflow': overflow}
+    elif layer == 'memory':
+        config = {'capacity': capacity}
+    elif layer == 'redis_pubsub':
+        config = {'hosts': hosts}
+    else:
+        config = {'hosts': hosts, 'capacity': capacity}
+    return {'BACKEND': CHANNEL_LAYER_BACKENDS[layer], 'CONFIG': config}
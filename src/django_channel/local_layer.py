@@ -0,0 +1,422 @@
+import asyncio
+import random
+import string
+import time
+from collections import deque
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_OLDEST = 'oldest'
+OVERFLOW_CLOSE = 'close'
+
+OVERFLOW_EVENT = {'type': 'channel.overflow'}
+
+
+class ChannelQueue:
+    """
+    The pending messages and the waiting receivers of one channel.
+
+    Attributes:
+        messages (deque): (sent at, message) tuples, oldest first.
+        waiters (deque): Futures of the receivers waiting for a message, only set while `messages` is empty.
+        closed (bool): Whether the channel overflowed under the close policy and accepts no more messages.
+    """
+    __slots__ = ('messages', 'waiters', 'closed')
+
+    def __init__(self):
+        self.messages = deque()
+        self.waiters = deque()
+        self.closed = False
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """
+    In-process channel layer for single process deployments.
+
+    Unlike `channels.layers.InMemoryChannelLayer` it does not scan every channel and group for
+    expired entries on each send: expired messages are dropped when their channel is received from
+    or sent to, group memberships are checked for expiry only while their own group is sent to, and
+    a full sweep runs at most once every `expiry` seconds. Group members are kept in a dict per
+    group and the groups of every channel in a dict per channel, so joins, leaves and the removal
+    of a dead channel from its groups do not walk other groups. A message sent to a channel with a
+    waiting receiver is handed over directly, and every delivery gets a shallow copy of the message
+    instead of a deep copy, so nested values are shared between the receivers and must not be
+    modified.
+
+    When a channel holds `capacity` messages, the overflow policy decides what happens:
+        drop: the new message is dropped, a direct `send` raises `ChannelFull`.
+        oldest: the oldest pending message is dropped to make room for the new one.
+        close: the pending messages are dropped, the channel leaves its groups, refuses further
+            messages and receives a single `channel.overflow` event telling its consumer to close.
+
+    Attributes:
+        expiry (int): Seconds after which an undelivered message expires and its channel is considered gone.
+        group_expiry (int): Seconds after which a group membership expires, 0 to never expire them.
+        capacity (int): Messages a channel holds, unless `channel_capacity` matches its name.
+        overflow (str): One of `OVERFLOW_DROP`, `OVERFLOW_OLDEST` or `OVERFLOW_CLOSE`.
+
+    Methods:
+        send(channel, message): Sends a message to a channel.
+        receive(channel): Receives the next message of a channel.
+        new_channel(prefix): Returns a new process specific channel name.
+        group_add(group, channel): Adds a channel to a group.
+        group_discard(group, channel): Removes a channel from a group.
+        group_send(group, message): Sends a message to every channel of a group.
+        flush(): Drops every channel, group and pending message.
+        metrics(): Returns the queue depth, drop and latency counters.
+    """
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry = 60, group_expiry = 86400, capacity = 100, channel_capacity = None, overflow = OVERFLOW_DROP, **kwargs):
+        super().__init__(expiry = expiry, capacity = capacity, channel_capacity = channel_capacity, **kwargs)
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_OLDEST, OVERFLOW_CLOSE):
+            raise ValueError(f'Unknown channel layer overflow policy: {overflow}')
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_expiry = group_expiry
+        self.overflow = overflow
+        self._channels = {}
+        self._groups = {}
+        self._memberships = {}
+        self._capacities = {}
+        self._next_sweep = time.monotonic() + expiry
+        self._stats = {
+            'sent': 0,
+            'received': 0,
+            'group_sends': 0,
+            'dropped': 0,
+            'evicted': 0,
+            'closed_channels': 0,
+            'expired_messages': 0,
+            'expired_memberships': 0,
+            'max_queue_depth': 0,
+            'total_latency_ms': 0.0,
+            'max_latency_ms': 0.0,
+            'total_group_send_ms': 0.0,
+        }
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """
+        Sends a message to a channel.
+
+        Args:
+            channel (str): The channel name.
+            message (dict): The message.
+
+        Raises:
+            ChannelFull: If the message was not queued because the channel is full or closed.
+        """
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        now = time.monotonic()
+        self._maybe_sweep(now)
+        if not self._deliver(channel, message, now):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        """
+        Receives the next message of a channel, waiting for one if none is pending.
+
+        If several coroutines receive from the same channel, each message goes to one of them.
+
+        Args:
+            channel (str): The channel name.
+
+        Returns:
+            dict: The message.
+        """
+        assert self.valid_channel_name(channel)
+        queue = self._channels.get(channel)
+        if queue is None:
+            queue = self._channels[channel] = ChannelQueue()
+        now = time.monotonic()
+        if queue.messages:
+            # The receiver is alive, so expired messages leave the channel in its groups
+            self._drop_expired(channel, queue, now, gone = False)
+        if queue.messages:
+            sent_at, message = queue.messages.popleft()
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            queue.waiters.append(waiter)
+            try:
+                sent_at, message = await waiter
+            except asyncio.CancelledError:
+                if waiter in queue.waiters:
+                    queue.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # Handed over just before the cancellation, keep it for the next receiver
+                    queue.messages.appendleft(waiter.result())
+                if not queue.messages and not queue.waiters and self._channels.get(channel) is queue:
+                    del self._channels[channel]
+                raise
+            now = time.monotonic()
+        if not queue.messages and not queue.waiters and self._channels.get(channel) is queue:
+            del self._channels[channel]
+        latency_ms = (now - sent_at) * 1000
+        self._stats['received'] += 1
+        self._stats['total_latency_ms'] += latency_ms
+        self._stats['max_latency_ms'] = max(self._stats['max_latency_ms'], latency_ms)
+        return message
+
+    async def new_channel(self, prefix = 'specific.'):
+        """
+        Returns a new channel name that can be used by something in this process as a specific channel.
+
+        Args:
+            prefix (str): The prefix of the name.
+
+        Returns:
+            str: The channel name.
+        """
+        return '%s.local!%s' % (prefix, ''.join(random.choice(string.ascii_letters) for _ in range(12)))
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """
+        Adds a channel to a group, or refreshes its membership.
+
+        Args:
+            group (str): The group name.
+            channel (str): The channel name.
+        """
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self._groups.setdefault(group, {})[channel] = time.monotonic()
+        self._memberships.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        """
+        Removes a channel from a group.
+
+        Args:
+            group (str): The group name.
+            channel (str): The channel name.
+        """
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self._leave(group, channel)
+
+    async def group_send(self, group, message):
+        """
+        Sends a message to every channel of a group, dropping it for channels that are full or closed.
+
+        Args:
+            group (str): The group name.
+            message (dict): The message.
+        """
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        start = time.perf_counter()
+        now = time.monotonic()
+        self._maybe_sweep(now)
+        members = self._groups.get(group)
+        if members:
+            joined_before = now - self.group_expiry if self.group_expiry else None
+            for channel, joined_at in list(members.items()):
+                if joined_before is not None and joined_at < joined_before:
+                    self._stats['expired_memberships'] += 1
+                    self._leave(group, channel)
+                    continue
+                self._deliver(channel, message, now)
+        self._stats['group_sends'] += 1
+        self._stats['total_group_send_ms'] += (time.perf_counter() - start) * 1000
+
+    # Flush extension
+
+    async def flush(self):
+        """
+        Drops every channel, group and pending message.
+        """
+        self._channels = {}
+        self._groups = {}
+        self._memberships = {}
+
+    async def close(self):
+        pass
+
+    def metrics(self):
+        """
+        Returns the queue depth, drop and latency counters.
+
+        Returns:
+            dict: The number of channels, pending messages, waiting receivers and groups, the
+            current and maximum queue depth, the sent, received and dropped messages by cause,
+            the average and maximum send-to-receive latency and the average group send duration
+            in milliseconds.
+        """
+        stats = dict(self._stats)
+        depths = [len(queue.messages) for queue in self._channels.values()]
+        stats['channels'] = len(self._channels)
+        stats['groups'] = len(self._groups)
+        stats['pending_messages'] = sum(depths)
+        stats['queue_depth'] = max(depths, default = 0)
+        stats['waiting_receivers'] = sum(len(queue.waiters) for queue in self._channels.values())
+        stats['avg_latency_ms'] = stats['total_latency_ms'] / stats['received'] if stats['received'] else 0.0
+        stats['avg_group_send_ms'] = stats['total_group_send_ms'] / stats['group_sends'] if stats['group_sends'] else 0.0
+        return stats
+
+    # Internals
+
+    def _deliver(self, channel, message, now):
+        """
+        Hands a copy of a message to a waiting receiver of a channel or queues it, applying the overflow policy.
+
+        Args:
+            channel (str): The channel name.
+            message (dict): The message.
+            now (float): The current `time.monotonic()`.
+
+        Returns:
+            bool: Whether the message was handed over or queued.
+        """
+        queue = self._channels.get(channel)
+        if queue is None:
+            queue = self._channels[channel] = ChannelQueue()
+        elif queue.closed:
+            self._stats['dropped'] += 1
+            return False
+        elif queue.messages and self._drop_expired(channel, queue, now):
+            queue = self._channels.setdefault(channel, queue)
+        self._stats['sent'] += 1
+        while queue.waiters:
+            waiter = queue.waiters.popleft()
+            if not waiter.done():
+                self._wake(waiter, (now, dict(message)))
+                return True
+        messages = queue.messages
+        if len(messages) >= self._capacity(channel):
+            if self.overflow == OVERFLOW_DROP:
+                self._stats['dropped'] += 1
+                return False
+            if self.overflow == OVERFLOW_CLOSE:
+                self._stats['dropped'] += len(messages) + 1
+                self._stats['closed_channels'] += 1
+                messages.clear()
+                messages.append((now, dict(OVERFLOW_EVENT)))
+                queue.closed = True
+                self._remove_from_groups(channel)
+                return False
+            messages.popleft()
+            self._stats['evicted'] += 1
+        messages.append((now, dict(message)))
+        if len(messages) > self._stats['max_queue_depth']:
+            self._stats['max_queue_depth'] = len(messages)
+        return True
+
+    def _wake(self, waiter, item):
+        """
+        Resolves the future of a waiting receiver, from its own event loop.
+
+        Args:
+            waiter (asyncio.Future): The future.
+            item (tuple): The (sent at, message) tuple.
+        """
+        loop = waiter.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            waiter.set_result(item)
+        else:
+            loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(item))
+
+    def _capacity(self, channel):
+        """
+        Returns the capacity of a channel, caching the match of `channel_capacity`.
+
+        Args:
+            channel (str): The channel name.
+
+        Returns:
+            int: The capacity.
+        """
+        if not self.channel_capacity:
+            return self.capacity
+        capacity = self._capacities.get(channel)
+        if capacity is None:
+            if len(self._capacities) >= 10000:
+                self._capacities.clear()
+            capacity = self._capacities[channel] = self.get_capacity(channel)
+        return capacity
+
+    def _drop_expired(self, channel, queue, now, gone = True):
+        """
+        Drops the expired messages at the head of a channel.
+
+        Args:
+            channel (str): The channel name.
+            queue (ChannelQueue): The channel queue.
+            now (float): The current `time.monotonic()`.
+            gone (bool): Whether an expired message means nothing receives from the channel anymore,
+                which removes it from its groups and deletes it once empty.
+
+        Returns:
+            bool: Whether messages expired.
+        """
+        messages = queue.messages
+        sent_before = now - self.expiry
+        expired = 0
+        while messages and messages[0][0] < sent_before:
+            messages.popleft()
+            expired += 1
+        if not expired:
+            return False
+        self._stats['expired_messages'] += expired
+        if not gone:
+            return True
+        self._remove_from_groups(channel)
+        if not messages and not queue.waiters:
+            del self._channels[channel]
+        return True
+
+    def _maybe_sweep(self, now):
+        """
+        Drops the expired messages of every channel, at most once every `expiry` seconds.
+
+        Catches the channels that are never sent to nor received from again, whose expired
+        messages would otherwise be kept forever.
+
+        Args:
+            now (float): The current `time.monotonic()`.
+        """
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.expiry
+        for channel, queue in list(self._channels.items()):
+            if queue.messages:
+                self._drop_expired(channel, queue, now)
+
+    def _leave(self, group, channel):
+        """
+        Removes a channel from a group, deleting the group and the membership set once empty.
+
+        Args:
+            group (str): The group name.
+            channel (str): The channel name.
+        """
+        members = self._groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self._groups[group]
+        groups = self._memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self._memberships[channel]
+
+    def _remove_from_groups(self, channel):
+        """
+        Removes a channel from every group it belongs to.
+
+        Args:
+            channel (str): The channel name.
+        """
+        for group in list(self._memberships.get(channel, ())):
+            self._leave(group, channel)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
 from pathlib import Path
+from django_channel.channel_layers import channel_layer_config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -66,6 +67,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'chat_app.context_processors.wire_protocol',
             ],
         },
     },
@@ -81,11 +83,11 @@ ASGI_APPLICATION = 'django_channel.asgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'chatApplication',
-        'USER': 'postgres',
-        'PASSWORD': 'admin123',
-        'HOST': 'localhost',
-        'PORT': '5432'
+        'NAME': os.environ.get('DATABASE_NAME', 'chatApplication'),
+        'USER': os.environ.get('DATABASE_USER', 'postgres'),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', 'admin123'),
+        'HOST': os.environ.get('DATABASE_HOST', 'localhost'),
+        'PORT': os.environ.get('DATABASE_PORT', '5432')
     }
 }
 
@@ -140,13 +142,75 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 # ================================= Channel Settings ===========================
+# The channel layer is selected with the CHANNEL_LAYER environment variable, one of
+# django_channel.channel_layers.CHANNEL_LAYER_BACKENDS:
+#   local         django_channel.local_layer.LocalChannelLayer, single process only, the default
+#   memory        channels InMemoryChannelLayer, single process only
+#   redis         channels_redis sharded layer, each host of CHANNEL_REDIS_HOSTS is a shard
+#   redis_pubsub  channels_redis Redis Pub/Sub layer
+CHANNEL_LAYER = os.environ.get('CHANNEL_LAYER', 'local')
+CHANNEL_REDIS_HOSTS = os.environ.get('CHANNEL_REDIS_HOSTS', 'redis://127.0.0.1:6379/0').split(',')     # Comma separated Redis URLs
+CHANNEL_CAPACITY = int(os.environ.get('CHANNEL_CAPACITY', 1000))      # Messages a channel holds before new ones overflow
+CHANNEL_OVERFLOW = os.environ.get('CHANNEL_OVERFLOW', 'oldest')        # Local layer policy for full channels: 'drop', 'oldest' or 'close'
+
 CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        # 'CONFIG': {
-        #     "hosts": [('127.0.0.1', 6379)],
-        # },
-    },
+    'default': channel_layer_config(CHANNEL_LAYER, CHANNEL_REDIS_HOSTS, CHANNEL_CAPACITY, CHANNEL_OVERFLOW),
+}
+
+
+# ================================= Chat Settings ==============================
+CHAT_HISTORY_PAGE_SIZE = 50     # Messages rendered when a chat is opened and returned per history page
+
+CHAT_INBOX_PAGE_SIZE = 50       # Conversations returned per inbox page
+
+CHAT_DIRECTORY_PAGE_SIZE = 20   # Users returned per page of the create friend directory
+
+CHAT_SEARCH_PAGE_SIZE = 20      # Hits returned per page of the message search
+
+CHAT_SYNC_PAGE_SIZE = 200       # Messages returned per delta sync request of a reconnecting client
+
+CHAT_REPLAY = {
+    'BUFFER_SIZE': 256,         # Recent sequenced events kept per room for replays on reconnect
+    'MAX_ROOMS': 10000,         # Rooms whose sequence counter and replay buffer are kept per process
+    'DATABASE_LIMIT': 500,      # Missed messages replayed from the database before the client must resync
+}
+
+CHAT_WIRE_ENCODER = 'json'      # Encoder of WebSocket frames: 'json', 'orjson', 'ujson' or a dotted path to a callable
+
+CHAT_WIRE_BINARY = False        # Whether pages ask for the binary msgpack protocol; a page opened with ?protocol=msgpack always does
+
+CHAT_PARTICIPANT_CACHE_SIZE = 10000    # Chat sessions whose participants are cached per process
+
+CHAT_FRIEND_INDEX_CACHE_SIZE = 10000   # Users whose chat partners are cached per process for presence fan-out
+
+CHAT_PRESENCE = {
+    'HEARTBEAT_TTL': 60,        # Seconds without a heartbeat after which a personal connection is considered gone
+    'FLUSH_INTERVAL': 1,        # Seconds between batched writes of Profile.is_online
+}
+
+CHAT_TYPING = {
+    'WINDOW': 1.0,              # Minimum seconds between two broadcast typing transitions of a user in a room
+    'TIMEOUT': 6.0,             # Seconds after the last IS_TYPING at which the typing state expires
+}
+
+CHAT_UNREAD_PUSH = {
+    'WINDOW': 0.1,              # Seconds the new unread counts of a recipient are coalesced into one MESSAGE_COUNTER push
+}
+
+CHAT_CLUSTER = {
+    # Redis server of the state shared by several worker processes (presence, room sequence numbers,
+    # cache invalidations); empty runs a single process. Defaults to the first channel layer host
+    # when a Redis channel layer is selected.
+    'REDIS_URL': os.environ.get('CHAT_REDIS_URL', CHANNEL_REDIS_HOSTS[0] if CHANNEL_LAYER.startswith('redis') else ''),
+}
+
+CHAT_SESSION_TOUCH_INTERVAL = 2    # Seconds ChatSession.updated_on (friend list ordering) may lag behind the newest message
+
+CHAT_WRITE_BEHIND = {
+    'ENABLED': False,           # Queue incoming messages per process and insert them in batches
+    'FLUSH_INTERVAL': 0.005,    # Seconds the first message of a batch may wait before the batch is written
+    'MAX_BATCH': 100,           # Number of queued messages that triggers an immediate write
+    'DURABILITY': 'commit',     # 'commit': the sender waits for the batch to be committed, 'buffered': fire and forget
 }
 
 